@@ -0,0 +1,451 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Storage backends for deco.memo.
+
+DictBackend keeps results in process memory, SQLiteBackend and
+MmapBackend keep them on disk, so a restarted process finds the results
+computed by the previous one. Every backend is bound to one decorated
+function (its namespace) and a version: entries written under another
+version (changed function source or user tag) are dropped on bind.
+"""
+import hashlib
+import mmap
+import os
+import pickle
+import sqlite3
+import struct
+from collections import OrderedDict
+from contextlib import contextmanager
+from copy import copy
+from typing import Any
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Признак отсутствия значения в кеше (None тоже может быть результатом)
+MISSING = object()
+# Разделитель позиционных и именованных аргументов в ключе кеша
+_KWARGS_MARK = object()
+
+
+def make_key(args: tuple, kwargs: dict) -> tuple:
+    """
+    Build a hashable cache key from positional and keyword arguments.
+    Keyword order does not matter: f(a=1, b=2) and f(b=2, a=1) share a key.
+    """
+    if not kwargs:
+        return args
+    return args + (_KWARGS_MARK,) + tuple(sorted(kwargs.items()))
+
+
+def _encode(obj: Any) -> bytes:
+    """
+    Canonical encoding of an argument: equal builtin values give
+    equal bytes in any process. Other objects are pickled.
+    """
+    # bool проверяется раньше int, так как является его подклассом
+    if obj is None:
+        return b"N"
+    if obj is True or obj is False:
+        return b"T" if obj else b"F"
+    if isinstance(obj, int):
+        return b"i%d;" % obj
+    if isinstance(obj, float):
+        return b"f" + obj.hex().encode("ascii") + b";"
+    if isinstance(obj, str):
+        data = obj.encode("UTF-8", errors="surrogatepass")
+        return b"s%d:" % len(data) + data
+    if isinstance(obj, bytes):
+        return b"b%d:" % len(obj) + obj
+    if isinstance(obj, (tuple, list)):
+        return (b"t" if isinstance(obj, tuple) else b"l") + b"%d:" % len(obj) + b"".join(map(_encode, obj))
+    if isinstance(obj, dict):
+        # Порядок ключей словаря не влияет на хеш
+        items = sorted(_encode(key) + _encode(value) for key, value in obj.items())
+        return b"d%d:" % len(items) + b"".join(items)
+    if isinstance(obj, (set, frozenset)):
+        items = sorted(map(_encode, obj))
+        return b"e%d:" % len(items) + b"".join(items)
+    data = pickle.dumps(obj, protocol=4)
+    return b"p%d:" % len(data) + data
+
+
+def stable_hash(args: tuple, kwargs: dict) -> bytes:
+    """
+    SHA-256 of the arguments that does not depend on the process
+    (unlike hash() of strings), used as a key by persistent backends.
+    """
+    return hashlib.sha256(_encode(args) + _encode(kwargs)).digest()
+
+
+class MemoBackend:
+    """
+    Base class of memo storage. A configured backend is a template:
+    memo calls bind() to get a fresh instance holding the storage
+    of one function, so one backend object can serve several functions.
+    """
+    # Переживает ли кеш перезапуск процесса
+    persistent = False
+
+    def __init__(self, maxsize: int = None):
+        self.maxsize = maxsize
+        self.evictions = 0
+        self.namespace = None
+        self.version = None
+
+    def bind(self, namespace: str, version: str) -> "MemoBackend":
+        """Return an instance storing results of function namespace of the given version"""
+        bound = copy(self)
+        bound.evictions = 0
+        bound.namespace = namespace
+        bound.version = version
+        bound.open()
+        return bound
+
+    def open(self):
+        """Create (or load) the storage of a bound instance"""
+        raise NotImplementedError
+
+    def close(self):
+        """Release files and connections of a bound instance"""
+
+    def make_key(self, args: tuple, kwargs: dict) -> Any:
+        """Cache key for a call"""
+        return stable_hash(args, kwargs) if self.persistent else make_key(args, kwargs)
+
+    def get(self, key: Any) -> Any:
+        """Stored value or MISSING"""
+        raise NotImplementedError
+
+    def set(self, key: Any, value: Any):
+        """Store a value, evicting least recently used ones past maxsize"""
+        raise NotImplementedError
+
+    def delete(self, key: Any):
+        """Remove a value if it is stored"""
+        raise NotImplementedError
+
+    def clear(self):
+        """Remove all values of the function"""
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+
+class DictBackend(MemoBackend):
+    """In-process LRU storage (None maxsize - unbounded)"""
+
+    def __init__(self, maxsize: int = None):
+        super().__init__(maxsize=maxsize)
+        self.cache: OrderedDict = None
+
+    def open(self):
+        self.cache = OrderedDict()
+
+    def get(self, key: Any) -> Any:
+        value = self.cache.get(key, MISSING)
+        if value is not MISSING:
+            self.cache.move_to_end(key)
+        return value
+
+    def set(self, key: Any, value: Any):
+        self.cache[key] = value
+        self.cache.move_to_end(key)
+        if self.maxsize is not None and len(self.cache) > self.maxsize:
+            # Вытесняем давно не использованный результат
+            self.cache.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key: Any):
+        self.cache.pop(key, None)
+
+    def clear(self):
+        self.cache.clear()
+
+    def __len__(self) -> int:
+        return len(self.cache)
+
+
+class SQLiteBackend(MemoBackend):
+    """
+    Storage in an SQLite database, shared by all functions
+    memoized with it. Values are pickled; the least recently used
+    of the function's rows are deleted past maxsize. Hits do not
+    write: their use times are kept in memory and written before
+    an eviction and on close.
+    """
+    persistent = True
+
+    def __init__(self, path: str, maxsize: int = 100_000):
+        super().__init__(maxsize=maxsize)
+        self.path = path
+        self.connection: sqlite3.Connection = None
+        self.size = 0
+        # Время использования - номер обращения к хранилищу
+        self.clock = 0
+        # Ключ -> время использования, еще не записанное в базу
+        self.used: dict[bytes, int] = {}
+
+    def open(self):
+        # memo обращается к хранилищу под блокировкой, соединение можно делить между потоками
+        self.connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS memo (namespace TEXT, key BLOB, version TEXT, "
+                                "value BLOB, used INTEGER, PRIMARY KEY (namespace, key))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS memo_used ON memo (namespace, used)")
+        # Результаты другой версии функции больше не действительны
+        self.connection.execute("DELETE FROM memo WHERE namespace = ? AND version != ?",
+                                (self.namespace, self.version))
+        self.size, self.clock = self.connection.execute(
+            "SELECT COUNT(*), COALESCE(MAX(used), 0) FROM memo WHERE namespace = ?", (self.namespace,)).fetchone()
+        self.used = {}
+
+    def close(self):
+        if self.connection is not None:
+            self._write_used()
+            self.connection.close()
+            self.connection = None
+
+    def _write_used(self):
+        """Write the use times of hits"""
+        if self.used:
+            self.connection.executemany("UPDATE memo SET used = ? WHERE namespace = ? AND key = ?",
+                                        [(used, self.namespace, key) for key, used in self.used.items()])
+            self.used.clear()
+
+    def get(self, key: bytes) -> Any:
+        row = self.connection.execute("SELECT value FROM memo WHERE namespace = ? AND key = ?",
+                                      (self.namespace, key)).fetchone()
+        if row is None:
+            return MISSING
+        if self.maxsize is not None:
+            # Время использования нужно только для вытеснения
+            self.clock += 1
+            self.used[key] = self.clock
+        return pickle.loads(row[0])
+
+    def set(self, key: bytes, value: Any):
+        self.clock += 1
+        self.connection.execute("INSERT OR REPLACE INTO memo VALUES (?, ?, ?, ?, ?)",
+                                (self.namespace, key, self.version,
+                                 pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), self.clock))
+        self.size += 1
+        if self.maxsize is None or self.size <= self.maxsize:
+            return
+        # Счетчик мог быть завышен перезаписью ключа, уточняем
+        self.size = self.connection.execute("SELECT COUNT(*) FROM memo WHERE namespace = ?",
+                                            (self.namespace,)).fetchone()[0]
+        excess = self.size - self.maxsize
+        if excess > 0:
+            self._write_used()
+            self.connection.execute("DELETE FROM memo WHERE rowid IN (SELECT rowid FROM memo WHERE namespace = ? "
+                                    "ORDER BY used LIMIT ?)", (self.namespace, excess))
+            self.evictions += excess
+            self.size = self.maxsize
+
+    def delete(self, key: bytes):
+        cursor = self.connection.execute("DELETE FROM memo WHERE namespace = ? AND key = ?", (self.namespace, key))
+        self.size -= cursor.rowcount
+
+    def clear(self):
+        self.connection.execute("DELETE FROM memo WHERE namespace = ?", (self.namespace,))
+        self.size = 0
+        self.used.clear()
+
+    def __len__(self) -> int:
+        return self.size
+
+
+class MmapBackend(MemoBackend):
+    """
+    Storage in a memory-mapped append-only file per function
+    (directory/<namespace hash>.memo) of at most max_bytes.
+    Values are read straight from the mapping; when the file is full,
+    the most recently used values are compacted into its first half.
+    Several processes (or several binds in one process) may share
+    the file: every access takes flock on it and first reads the
+    records appended by the others, a compaction by another writer
+    is noticed by its generation number. Without fcntl (Windows)
+    the file must have a single user.
+    """
+    persistent = True
+    MAGIC = b"DECOMEM2"
+    # Заголовок: сигнатура, хеш версии, конец записанных данных, номер поколения (растет при очистке файла)
+    HEADER = struct.Struct("<8s32sQQ")
+    # Запись: ключ, длина значения (TOMBSTONE - ключ удален), значение
+    RECORD = struct.Struct("<32sI")
+    TOMBSTONE = 0xFFFFFFFF
+
+    def __init__(self, directory: str, maxsize: int = None, max_bytes: int = 64 * 2 ** 20):
+        super().__init__(maxsize=maxsize)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.path: str = None
+        self.version_hash: bytes = None
+        # Ключ -> (смещение значения, длина), в порядке использования
+        self.index: OrderedDict = None
+        self.end = self.HEADER.size
+        self.generation: int = None
+        # Файл остается открытым, пока открыто хранилище: на нем берется блокировка
+        self.file = None
+        self.buffer: mmap.mmap = None
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        name = hashlib.sha256(self.namespace.encode("UTF-8")).hexdigest()[:32]
+        self.path = os.path.join(self.directory, f"{name}.memo")
+        self.version_hash = hashlib.sha256(self.version.encode("UTF-8")).digest()
+        self.index = OrderedDict()
+        self.end = self.HEADER.size
+        self.generation = None
+        self.file = open(self.path, "a+b")
+        with self._locked(exclusive=True):
+            size = os.fstat(self.file.fileno()).st_size
+            if size < self.HEADER.size + self.RECORD.size:
+                # Новый файл; размер существующего не меняется - его отображают другие процессы
+                os.ftruncate(self.file.fileno(), self.max_bytes)
+                size = self.max_bytes
+            self.max_bytes = size
+            self.buffer = mmap.mmap(self.file.fileno(), size)
+            if not self._sync():
+                # Новый файл или результаты другой версии функции
+                self._reset()
+            self._trim()
+
+    def close(self):
+        if self.buffer is not None:
+            self.buffer.close()
+            self.buffer = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    @contextmanager
+    def _locked(self, exclusive: bool):
+        """Lock the file for the time of an access"""
+        if fcntl is None:
+            yield
+            return
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+
+    def _sync(self) -> bool:
+        """
+        Catch the index up with the file: read the records appended
+        by others, all of them after a compaction. False - the file
+        is not initialised or holds another version of the function
+        """
+        magic, version_hash, end, generation = self.HEADER.unpack_from(self.buffer, 0)
+        if magic != self.MAGIC or version_hash != self.version_hash or end > self.max_bytes:
+            self.index.clear()
+            self.generation = None
+            return False
+        if generation != self.generation:
+            self.index.clear()
+            self.end = self.HEADER.size
+            self.generation = generation
+        position = self.end
+        while position < end:
+            key, length = self.RECORD.unpack_from(self.buffer, position)
+            position += self.RECORD.size
+            self.index.pop(key, None)
+            if length == self.TOMBSTONE:
+                continue
+            self.index[key] = (position, length)
+            position += length
+        self.end = end
+        return True
+
+    def _reset(self):
+        """Empty the file, starting a new generation"""
+        _, _, _, generation = self.HEADER.unpack_from(self.buffer, 0)
+        self.generation = (generation + 1) % 2 ** 64
+        self.index.clear()
+        self._set_end(self.HEADER.size)
+
+    def _set_end(self, end: int):
+        """Commit the data written before end"""
+        self.end = end
+        self.HEADER.pack_into(self.buffer, 0, self.MAGIC, self.version_hash, end, self.generation)
+
+    def _append(self, key: bytes, data: bytes = None) -> bool:
+        """Append a record (data None - tombstone), compacting the file if it is full"""
+        size = self.RECORD.size + (0 if data is None else len(data))
+        if self.HEADER.size + size > self.max_bytes // 2:
+            # Значение не поместится даже после уплотнения
+            return False
+        if self.end + size > self.max_bytes:
+            self._compact()
+            if data is None:
+                # Удаленного ключа после уплотнения в файле нет
+                return True
+        position = self.end
+        self.RECORD.pack_into(self.buffer, position, key, self.TOMBSTONE if data is None else len(data))
+        if data is not None:
+            self.buffer[position + self.RECORD.size:position + size] = data
+            self.index.pop(key, None)
+            self.index[key] = (position + self.RECORD.size, len(data))
+        self._set_end(position + size)
+        return True
+
+    def _compact(self):
+        """Keep the most recently used values fitting into half of the file"""
+        kept, total = [], self.HEADER.size
+        for key, (offset, length) in reversed(self.index.items()):
+            total += self.RECORD.size + length
+            if total > self.max_bytes // 2:
+                break
+            kept.append((key, self.buffer[offset:offset + length]))
+        self.evictions += len(self.index) - len(kept)
+        self._reset()
+        for key, data in reversed(kept):
+            self._append(key, data)
+
+    def _trim(self):
+        """Evict least recently used values past maxsize"""
+        while self.maxsize is not None and len(self.index) > self.maxsize:
+            key, _ = self.index.popitem(last=False)
+            self._append(key)
+            self.evictions += 1
+
+    def get(self, key: bytes) -> Any:
+        with self._locked(exclusive=False):
+            self._sync()
+            location = self.index.get(key)
+            if location is None:
+                return MISSING
+            self.index.move_to_end(key)
+            offset, length = location
+            # Значение копируется под блокировкой: другой процесс может уплотнить файл
+            data = self.buffer[offset:offset + length]
+        return pickle.loads(data)
+
+    def set(self, key: bytes, value: Any):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._locked(exclusive=True):
+            if not self._sync():
+                # Файл занят результатами другой версии функции - теперь он наш
+                self._reset()
+            if self._append(key, data):
+                self._trim()
+
+    def delete(self, key: bytes):
+        with self._locked(exclusive=True):
+            if self._sync() and self.index.pop(key, None) is not None:
+                self._append(key)
+
+    def clear(self):
+        with self._locked(exclusive=True):
+            self._reset()
+
+    def __len__(self) -> int:
+        with self._locked(exclusive=False):
+            self._sync()
+            return len(self.index)
@@ -0,0 +1,537 @@
+import asyncio
+import os
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from unittest import mock
+
+from benchmark import MAX_RELATIVE, find_regressions, relative_cost
+from deco import countcalls, memo, n_ary, profile, ProfileRegistry
+from memo_backends import MISSING, SQLiteBackend, MmapBackend
+
+
+def set_in_process(backend, namespace: str, version: str, key: bytes, value):
+    """
+    Записывает значение в хранилище из другого процесса
+    """
+    bound = backend.bind(namespace, version=version)
+    bound.set(key, value)
+    size = len(bound)
+    bound.close()
+    return size
+
+
+def open_files(catalog: str) -> list[str]:
+    """
+    Открытые процессом файлы в каталоге catalog
+    """
+    paths = [os.path.realpath(f"/proc/self/fd/{fd}") for fd in os.listdir("/proc/self/fd")]
+    return [path for path in paths if path.startswith(os.path.realpath(catalog))]
+
+
+class BackendTests(unittest.TestCase):
+
+    def bind(self, backend, namespace: str, version: str):
+        """
+        Хранилище функции, закрываемое после теста
+        """
+        bound = backend.bind(namespace, version=version)
+        self.addCleanup(bound.close)
+        return bound
+
+    def make_backends(self, catalog: str, maxsize: int = None) -> list:
+        """
+        Постоянные хранилища в каталоге catalog
+        """
+        return [SQLiteBackend(f"{catalog}/memo.sqlite", maxsize=maxsize),
+                MmapBackend(f"{catalog}/mmap", maxsize=maxsize, max_bytes=64 * 1024)]
+
+    def test_warm_restart(self):
+        """
+        Результаты переживают перезапуск: новое хранилище той же версии их находит
+        """
+        with tempfile.TemporaryDirectory() as catalog:
+            for backend in self.make_backends(catalog):
+                bound = self.bind(backend, "func", version="1")
+                key = bound.make_key((1, "a"), {"b": None})
+                bound.set(key, {"result": [1, 2]})
+                bound.set(bound.make_key((2,), {}), None)
+                restarted = self.bind(backend, "func", version="1")
+                self.assertEqual(restarted.get(key), {"result": [1, 2]}, type(backend).__name__)
+                self.assertIsNone(restarted.get(bound.make_key((2,), {})))
+                self.assertIs(restarted.get(bound.make_key((3,), {})), MISSING)
+                self.assertEqual(len(restarted), 2)
+
+    def test_version_invalidation(self):
+        """
+        Результаты другой версии функции не возвращаются
+        """
+        with tempfile.TemporaryDirectory() as catalog:
+            for backend in self.make_backends(catalog):
+                bound = self.bind(backend, "func", version="1")
+                key = bound.make_key((1,), {})
+                bound.set(key, "old")
+                changed = self.bind(backend, "func", version="2")
+                self.assertIs(changed.get(key), MISSING, type(backend).__name__)
+                self.assertEqual(len(changed), 0)
+                # Другая функция в том же хранилище не затрагивается
+                other = self.bind(backend, "other", version="1")
+                other.set(key, "other")
+                self.assertEqual(self.bind(backend, "other", version="1").get(key), "other")
+
+    def test_eviction(self):
+        """
+        Сверх maxsize вытесняются давно не использованные значения
+        """
+        with tempfile.TemporaryDirectory() as catalog:
+            for backend in self.make_backends(catalog, maxsize=3):
+                bound = self.bind(backend, "func", version="1")
+                keys = [bound.make_key((i,), {}) for i in range(5)]
+                for key in keys[:3]:
+                    bound.set(key, key)
+                bound.get(keys[0])
+                bound.set(keys[3], keys[3])
+                bound.set(keys[4], keys[4])
+                name = type(backend).__name__
+                self.assertEqual(len(bound), 3, name)
+                self.assertEqual(bound.evictions, 2, name)
+                self.assertEqual(bound.get(keys[0]), keys[0], name)
+                self.assertIs(bound.get(keys[1]), MISSING, name)
+                self.assertIs(bound.get(keys[2]), MISSING, name)
+                restarted = self.bind(backend, "func", version="1")
+                self.assertEqual(len(restarted), 3, name)
+
+    def test_mmap_shared_file(self):
+        """
+        Два хранилища одного файла видят записи друг друга
+        и не затирают их, в том числе после уплотнения файла
+        """
+        with tempfile.TemporaryDirectory() as catalog:
+            backend = MmapBackend(catalog, max_bytes=4096)
+            first, second = self.bind(backend, "func", version="1"), self.bind(backend, "func", version="1")
+            first.set(b"1" * 32, "A")
+            second.set(b"2" * 32, "B")
+            self.assertEqual(first.get(b"1" * 32), "A")
+            self.assertEqual(first.get(b"2" * 32), "B")
+            second.delete(b"1" * 32)
+            self.assertIs(first.get(b"1" * 32), MISSING)
+            # Заполняем файл, что бы второе хранилище его уплотнило
+            for i in range(100):
+                second.set(b"%032d" % i, "x" * 50)
+            self.assertEqual(first.get(b"%032d" % 99), "x" * 50)
+            first.set(b"3" * 32, "C")
+            self.assertEqual(second.get(b"3" * 32), "C")
+            self.assertEqual(self.bind(backend, "func", version="1").get(b"3" * 32), "C")
+
+    def test_mmap_other_process(self):
+        """
+        Значение, записанное другим процессом, видно в уже открытом хранилище
+        """
+        with tempfile.TemporaryDirectory() as catalog:
+            backend = MmapBackend(catalog, max_bytes=64 * 1024)
+            bound = self.bind(backend, "func", version="1")
+            bound.set(b"1" * 32, "A")
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                size = executor.submit(set_in_process, backend, "func", "1", b"2" * 32, "B").result()
+            self.assertEqual(size, 2)
+            self.assertEqual(bound.get(b"2" * 32), "B")
+            self.assertEqual(bound.get(b"1" * 32), "A")
+
+    @unittest.skipUnless(os.path.isdir("/proc/self/fd"), "нужен /proc")
+    def test_close(self):
+        """
+        cache_close закрывает файлы хранилища, повторный вызов ничего не делает
+        """
+        with tempfile.TemporaryDirectory() as catalog:
+            backend = MmapBackend(catalog, max_bytes=64 * 1024)
+
+            @memo(backend=backend)
+            def double(x):
+                return x * 2
+
+            self.assertEqual(double(2), 4)
+            self.assertTrue(open_files(catalog))
+            double.cache_close()
+            self.assertEqual(open_files(catalog), [])
+            double.cache_close()
+            self.assertFalse(double.cache_close.alive)
+
+    def test_sqlite_hits_do_not_write(self):
+        """
+        Попадание не пишет в базу, время использования записывается перед вытеснением
+        """
+        with tempfile.TemporaryDirectory() as catalog:
+            path = f"{catalog}/memo.sqlite"
+            bound = SQLiteBackend(path, maxsize=2).bind("func", version="1")
+            bound.set(b"a", 1)
+            bound.set(b"b", 2)
+            changes = bound.connection.total_changes
+            self.assertEqual(bound.get(b"a"), 1)
+            self.assertEqual(bound.connection.total_changes, changes)
+            # "a" использован позже "b" - вытесняется "b"
+            bound.set(b"c", 3)
+            self.assertEqual(bound.get(b"a"), 1)
+            self.assertIs(bound.get(b"b"), MISSING)
+            bound.close()
+            restarted = SQLiteBackend(path, maxsize=2).bind("func", version="1")
+            restarted.set(b"d", 4)
+            self.assertIs(restarted.get(b"c"), MISSING)
+            self.assertEqual(restarted.get(b"a"), 1)
+            restarted.close()
+
+
+class MemoTests(unittest.TestCase):
+
+    def test_single_flight(self):
+        """
+        Одновременные вызовы с одним ключом ждут одного вычисления
+        """
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        @memo
+        def slow(x):
+            calls.append(x)
+            started.set()
+            release.wait(5)
+            return x * 2
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            first = executor.submit(slow, 21)
+            started.wait(5)
+            others = [executor.submit(slow, 21) for _ in range(3)]
+            time.sleep(0.05)
+            release.set()
+            results = [future.result(5) for future in [first] + others]
+        self.assertEqual(results, [42] * 4)
+        self.assertEqual(calls, [21])
+        self.assertEqual(slow.cache_info().misses, 1)
+        self.assertEqual(slow.cache_info().hits, 3)
+
+    def test_single_flight_exception(self):
+        """
+        Ожидающие вычисления получают его исключение
+        """
+        started, release = threading.Event(), threading.Event()
+
+        @memo
+        def slow(x):
+            started.set()
+            release.wait(5)
+            raise ValueError(x)
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            first = executor.submit(slow, 1)
+            started.wait(5)
+            others = [executor.submit(slow, 1) for _ in range(2)]
+            time.sleep(0.05)
+            release.set()
+            for future in [first] + others:
+                self.assertRaises(ValueError, future.result, 5)
+        self.assertEqual(slow.cache_info().currsize, 0)
+
+    def test_exception(self):
+        """
+        Исключение передается вызывающему и не кешируется
+        """
+        calls = []
+
+        @memo
+        def fail(x):
+            calls.append(x)
+            if len(calls) == 1:
+                raise ValueError(x)
+            return x
+
+        with self.assertRaises(ValueError):
+            fail(1)
+        self.assertEqual(fail(1), 1)
+        self.assertEqual(fail(1), 1)
+        self.assertEqual(calls, [1, 1])
+
+    def test_async(self):
+        """
+        Результат корутины кешируется, одновременные ожидающие делят одно вычисление
+        """
+        calls = []
+
+        @memo
+        async def double(x):
+            calls.append(x)
+            await asyncio.sleep(0.01)
+            return x * 2
+
+        async def run():
+            first = await asyncio.gather(*(double(1) for _ in range(5)))
+            return first + [await double(1), await double(2)]
+
+        self.assertEqual(asyncio.run(run()), [2] * 6 + [4])
+        self.assertEqual(calls, [1, 2])
+        self.assertTrue(asyncio.iscoroutinefunction(double))
+
+    def test_keys(self):
+        """
+        Именованные аргументы входят в ключ независимо от порядка, None кешируется
+        """
+        calls = []
+
+        @memo
+        def func(*args, **kwargs):
+            calls.append((args, kwargs))
+
+        self.assertIsNone(func(1, a=1, b=2))
+        self.assertIsNone(func(1, b=2, a=1))
+        self.assertIsNone(func(1))
+        self.assertIsNone(func(1, a=2, b=2))
+        self.assertIsNone(func(1))
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(func.cache_info().hits, 2)
+
+    def test_ttl(self):
+        """
+        Результат устаревает через ttl секунд и вычисляется заново
+        """
+        calls = []
+
+        @memo(ttl=10)
+        def func(x):
+            calls.append(x)
+            return x
+
+        with mock.patch("deco.time", return_value=1000.0):
+            func(1)
+            func(1)
+        with mock.patch("deco.time", return_value=1011.0):
+            func(1)
+            func(1)
+        self.assertEqual(calls, [1, 1])
+        info = func.cache_info()
+        self.assertEqual((info.hits, info.misses, info.evictions), (2, 2, 1))
+
+    def test_cache_info(self):
+        """
+        Статистика, вытеснение по maxsize и очистка кеша
+        """
+
+        @memo(maxsize=2)
+        def func(x):
+            return x
+
+        for x in [1, 2, 1, 3, 1, 2]:
+            func(x)
+        self.assertEqual(tuple(func.cache_info()), (2, 4, 2, 2, 2))
+        func.cache_clear()
+        self.assertEqual(tuple(func.cache_info()), (0, 0, 0, 2, 0))
+        func(1)
+        func(1)
+        self.assertEqual(tuple(func.cache_info()), (1, 1, 0, 2, 1))
+
+    def test_countcalls_threads(self):
+        """
+        Вызовы из нескольких потоков все учитываются
+        """
+
+        @countcalls
+        def func():
+            pass
+
+        def run():
+            for _ in range(10000):
+                func()
+
+        threads = [threading.Thread(target=run) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(func.calls.cnt, 40000)
+        self.assertEqual(str(func.calls), "40000")
+        func.calls += 5
+        self.assertEqual(func.calls.cnt, 40005)
+
+
+class NAryTests(unittest.TestCase):
+
+    def test_right_fold(self):
+        """
+        Аргументы сворачиваются справа: f(x, f(y, z))
+        """
+        sub = n_ary(lambda a, b: a - b)
+        self.assertEqual(sub(1, 2, 3, 4, 5), 1 - (2 - (3 - (4 - 5))))
+        self.assertEqual(sub(1, 2), -1)
+        pairs = n_ary(lambda a, b: (a, b))
+        self.assertEqual(pairs(1, 2, 3), (1, (2, 3)))
+
+    def test_single_argument(self):
+        """
+        f(x) = x, функция не вызывается
+        """
+        calls = []
+
+        @n_ary
+        def add(a, b):
+            calls.append((a, b))
+            return a + b
+
+        marker = object()
+        self.assertIs(add(marker), marker)
+        self.assertEqual(calls, [])
+
+    def test_many_arguments(self):
+        """
+        Миллион аргументов сворачивается без RecursionError
+        """
+        add = n_ary(lambda a, b: a + b)
+        self.assertEqual(add(*range(10 ** 6)), 499999500000)
+
+    def test_bulk(self):
+        """
+        bulk дает тот же результат, что и попарное сворачивание, и вызывается вместо него
+        """
+        calls = []
+
+        def add(a, b):
+            calls.append((a, b))
+            return a + b
+
+        pairwise, bulk = n_ary(add), n_ary(add, bulk=sum)
+        values = list(range(1, 1001))
+        self.assertEqual(bulk(*values), pairwise(*values))
+        self.assertEqual(len(calls), 999)
+        self.assertEqual(bulk(7), 7)
+        self.assertEqual(len(calls), 999)
+
+
+class ProfileTests(unittest.TestCase):
+
+    def test_calls(self):
+        """
+        Считаются все вызовы, замеряется каждый sample-й
+        """
+        registry = ProfileRegistry()
+        func = profile(lambda: None, sample=10, registry=registry, name="func")
+        for _ in range(95):
+            func()
+        stats = registry.to_dict()["func"]
+        self.assertEqual(stats["calls"], 95)
+        self.assertIn(stats["sampled"], (9, 10))
+
+    def test_nested(self):
+        """
+        Собственное время вызывающего не включает замеренные вызовы внутри него
+        """
+        registry = ProfileRegistry()
+
+        @profile(registry=registry, name="inner")
+        def inner():
+            time.sleep(0.02)
+
+        @profile(registry=registry, name="outer")
+        def outer():
+            inner()
+            inner()
+
+        outer()
+        stats = registry.to_dict()
+        self.assertEqual(stats["inner"]["calls"], 2)
+        self.assertGreaterEqual(stats["outer"]["wall_ns"], stats["inner"]["wall_ns"])
+        self.assertLess(stats["outer"]["self_wall_ns"], 20_000_000)
+        self.assertEqual(registry.collapsed().splitlines()[0].split()[0], "outer")
+
+    def test_async_gather(self):
+        """
+        Параллельные замеренные задачи не делают собственное время вызывающего отрицательным,
+        CPU время корутин не замеряется
+        """
+        registry = ProfileRegistry()
+
+        @profile(registry=registry, name="child")
+        async def child():
+            await asyncio.sleep(0.02)
+
+        @profile(registry=registry, name="parent")
+        async def parent():
+            await asyncio.gather(*(child() for _ in range(5)))
+            await child()
+
+        asyncio.run(parent())
+        stats = registry.to_dict()
+        self.assertEqual(stats["child"]["calls"], 6)
+        self.assertGreaterEqual(stats["parent"]["self_wall_ns"], 0)
+        # Из собственного времени вычитается только последовательно ожидаемый child
+        self.assertGreaterEqual(stats["parent"]["self_wall_ns"], 15_000_000)
+        self.assertEqual(stats["parent"]["cpu_ns"], 0)
+        self.assertEqual(stats["child"]["self_cpu_ns"], 0)
+
+    def test_clear(self):
+        """
+        После очистки реестра вызовы уже украшенных функций снова учитываются
+        """
+        registry = ProfileRegistry()
+        func = profile(lambda: None, registry=registry, name="func")
+        func()
+        registry.clear()
+        self.assertEqual(registry.to_dict()["func"]["calls"], 0)
+        self.assertEqual(registry.collapsed(), "")
+        func()
+        func()
+        stats = registry.to_dict()["func"]
+        self.assertEqual((stats["calls"], stats["sampled"]), (2, 2))
+        self.assertEqual(registry.collapsed().split()[0], "func")
+
+    def test_clear_during_call(self):
+        """
+        Очистка реестра внутри замеряемого вызова не ломает его учет
+        """
+        registry = ProfileRegistry()
+
+        @profile(registry=registry, name="inner")
+        def inner():
+            registry.clear()
+
+        @profile(registry=registry, name="outer")
+        def outer():
+            inner()
+
+        outer()
+        outer()
+        stacks = [line.split()[0] for line in registry.collapsed().splitlines()]
+        self.assertEqual(stacks, ["outer", "outer;inner"])
+        # Вызов считается при входе - до очистки, а замер учитывается при выходе
+        self.assertEqual(registry.to_dict()["outer"]["sampled"], 1)
+        self.assertEqual(registry.to_dict()["inner"]["sampled"], 1)
+
+    def test_sample(self):
+        """
+        sample меньше 1 отвергается при украшении
+        """
+        with self.assertRaises(ValueError):
+            profile(lambda: None, sample=0)
+        with self.assertRaises(ValueError):
+            profile(sample=-1)(lambda: None)
+
+
+class BenchmarkTests(unittest.TestCase):
+
+    def test_find_regressions(self):
+        """
+        Бюджет проверяется по стоимости относительно неукрашенного вызова того же замера,
+        а не по абсолютному времени: на машине вдвое медленнее регрессии нет
+        """
+        def result(plain: float, memo_hit: float) -> dict:
+            cases = {"plain": {"ns_per_call": plain},
+                     "memo_hit": {"ns_per_call": memo_hit, "baseline": "plain"}}
+            cases["memo_hit"]["relative"] = relative_cost(cases, "memo_hit")
+            return {"cases": cases}
+
+        limit = MAX_RELATIVE["memo_hit"]
+        self.assertEqual(find_regressions(result(100.0, 100.0 * limit)), {})
+        self.assertEqual(find_regressions(result(200.0, 200.0 * limit)), {})
+        self.assertEqual(find_regressions(result(100.0, 150.0 * limit)), {"memo_hit": 1.5 * limit})
+        self.assertEqual(find_regressions(result(100.0, 150.0 * limit), tolerance=2), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,605 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Потоковая агрегация статистики по URL
+
+Вместо списка всех времен запросов для каждого URL хранится
+компактная запись: количество, сумма, максимум и скетч квантилей.
+Время хранится в целых микросекундах, поэтому суммы не зависят
+от порядка сложения и агрегаты можно объединять в любом порядке
+"""
+import gzip
+import heapq
+import json
+import math
+import os
+import shutil
+import tempfile
+import weakref
+from array import array
+from bisect import bisect_left
+from operator import itemgetter
+from pathlib import Path
+from typing import Callable, Iterable, Iterator
+
+from instrumentation import RunStats, anonymous_rss
+
+# Множитель перевода секунд в микросекунды
+MICROSECONDS = 1_000_000
+# Версия формата файла с агрегатами
+AGGREGATE_FORMAT_VERSION = 2
+# URL, в который сворачиваются редкие URL при превышении лимита
+OVERFLOW_URL = "__other__"
+# Относительная точность скетча квантилей
+SKETCH_RELATIVE_ACCURACY = 0.01
+# Количество серий на диске, после которого они сливаются в одну
+MAX_SPILL_RUNS = 64
+# Минимальное количество URL в памяти между сбросами на диск
+MIN_SPILL_URLS = 1_000
+# Доля URL (от количества при первом превышении бюджета памяти),
+# при которой агрегат сбрасывается на диск
+SPILL_HEADROOM = 0.8
+# Во сколько раз количество URL в памяти может превышать лимит отчета (MAX_URLS)
+# до сброса на диск
+URL_SPILL_FACTOR = 4
+
+
+def to_microseconds(seconds: float) -> int:
+    """Переводит время из секунд в целые микросекунды"""
+    return round(seconds * MICROSECONDS)
+
+
+def to_seconds(microseconds: int | float) -> float:
+    """Переводит время из микросекунд в секунды"""
+    return microseconds / MICROSECONDS
+
+
+class QuantileSketch:
+    """
+    Объединяемый скетч квантилей с логарифмическими корзинами (DDSketch)
+
+    Значение v попадает в корзину ceil(log(v) / log(gamma)),
+    оценка квантиля отличается от истинной не более чем
+    на SKETCH_RELATIVE_ACCURACY. Память зависит от разброса значений,
+    а не от их количества
+    """
+    __slots__ = ("bins", "zero_count")
+
+    gamma = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+    log_gamma = math.log(gamma)
+
+    def __init__(self):
+        self.bins: dict[int, int] = {}
+        self.zero_count = 0
+
+    def add(self, value: int):
+        """Добавляет значение (в микросекундах)"""
+        if value <= 0:
+            self.zero_count += 1
+            return
+        index = math.ceil(math.log(value) / self.log_gamma)
+        self.bins[index] = self.bins.get(index, 0) + 1
+
+    def merge(self, other: "QuantileSketch"):
+        """Добавляет к скетчу данные другого скетча"""
+        self.zero_count += other.zero_count
+        bins = self.bins
+        for index, count in other.bins.items():
+            bins[index] = bins.get(index, 0) + count
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля q (0 <= q <= 1) в микросекундах"""
+        return self.quantiles([q])[0]
+
+    def quantiles(self, qs: list[float]) -> list[float]:
+        """Оценки нескольких квантилей за один проход по корзинам"""
+        count = self.zero_count + sum(self.bins.values())
+        if not count:
+            return [0.0] * len(qs)
+        # Квантили считаются по возрастанию, результат - в порядке qs
+        order = sorted(range(len(qs)), key=lambda i: qs[i])
+        result = [0.0] * len(qs)
+        indexes = sorted(self.bins)
+        position = 0
+        seen = self.zero_count
+        for i in order:
+            rank = qs[i] * (count - 1)
+            if rank < self.zero_count:
+                continue
+            while position < len(indexes) - 1 and rank >= seen + self.bins[indexes[position]]:
+                seen += self.bins[indexes[position]]
+                position += 1
+            result[i] = 2 * self.gamma ** indexes[position] / (self.gamma + 1)
+        return result
+
+    def get_state(self) -> list:
+        """Состояние скетча в виде простых типов (для сериализации)"""
+        return [self.zero_count, sorted(self.bins.items())]
+
+    @classmethod
+    def from_state(cls, state: list) -> "QuantileSketch":
+        """Восстанавливает скетч из состояния"""
+        sketch = cls()
+        zero_count, bins = state
+        sketch.zero_count = zero_count
+        sketch.bins = {index: count for index, count in bins}
+        return sketch
+
+
+class ExactQuantiles:
+    """
+    Точные квантили: хранит все значения в компактном массиве.
+    Память пропорциональна количеству запросов
+    """
+    __slots__ = ("values",)
+
+    def __init__(self):
+        self.values = array("q")
+
+    def add(self, value: int):
+        """Добавляет значение (в микросекундах)"""
+        self.values.append(value)
+
+    def merge(self, other: "ExactQuantiles"):
+        """Добавляет к набору значения другого набора"""
+        self.values.extend(other.values)
+
+    def quantile(self, q: float) -> float:
+        """Квантиль q (0 <= q <= 1) с линейной интерполяцией в микросекундах"""
+        return self.quantiles([q])[0]
+
+    def quantiles(self, qs: list[float]) -> list[float]:
+        """Несколько квантилей по одной сортировке значений"""
+        if not self.values:
+            return [0.0] * len(qs)
+        values = sorted(self.values)
+        result = []
+        for q in qs:
+            position = q * (len(values) - 1)
+            low = math.floor(position)
+            high = math.ceil(position)
+            if low == high:
+                result.append(float(values[low]))
+            else:
+                result.append(values[low] + (values[high] - values[low]) * (position - low))
+        return result
+
+    def get_state(self) -> list:
+        """Состояние в виде простых типов (для сериализации)"""
+        return self.values.tolist()
+
+    @classmethod
+    def from_state(cls, state: list) -> "ExactQuantiles":
+        """Восстанавливает набор значений из состояния"""
+        quantiles = cls()
+        quantiles.values = array("q", state)
+        return quantiles
+
+
+class UrlStat:
+    """
+    Компактная запись статистики по одному URL.
+    bounds - границы корзин гистограммы времени (в микросекундах,
+    по возрастанию): корзина i считает запросы со временем <= bounds[i],
+    последняя - запросы дольше bounds[-1]
+    """
+    __slots__ = ("count", "time_sum", "time_max", "quantiles", "bounds", "histogram")
+
+    def __init__(self, exact: bool = False, bounds: tuple[int, ...] = ()):
+        self.count = 0
+        self.time_sum = 0
+        self.time_max = 0
+        self.quantiles = ExactQuantiles() if exact else QuantileSketch()
+        self.bounds = bounds
+        self.histogram = [0] * (len(bounds) + 1) if bounds else None
+
+    def add(self, time: int):
+        """Учитывает один запрос (время в микросекундах)"""
+        self.count += 1
+        self.time_sum += time
+        if time > self.time_max:
+            self.time_max = time
+        self.quantiles.add(time)
+        if self.histogram is not None:
+            self.histogram[bisect_left(self.bounds, time)] += 1
+
+    def merge(self, other: "UrlStat"):
+        """
+        Добавляет статистику другой записи.
+        Гистограммы с разными корзинами не объединяются
+        """
+        if other.bounds != self.bounds:
+            raise ValueError(f"Нельзя объединить гистограммы с разными корзинами: {self.bounds}/{other.bounds}")
+        self.count += other.count
+        self.time_sum += other.time_sum
+        if other.time_max > self.time_max:
+            self.time_max = other.time_max
+        self.quantiles.merge(other.quantiles)
+        if other.histogram is not None:
+            # Отсутствующая гистограмма - пустая
+            if self.histogram is None:
+                self.histogram = list(other.histogram)
+            else:
+                self.histogram = [count + other_count
+                                  for count, other_count in zip(self.histogram, other.histogram)]
+
+    def median(self) -> float:
+        """Медиана времени запроса в микросекундах"""
+        return self.quantiles.quantile(0.5)
+
+    def get_state(self) -> list:
+        """Состояние записи в виде простых типов (для сериализации)"""
+        return [self.count, self.time_sum, self.time_max, self.quantiles.get_state(), self.histogram]
+
+    @classmethod
+    def from_state(cls, state: list, exact: bool = False, bounds: tuple[int, ...] = ()) -> "UrlStat":
+        """Восстанавливает запись из состояния"""
+        url_stat = cls.__new__(cls)
+        url_stat.count, url_stat.time_sum, url_stat.time_max, quantiles, url_stat.histogram = state
+        quantiles_cls = ExactQuantiles if exact else QuantileSketch
+        url_stat.quantiles = quantiles_cls.from_state(quantiles)
+        url_stat.bounds = bounds
+        return url_stat
+
+
+class LogAggregate:
+    """
+    Агрегированные данные лога: статистика по каждому URL
+    и общее количество строк.
+    normalizer - функция приведения URL к шаблону,
+    max_urls - лимит количества URL в отчете (0 - без лимита): самые редкие URL
+    сворачиваются в OVERFLOW_URL вызовом fold_rare_urls у итогового агрегата,
+    histogram_bounds - границы корзин гистограммы времени запросов в секундах.
+    Часть URL может быть сброшена на диск (spill) в серии, отсортированные по URL:
+    тогда полная статистика по URL доступна через items()
+    """
+    __slots__ = ("urls", "total_rows", "exact", "max_urls", "normalizer", "histogram_bounds", "bounds",
+                 "runs", "spilled_time_sum", "finalizer", "__weakref__")
+
+    def __init__(self, exact: bool = False, max_urls: int = 0,
+                 normalizer: Callable[[str], str] = None, histogram_bounds: tuple[float, ...] = ()):
+        self.urls: dict[str, UrlStat] = {}
+        self.total_rows = 0
+        self.exact = exact
+        self.max_urls = max_urls
+        self.normalizer = normalizer
+        self.histogram_bounds = tuple(sorted(histogram_bounds))
+        self.bounds = tuple(to_microseconds(bound) for bound in self.histogram_bounds)
+        self.runs: list[str] = []
+        self.spilled_time_sum = 0
+        self.finalizer = None
+
+    def add(self, url: str, time: float):
+        """Учитывает запрос к url со временем time (в секундах)"""
+        if self.normalizer is not None:
+            url = self.normalizer(url)
+        url_stat = self.urls.get(url)
+        if url_stat is None:
+            url_stat = self._new_url_stat(url)
+        url_stat.add(to_microseconds(time))
+
+    def merge(self, other: "LogAggregate", keep_runs: bool = False):
+        """
+        Добавляет данные другого агрегата.
+        Объединение ассоциативно, поэтому агрегаты можно объединять
+        в любой группировке (по процессам, дням, хостам).
+        keep_runs - оставить серии другому агрегату, этот получает их жесткие ссылки
+        """
+        if other.exact != self.exact or other.histogram_bounds != self.histogram_bounds:
+            raise ValueError("Нельзя объединить агрегаты с разными параметрами: "
+                             f"exact {self.exact}/{other.exact}, "
+                             f"гистограмма {self.histogram_bounds}/{other.histogram_bounds}")
+        self.total_rows += other.total_rows
+        if other.runs and keep_runs:
+            self._own_runs([link_run(path) for path in other.runs])
+            self.spilled_time_sum += other.spilled_time_sum
+        elif other.runs:
+            # Серии другого агрегата переходят к этому без чтения с диска
+            self._own_runs(other.runs)
+            other.runs.clear()
+            self.spilled_time_sum += other.spilled_time_sum
+            other.spilled_time_sum = 0
+        urls = self.urls
+        for url, other_stat in other.urls.items():
+            url_stat = urls.get(url)
+            if url_stat is None:
+                url_stat = self._new_url_stat(url)
+            url_stat.merge(other_stat)
+
+    def _new_url_stat(self, url: str) -> UrlStat:
+        """Заводит запись для нового URL"""
+        url_stat = self.urls[url] = UrlStat(exact=self.exact, bounds=self.bounds)
+        return url_stat
+
+    def fold_rare_urls(self):
+        """
+        Оставляет max_urls - 1 самых частых URL (при равном количестве -
+        с меньшим URL), статистика остальных переносится в OVERFLOW_URL.
+        Сворачивается только итоговый агрегат: частичные агрегаты
+        не сворачиваются, поэтому результат не зависит от порядка
+        и группировки их объединения. Серии на диске читаются
+        два раза, результат целиком помещается в памяти
+        """
+        if not self.max_urls:
+            return
+        distinct = 0
+
+        def counts():
+            nonlocal distinct
+            for url, url_stat in self.items():
+                distinct += 1
+                if url != OVERFLOW_URL:
+                    yield -url_stat.count, url
+
+        kept = {url for _, url in heapq.nsmallest(self.max_urls - 1, counts())}
+        if distinct <= self.max_urls:
+            return
+        urls, overflow = {}, UrlStat(exact=self.exact, bounds=self.bounds)
+        for url, url_stat in self.items():
+            if url in kept:
+                urls[url] = url_stat
+            else:
+                overflow.merge(url_stat)
+        urls[OVERFLOW_URL] = overflow
+        self.urls = urls
+        remove_runs(self.runs)
+        self.runs.clear()
+        self.spilled_time_sum = 0
+
+    def get_state(self, urls: bool = True) -> dict:
+        """
+        Состояние агрегата в виде простых типов (для сериализации),
+        включая URL, сброшенные на диск. urls=False - без списка URL
+        (его можно получить потоком из items())
+        """
+        state = {"exact": self.exact,
+                 "histogram_bounds": list(self.histogram_bounds),
+                 "total_rows": self.total_rows,
+                 "urls": []}
+        if urls:
+            state["urls"] = [[url, url_stat.get_state()] for url, url_stat in self.items()]
+        return state
+
+    @classmethod
+    def from_state(cls, state: dict) -> "LogAggregate":
+        """Восстанавливает агрегат из состояния"""
+        exact = state["exact"]
+        log_data = cls(exact=exact, histogram_bounds=state["histogram_bounds"])
+        log_data.total_rows = state["total_rows"]
+        log_data.urls = {url: UrlStat.from_state(url_stat, exact=exact, bounds=log_data.bounds)
+                         for url, url_stat in state["urls"]}
+        return log_data
+
+    def time_sum(self) -> int:
+        """Суммарное время всех запросов в микросекундах"""
+        return sum(url_stat.time_sum for url_stat in self.urls.values()) + self.spilled_time_sum
+
+    def items(self) -> Iterator[tuple[str, UrlStat]]:
+        """
+        Пары (URL, статистика) по всем URL.
+        Если часть URL сброшена на диск, серии и URL в памяти
+        сливаются (k-way merge) в порядке URL, в памяти одновременно
+        находится только одна запись каждой серии
+        """
+        if not self.runs:
+            return iter(self.urls.items())
+        return self._merge_streams([self._read_run(path) for path in self.runs] +
+                                   [((url, self.urls[url]) for url in sorted(self.urls))])
+
+    def spill(self, directory: str = None, max_runs: int = MAX_SPILL_RUNS):
+        """
+        Сбрасывает URL из памяти на диск отсортированной серией.
+        Когда серий становится max_runs, они сливаются в одну,
+        что бы слияние не упиралось в лимит открытых файлов
+        """
+        if not self.urls:
+            return
+        self.spilled_time_sum += sum(url_stat.time_sum for url_stat in self.urls.values())
+        urls = self.urls
+        # Сортируются только ключи, без списка пар (URL, запись)
+        self._own_runs([self._write_run(((url, urls[url]) for url in sorted(urls)), directory)])
+        # Новый словарь, что бы память старого освободилась целиком
+        self.urls = {}
+        if len(self.runs) >= max_runs:
+            runs = list(self.runs)
+            merged = self._write_run(self._merge_streams([self._read_run(path) for path in runs]), directory)
+            self.runs[:] = [merged]
+            remove_runs(runs)
+
+    def _own_runs(self, paths: list[str]):
+        """Добавляет серии, файлы которых удаляются вместе с агрегатом"""
+        if self.finalizer is None:
+            self.finalizer = weakref.finalize(self, remove_runs, self.runs)
+        self.runs.extend(paths)
+
+    def release_runs(self):
+        """
+        Отказывается от удаления файлов серий вместе с агрегатом:
+        агрегат процесса пула передается в основной процесс,
+        и серии удаляет уже его копия
+        """
+        if self.finalizer is not None:
+            self.finalizer.detach()
+            self.finalizer = None
+
+    def __getstate__(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__ if name not in ("finalizer", "__weakref__")}
+
+    def __setstate__(self, state: dict):
+        for name, value in state.items():
+            setattr(self, name, value)
+        self.finalizer = None
+        if self.runs:
+            self.finalizer = weakref.finalize(self, remove_runs, self.runs)
+
+    def _write_run(self, items: Iterator[tuple[str, UrlStat]], directory: str = None) -> str:
+        """Записывает отсортированные по URL пары в файл серии (строка - JSON [url, состояние])"""
+        descriptor, path = tempfile.mkstemp(prefix="log-analyzer-", suffix=".run", dir=directory)
+        with open(descriptor, "w", encoding="UTF-8") as run:
+            for url, url_stat in items:
+                run.write(json.dumps([url, url_stat.get_state()], ensure_ascii=False, separators=(",", ":")))
+                run.write("\n")
+        return path
+
+    def _read_run(self, path: str) -> Iterator[tuple[str, UrlStat]]:
+        """Генератор пар (URL, статистика) из файла серии"""
+        with open(path, encoding="UTF-8") as run:
+            for line in run:
+                url, state = json.loads(line)
+                yield url, UrlStat.from_state(state, exact=self.exact, bounds=self.bounds)
+
+    def _merge_streams(self, streams: list[Iterator[tuple[str, UrlStat]]]) -> Iterator[tuple[str, UrlStat]]:
+        """Сливает отсортированные по URL потоки, объединяя записи одного URL"""
+        current_url, current = None, None
+        for url, url_stat in heapq.merge(*streams, key=itemgetter(0)):
+            if current is not None and url == current_url:
+                current.merge(url_stat)
+                continue
+            if current is not None:
+                yield current_url, current
+            # Новая запись, что бы не менять записи агрегата, лежащие в памяти
+            current_url, current = url, UrlStat(exact=self.exact, bounds=self.bounds)
+            current.merge(url_stat)
+        if current is not None:
+            yield current_url, current
+
+    def __len__(self):
+        """Количество различных URL, с сериями на диске - после их слияния"""
+        if not self.runs:
+            return len(self.urls)
+        return sum(1 for _ in self.items())
+
+
+def merge_log_data(logs_data: Iterable[LogAggregate], **aggregate_options) -> LogAggregate:
+    """
+    Объединяет агрегаты нескольких логов в один
+    """
+    log_data = LogAggregate(**aggregate_options)
+    for day_data in logs_data:
+        log_data.merge(day_data)
+    return log_data
+
+
+def remove_runs(paths: list[str]):
+    """Удаляет файлы серий"""
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def link_run(path: str) -> str:
+    """
+    Возвращает новое имя файла серии рядом с исходным: жесткую ссылку
+    или копию, если файловая система ссылки не поддерживает
+    """
+    descriptor, new_path = tempfile.mkstemp(prefix="log-analyzer-", suffix=".run", dir=os.path.dirname(path))
+    os.close(descriptor)
+    os.remove(new_path)
+    try:
+        os.link(path, new_path)
+    except OSError:
+        shutil.copyfile(path, new_path)
+    return new_path
+
+
+class MemoryBudget:
+    """
+    Бюджет памяти агрегации: limit байт анонимной памяти процесса
+    (RSS без страниц отображенных файлов) сверх базовой, занятой
+    до начала разбора (интерпретатор, модули). Базовая память
+    измеряется при создании бюджета, у долей бюджета (split) -
+    при первой проверке в процессе пула.
+    При первом превышении бюджета количество URL в памяти
+    (с запасом SPILL_HEADROOM) становится порогом сброса на диск,
+    дальше агрегат сбрасывается при достижении порога: освобожденная
+    память переиспользуется интерпретатором, поэтому RSS
+    после этого не растет, хотя ОС он возвращается не сразу.
+    url_limit - порог сброса, действующий с начала разбора
+    (None - только по памяти), limit None - без проверки памяти
+    """
+
+    def __init__(self, limit: int | None, directory: str = None, min_urls: int = MIN_SPILL_URLS,
+                 max_runs: int = MAX_SPILL_RUNS, url_limit: int = None):
+        self.limit = limit
+        self.directory = directory or None
+        self.min_urls = min_urls
+        self.max_runs = max_runs
+        self.url_limit = url_limit
+        self.max_urls = None
+        self.baseline = None if limit is None else anonymous_rss()
+
+    def split(self, parts: int, baseline: int = None) -> "MemoryBudget":
+        """
+        Доля бюджета для одного из parts процессов, разбирающих лог одновременно.
+        baseline - базовая память процесса, None - измерить при первой проверке
+        """
+        budget = MemoryBudget(limit=None if self.limit is None else self.limit // parts,
+                              directory=self.directory, min_urls=self.min_urls, max_runs=self.max_runs,
+                              url_limit=None if self.url_limit is None else max(1, self.url_limit // parts))
+        budget.baseline = baseline
+        return budget
+
+    @property
+    def spill_urls(self) -> int | None:
+        """Порог сброса на диск: количество URL в памяти (None - пока не действует)"""
+        thresholds = [urls for urls in (self.max_urls, self.url_limit) if urls is not None]
+        return min(thresholds) if thresholds else None
+
+    def check(self, log_data: LogAggregate, run_stats: RunStats = None) -> bool:
+        """Сбрасывает URL агрегата на диск, если бюджет исчерпан"""
+        if self.limit is not None and self.max_urls is None:
+            rss = anonymous_rss()
+            if self.baseline is None:
+                self.baseline = rss
+            if rss - self.baseline > self.limit:
+                self.max_urls = max(self.min_urls, int(len(log_data.urls) * SPILL_HEADROOM))
+        spill_urls = self.spill_urls
+        if spill_urls is None or len(log_data.urls) < spill_urls:
+            return False
+        run_stats = RunStats() if run_stats is None else run_stats
+        with run_stats.stage("spill"):
+            log_data.spill(self.directory, max_runs=self.max_runs)
+        run_stats.spilled_runs += 1
+        return True
+
+
+def write_aggregate(path: str | Path, log_data: LogAggregate, meta: dict):
+    """
+    Сохраняет агрегат в сжатый файл, включая URL, сброшенные на диск.
+    meta - произвольные данные о происхождении агрегата (лог, отпечаток файла).
+    Файл сначала пишется во временный и затем переименовывается,
+    поэтому прерванная запись не оставляет битый файл
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.tmp{os.getpid()}")
+    document = {"version": AGGREGATE_FORMAT_VERSION, "meta": meta, "data": log_data.get_state(urls=False)}
+    header = json.dumps(document, ensure_ascii=False, separators=(",", ":"))
+    # Список URL - последнее поле документа: он пишется потоком из items() между "[" и "]}}",
+    # поэтому URL, сброшенные на диск, не собираются в памяти
+    opening, closing = header[:-len("]}}")], header[-len("]}}"):]
+    with gzip.open(tmp_path, "wt", encoding="UTF-8", compresslevel=6) as file:
+        file.write(opening)
+        for i, (url, url_stat) in enumerate(log_data.items()):
+            if i:
+                file.write(",")
+            file.write(json.dumps([url, url_stat.get_state()], ensure_ascii=False, separators=(",", ":")))
+        file.write(closing)
+    os.replace(tmp_path, path)
+
+
+def read_aggregate(path: str | Path) -> tuple[dict, LogAggregate] | None:
+    """
+    Читает агрегат из файла.
+    Возвращает (meta, агрегат) или None, если файла нет или его формат устарел
+    """
+    try:
+        with gzip.open(path, "rt", encoding="UTF-8") as file:
+            document = json.load(file)
+    except (OSError, EOFError, ValueError):
+        return None
+    if document.get("version") != AGGREGATE_FORMAT_VERSION:
+        return None
+    return document["meta"], LogAggregate.from_state(document["data"])
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Замер скорости работы анализатора логов
+
+Генерирует синтетический лог в формате ui_short и замеряет по отдельности
+этапы find_last_log, read_lines, gather_log_data, prepare_stat_table
+и write_html_report, а также разбор строк быстрым парсером и регулярками
+(ускорение записывается в speedup этапа parse_rows_fast). При --workers > 1
+разбор замеряется еще и в одном процессе, ускорение параллельного
+(для gz - конвейерного) разбора записывается в speedup этапа gather_log_data.
+Результат (строк/с, МБ/с, текущий RSS на границах этапов и пиковый RSS
+всего процесса) выводится в формате JSON и может сравниваться
+с сохраненным ранее результатом.
+
+Запуск:
+    python benchmark.py --rows 1000000 --urls 10000 --output result.json
+    python benchmark.py --rows 1000000 --gzip --baseline result.json
+    python benchmark.py --rows 1000000 --gzip --workers 4
+"""
+import argparse
+import gzip
+import json
+import random
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+from time import perf_counter
+
+import log_analyzer
+from instrumentation import current_rss, peak_rss
+from log_analyzer import find_last_log
+from parsing import (read_lines, gather_log_data, get_aggregate_options, iter_log_batches, parse_row_fast,
+                     parse_row_fallback)
+from stat_table import prepare_stat_table
+from writers import write_html_report
+
+LOG_ROW = ('{ip} -  - [29/Jun/2017:03:50:22 +0300] "{method} {url} HTTP/1.1" 200 927 "-" '
+           '"Lynx/2.8.8dev.9 libwww-FM/2.14" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" {time}\n')
+MALFORMED_ROW = '{ip} -  - [29/Jun/2017:03:50:22 +0300] "0" 400 166 "-" "-" "-" "-" "-" 0.000\n'
+BENCHMARK_DATE = datetime(2017, 6, 30)
+
+
+def generate_log(path: Path, rows: int, urls: int, malformed_ratio: float = 0.0, seed: int = 1):
+    """
+    Генерирует синтетический лог в формате ui_short.
+    Если имя файла оканчивается на .gz, лог сжимается
+    """
+    rnd = random.Random(seed)
+    opener = gzip.open if path.name.endswith(".gz") else open
+    with opener(path, "wt", encoding="UTF-8") as log:
+        for _ in range(rows):
+            ip = f"10.{rnd.randrange(256)}.{rnd.randrange(256)}.{rnd.randrange(256)}"
+            if rnd.random() < malformed_ratio:
+                log.write(MALFORMED_ROW.format(ip=ip))
+                continue
+            # Популярность URL распределена неравномерно, как в реальных логах
+            url_id = int(rnd.paretovariate(1.2)) % urls
+            method = "POST" if url_id % 10 == 0 else "GET"
+            time = rnd.expovariate(3)
+            log.write(LOG_ROW.format(ip=ip, method=method, url=f"/api/v2/banner/{url_id}",
+                                     time=f"{time:.3f}"))
+
+
+def measure(name: str, results: dict, func, rows: int = None, size: int = None, items: int = None):
+    """
+    Выполняет func и сохраняет в results время, скорость этапа и текущий RSS
+    процесса на его границах: rss_bytes - после этапа, rss_delta_bytes - прирост
+    за этап (без /proc - None).
+    rows - строк лога, size - байт лога, items - строк таблицы обработано за этап
+    """
+    rss_before = current_rss()
+    started = perf_counter()
+    result = func()
+    elapsed = max(perf_counter() - started, 1e-9)
+    rss_after = current_rss()
+    stage = {"seconds": round(elapsed, 6), "rss_bytes": rss_after,
+             "rss_delta_bytes": None if rss_after is None else rss_after - rss_before}
+    if rows is not None:
+        stage["lines_per_sec"] = round(rows / elapsed, 1)
+    if items is not None:
+        stage["items_per_sec"] = round(items / elapsed, 1)
+    if size is not None:
+        stage["mb_per_sec"] = round(size / 2 ** 20 / elapsed, 3)
+    results[name] = stage
+    return result
+
+
+def run_benchmark(rows: int, urls: int, malformed_ratio: float, use_gzip: bool,
+                  workers: int = 1) -> dict:
+    """
+    Замеряет этапы анализа синтетического лога
+    """
+    with tempfile.TemporaryDirectory() as catalog:
+        log_dir = Path(catalog) / "log"
+        report_dir = Path(catalog) / "reports"
+        log_dir.mkdir()
+        report_dir.mkdir()
+        # Прошлые логи, что бы поиск последнего лога был не тривиальным
+        for days in range(1, 31):
+            date = BENCHMARK_DATE - timedelta(days=days)
+            (log_dir / f"nginx-access-ui.log-{date:%Y%m%d}.gz").write_bytes(b"")
+        name = f"nginx-access-ui.log-{BENCHMARK_DATE:%Y%m%d}" + (".gz" if use_gzip else "")
+        generate_log(log_dir / name, rows=rows, urls=urls, malformed_ratio=malformed_ratio)
+        size = (log_dir / name).stat().st_size
+
+        config = dict(log_analyzer.config, LOG_DIR=str(log_dir), REPORT_DIR=str(report_dir))
+        stages = {}
+        last_log = measure("find_last_log", stages, lambda: find_last_log(config=config))
+        measure("read_lines", stages, lambda: sum(1 for _ in read_lines(last_log.path)),
+                rows=rows, size=size)
+        # Разбор строк быстрым парсером и регулярками на одних и тех же строках
+        log_rows = [row for batch in iter_log_batches(last_log.path) for row in batch]
+        measure("parse_rows_fast", stages, lambda: sum(1 for row in log_rows if parse_row_fast(row)),
+                rows=rows)
+        measure("parse_rows_regex", stages,
+                lambda: sum(1 for i, row in enumerate(log_rows) if parse_row_fallback(row, i)),
+                rows=rows)
+        stages["parse_rows_fast"]["speedup"] = round(
+            stages["parse_rows_regex"]["seconds"] / stages["parse_rows_fast"]["seconds"], 3)
+        del log_rows
+        log_data = measure("gather_log_data", stages,
+                           lambda: gather_log_data(last_log.path, workers=workers,
+                                                   **get_aggregate_options(config)),
+                           rows=rows, size=size)
+        if workers > 1:
+            # Тот же разбор в одном процессе, для сравнения с параллельным (конвейерным для gz)
+            measure("gather_log_data_serial", stages,
+                    lambda: gather_log_data(last_log.path, **get_aggregate_options(config)),
+                    rows=rows, size=size)
+            stages["gather_log_data"]["speedup"] = round(
+                stages["gather_log_data_serial"]["seconds"] / stages["gather_log_data"]["seconds"], 3)
+        report_size = config["REPORT_SIZE"]
+        percentiles = config["PERCENTILES"]
+        stat = measure("prepare_stat_table", stages,
+                       lambda: prepare_stat_table(log_data, report_size=report_size,
+                                                  percentiles=percentiles),
+                       items=len(log_data))
+        measure("write_html_report", stages,
+                lambda: write_html_report(stat=stat, config=config, last_log=last_log),
+                items=len(stat))
+    return {"params": {"rows": rows, "urls": urls, "malformed_ratio": malformed_ratio,
+                       "gzip": use_gzip, "workers": workers, "log_bytes": size,
+                       "python": sys.version.split()[0]},
+            "stages": stages,
+            # Пиковый RSS всего процесса, включая генерацию лога
+            "peak_rss_bytes": peak_rss()}
+
+
+def compare_with_baseline(result: dict, baseline: dict) -> dict:
+    """
+    Отношение времени этапов к сохраненному результату (> 1 - стало медленнее)
+    """
+    comparison = {}
+    for name, stage in result["stages"].items():
+        base_stage = baseline.get("stages", {}).get(name)
+        if base_stage and base_stage["seconds"]:
+            comparison[name] = round(stage["seconds"] / base_stage["seconds"], 3)
+    return comparison
+
+
+def parse_args() -> argparse.Namespace:
+    """Парсинг аргументов из командной строки"""
+    parser = argparse.ArgumentParser(description="Замер скорости работы log_analyzer")
+    parser.add_argument("--rows", type=int, default=200_000, help="Количество строк лога")
+    parser.add_argument("--urls", type=int, default=10_000, help="Количество уникальных URL")
+    parser.add_argument("--malformed", type=float, default=0.01, help="Доля битых строк")
+    parser.add_argument("--gzip", action="store_true", help="Сжимать лог")
+    parser.add_argument("--workers", type=int, default=1, help="Количество процессов разбора")
+    parser.add_argument("--output", help="Сохранить результат в JSON файл")
+    parser.add_argument("--baseline", help="JSON файл с результатом для сравнения")
+    parser.add_argument("--max-slowdown", type=float,
+                        help="Завершиться с ошибкой, если этап медленнее baseline в N раз")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    result = run_benchmark(rows=args.rows, urls=args.urls, malformed_ratio=args.malformed,
+                           use_gzip=args.gzip, workers=args.workers)
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, encoding="UTF-8") as file:
+            baseline = json.load(file)
+        result["baseline_ratio"] = compare_with_baseline(result, baseline)
+        if args.max_slowdown is not None:
+            slow = {name: ratio for name, ratio in result["baseline_ratio"].items()
+                    if ratio > args.max_slowdown}
+            if slow:
+                result["regressions"] = slow
+                exit_code = 1
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    print(output)
+    if args.output:
+        Path(args.output).write_text(output, encoding="UTF-8")
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
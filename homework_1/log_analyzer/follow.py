@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Слежение за живым логом (режим --follow)
+
+Новые строки лога копятся в корзинах по FOLLOW_INTERVAL секунд,
+по корзинам окон FOLLOW_WINDOWS периодически строятся отчеты
+"""
+import json
+import logging
+import os
+import time
+from collections import deque
+from functools import partial
+from pathlib import Path
+from typing import IO
+
+from aggregation import LogAggregate, merge_log_data
+from parsing import gather_batch, get_aggregate_options, split_batches
+from stat_table import prepare_stat_table
+from writers import write_html_report
+
+# Размер блока чтения живого лога в режиме --follow
+FOLLOW_BLOCK_SIZE = 2 ** 20
+
+
+class LogFollower:
+    """
+    Слежение за живым логом (режим --follow).
+    Читает только новые строки лога, начиная с сохраненного смещения,
+    переживает ротацию (смена inode) и обрезку файла.
+    Статистика копится в корзинах по FOLLOW_INTERVAL секунд,
+    раз в FOLLOW_INTERVAL секунд по корзинам каждого окна из FOLLOW_WINDOWS
+    строится отчет report-live-<окно>s.html
+    """
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.path = config.get("LIVE_LOG") or str(Path(config.get("LOG_DIR", "..")) / "nginx-access-ui.log")
+        self.aggregate_options = get_aggregate_options(config)
+        self.log: IO[bytes] = None
+        self.inode: int = None
+        self.offset = 0
+        # Корзины статистики: (начало интервала, агрегат)
+        self.buckets: deque[tuple[float, LogAggregate]] = deque()
+
+    @property
+    def state_path(self) -> Path:
+        """Файл с inode и смещением прочитанной части лога"""
+        return Path(self.config.get("FOLLOW_STATE")
+                    or Path(self.config.get("CACHE_DIR") or ".") / "follow-state.json")
+
+    @property
+    def interval(self) -> float:
+        """Длина интервала корзины и период обновления отчетов в секундах"""
+        return self.config.get("FOLLOW_INTERVAL", 60)
+
+    @property
+    def windows(self) -> list[int]:
+        """Окна статистики в секундах по возрастанию"""
+        return sorted(self.config.get("FOLLOW_WINDOWS", [300]))
+
+    def load_state(self) -> dict | None:
+        """Читает сохраненные inode и смещение"""
+        try:
+            return json.loads(self.state_path.read_text(encoding="UTF-8"))
+        except (OSError, ValueError):
+            return None
+
+    def save_state(self):
+        """Сохраняет inode и смещение прочитанной части лога"""
+        if self.inode is None:
+            return
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.state_path.with_name(f"{self.state_path.name}.tmp")
+        tmp_path.write_text(json.dumps({"path": self.path, "inode": self.inode, "offset": self.offset}),
+                            encoding="UTF-8")
+        os.replace(tmp_path, self.state_path)
+
+    def open_log(self, from_start: bool = False) -> bool:
+        """
+        Открывает живой лог. Продолжает с сохраненного смещения, если это
+        тот же файл; без сохраненного состояния начинает с конца файла
+        """
+        try:
+            log = open(self.path, "rb")
+        except FileNotFoundError:
+            return False
+        file_stat = os.fstat(log.fileno())
+        state = None if from_start else self.load_state()
+        if from_start:
+            offset = 0
+        elif state is None:
+            offset = file_stat.st_size
+        elif state.get("inode") == file_stat.st_ino and state.get("offset", 0) <= file_stat.st_size:
+            offset = state["offset"]
+        else:
+            # Лог сменился, пока анализатор не работал
+            offset = 0
+        self.log, self.inode, self.offset = log, file_stat.st_ino, offset
+        return True
+
+    def read_new_rows(self, now: float) -> int:
+        """
+        Разбирает строки, дописанные после смещения.
+        Неполная последняя строка остается до следующего чтения
+        """
+        self.log.seek(self.offset)
+        rows = 0
+        for batch in split_batches(iter(partial(self.log.read, FOLLOW_BLOCK_SIZE), b"")):
+            if not batch.endswith(b"\n"):
+                # Строка еще дописывается
+                break
+            partial_data, _ = gather_batch(batch, **self.aggregate_options)
+            self.current_bucket(now).merge(partial_data)
+            rows += partial_data.total_rows
+            self.offset += len(batch)
+        return rows
+
+    def poll(self, now: float = None) -> int:
+        """
+        Читает новые строки с учетом ротации и обрезки лога.
+        Возвращает количество прочитанных строк
+        """
+        now = time.time() if now is None else now
+        if self.log is None and not self.open_log():
+            return 0
+        rows = self.read_new_rows(now)
+        try:
+            file_stat = os.stat(self.path)
+        except FileNotFoundError:
+            # Лог переименован, новый еще не создан
+            file_stat = None
+        if file_stat is not None and file_stat.st_ino != self.inode:
+            # Ротация: старый файл дочитан, переходим на новый
+            self.log.close()
+            self.log = None
+            if self.open_log(from_start=True):
+                rows += self.read_new_rows(now)
+        elif file_stat is not None and file_stat.st_size < self.offset:
+            # Файл обрезан
+            self.offset = 0
+            rows += self.read_new_rows(now)
+        self.save_state()
+        return rows
+
+    def current_bucket(self, now: float) -> LogAggregate:
+        """Корзина статистики текущего интервала"""
+        start = now - now % self.interval
+        if not self.buckets or self.buckets[-1][0] != start:
+            self.buckets.append((start, LogAggregate(**self.aggregate_options)))
+        return self.buckets[-1][1]
+
+    def publish(self, now: float = None) -> list[str]:
+        """
+        Строит отчеты по всем окнам. Возвращает пути отчетов
+        """
+        now = time.time() if now is None else now
+        # Корзины старше самого большого окна больше не нужны
+        while self.buckets and self.buckets[0][0] <= now - self.windows[-1] - self.interval:
+            self.buckets.popleft()
+        report_dir = Path(self.config.get("REPORT_DIR", "."))
+        report_size = self.config.get("REPORT_SIZE", 1_000)
+        paths = []
+        for window in self.windows:
+            window_data = merge_log_data((bucket for start, bucket in self.buckets
+                                          if start > now - window - self.interval),
+                                         **self.aggregate_options)
+            stat = prepare_stat_table(window_data, report_size=report_size,
+                                      percentiles=self.config.get("PERCENTILES", ()))
+            path = report_dir / f"report-live-{window}s.html"
+            write_html_report(stat=stat, config=self.config, last_log=None, path=str(path))
+            paths.append(str(path))
+        return paths
+
+    def run(self, poll_interval: float = 1.0):
+        """
+        Читает лог и публикует отчеты, пока процесс не прервут
+        """
+        next_publish = time.time() + self.interval
+        try:
+            while True:
+                self.poll()
+                if time.time() >= next_publish:
+                    self.publish()
+                    next_publish += self.interval
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            logging.info("Слежение за логом остановлено")
+        finally:
+            self.save_state()
+            if self.log is not None:
+                self.log.close()
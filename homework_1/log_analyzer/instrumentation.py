@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Счетчики и замеры этапов разбора логов
+
+Считаются строки (всего, разобранные, битые), прочитанные байты
+и время по этапам: read, decompress, parse, aggregate, spill, render.
+Битые строки попадают в случайную выборку фиксированного размера.
+Статистика частей, собранная в разных процессах, объединяется merge
+"""
+import heapq
+import json
+import logging
+import os
+import random
+import resource
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Iterable, Iterator
+
+# Размер выборки битых строк
+BAD_LINES_SAMPLE_SIZE = 10
+# Максимальная длина битой строки в выборке
+BAD_LINE_MAX_LENGTH = 500
+
+
+def read_statm() -> tuple[int, int] | None:
+    """
+    Текущие RSS и его часть из страниц файлов (shared) в байтах
+    по /proc/self/statm, None - если /proc недоступен
+    """
+    try:
+        with open("/proc/self/statm", encoding="ascii") as statm:
+            _, resident, shared = statm.read().split()[:3]
+    except (OSError, ValueError):
+        return None
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    return int(resident) * page_size, int(shared) * page_size
+
+
+def peak_rss() -> int:
+    """
+    Пиковый RSS процесса в байтах: наибольший за все время работы
+    процесса, он никогда не уменьшается
+    """
+    # ru_maxrss на Linux в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def current_rss() -> int | None:
+    """Текущий RSS процесса в байтах, None - если /proc недоступен"""
+    statm = read_statm()
+    return None if statm is None else statm[0]
+
+
+def anonymous_rss() -> int:
+    """
+    Анонимная память процесса в байтах: RSS без страниц файлов,
+    отображенных в память (их ядро может освободить само).
+    Если /proc недоступен - пиковый RSS: он не уменьшается
+    после сброса агрегата на диск, поэтому бюджет памяти
+    на таких системах срабатывает раньше нужного
+    """
+    statm = read_statm()
+    if statm is None:
+        return peak_rss()
+    resident, shared = statm
+    return resident - shared
+
+
+class RunStats:
+    """
+    Статистика одного запуска анализатора.
+    Выборка битых строк - bottom-k: каждой строке присваивается
+    случайный ключ и хранятся sample_size строк с наименьшими ключами.
+    Такая выборка равномерна и объединяется без потери равномерности.
+    progress_interval - период (в секундах) записи прогресса в лог, 0 - не писать
+    """
+    __slots__ = ("total_rows", "parsed_rows", "malformed_rows", "bytes_read", "logs", "cached_logs",
+                 "spilled_runs", "stages", "bad_lines", "sample_size", "progress_interval",
+                 "started", "last_progress")
+
+    def __init__(self, sample_size: int = BAD_LINES_SAMPLE_SIZE, progress_interval: float = 0):
+        self.total_rows = 0
+        self.parsed_rows = 0
+        self.malformed_rows = 0
+        self.bytes_read = 0
+        self.logs = 0
+        self.cached_logs = 0
+        self.spilled_runs = 0
+        self.stages: dict[str, float] = {}
+        # Пары (-ключ, строка, причина): куча по наибольшему ключу
+        self.bad_lines: list[tuple[float, str, str]] = []
+        self.sample_size = sample_size
+        self.progress_interval = progress_interval
+        self.started = self.last_progress = perf_counter()
+
+    def add_time(self, stage: str, seconds: float):
+        """Добавляет время этапа"""
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name: str):
+        """Замеряет время выполнения блока как этап name"""
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, perf_counter() - started)
+
+    def timed(self, iterable: Iterable, stage: str) -> Iterator:
+        """Генератор элементов iterable, время их получения относится к этапу stage"""
+        iterator = iter(iterable)
+        while True:
+            started = perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(stage, perf_counter() - started)
+                return
+            self.add_time(stage, perf_counter() - started)
+            yield item
+
+    def add_bad_line(self, row: bytes, reason: str):
+        """Учитывает битую строку и, возможно, добавляет ее в выборку"""
+        self.malformed_rows += 1
+        if not self.sample_size:
+            return
+        key = random.random()
+        if len(self.bad_lines) >= self.sample_size and -self.bad_lines[0][0] <= key:
+            return
+        line = row[:BAD_LINE_MAX_LENGTH].decode("UTF-8", errors="replace")
+        self._add_sample((-key, line, reason))
+
+    def _add_sample(self, item: tuple[float, str, str]):
+        """Добавляет строку в выборку, вытесняя строку с наибольшим ключом"""
+        if len(self.bad_lines) < self.sample_size:
+            heapq.heappush(self.bad_lines, item)
+        elif item[0] > self.bad_lines[0][0]:
+            heapq.heapreplace(self.bad_lines, item)
+
+    def merge(self, other: "RunStats"):
+        """Добавляет статистику другой части (процесса, лога)"""
+        self.total_rows += other.total_rows
+        self.parsed_rows += other.parsed_rows
+        self.malformed_rows += other.malformed_rows
+        self.bytes_read += other.bytes_read
+        self.logs += other.logs
+        self.cached_logs += other.cached_logs
+        self.spilled_runs += other.spilled_runs
+        for stage, seconds in other.stages.items():
+            self.add_time(stage, seconds)
+        for item in other.bad_lines:
+            self._add_sample(item)
+
+    def progress(self, force: bool = False):
+        """Пишет прогресс в лог, если с прошлой записи прошло progress_interval секунд"""
+        if not self.progress_interval and not force:
+            return
+        now = perf_counter()
+        if not force and now - self.last_progress < self.progress_interval:
+            return
+        self.last_progress = now
+        elapsed = max(now - self.started, 1e-9)
+        logging.info(json.dumps({"progress": {"elapsed": round(elapsed, 3),
+                                              "total_rows": self.total_rows,
+                                              "malformed_rows": self.malformed_rows,
+                                              "bytes_read": self.bytes_read,
+                                              "rows_per_sec": round(self.total_rows / elapsed, 1)}}))
+
+    def summary(self) -> dict:
+        """
+        Итоговая статистика в виде простых типов.
+        Время этапов в процессах разбора суммируется, поэтому
+        при нескольких процессах оно может превышать elapsed
+        """
+        elapsed = max(perf_counter() - self.started, 1e-9)
+        return {"elapsed": round(elapsed, 6),
+                "logs": self.logs,
+                "cached_logs": self.cached_logs,
+                "total_rows": self.total_rows,
+                "parsed_rows": self.parsed_rows,
+                "malformed_rows": self.malformed_rows,
+                "bytes_read": self.bytes_read,
+                "spilled_runs": self.spilled_runs,
+                "peak_rss_bytes": peak_rss(),
+                "rss_bytes": current_rss(),
+                "rows_per_sec": round(self.total_rows / elapsed, 1),
+                "bytes_per_sec": round(self.bytes_read / elapsed, 1),
+                "stages": {stage: round(seconds, 6) for stage, seconds in sorted(self.stages.items())},
+                "bad_lines_sample": [{"line": line, "reason": reason}
+                                     for _, line, reason in sorted(self.bad_lines, reverse=True)]}
@@ -7,42 +7,108 @@
 #                     '"$http_user_agent" "$http_x_forwarded_for" "$http_X_REQUEST_ID" "$http_X_RB_USER" '  
 #                     '$request_time';
 import argparse
+import hashlib
+import json
 import logging
 import os
-import shutil
-import gzip
 import re
+from concurrent.futures import ProcessPoolExecutor
 from configparser import ConfigParser
-from statistics import mean, median
-from string import Template
-from collections import namedtuple
 from datetime import datetime
+from itertools import repeat
 from pathlib import Path
 
+from aggregation import LogAggregate, MemoryBudget, merge_log_data, read_aggregate, write_aggregate
+from follow import LogFollower
+from instrumentation import RunStats
+from log_index import LogFile, LogIndex
+from merge import get_partial_meta, run_merge, write_partial_aggregate
+from normalization import parse_rules
+from parsing import gather_log_data, get_aggregate_options, get_memory_budget
+from stat_table import add_daily_columns, prepare_stat_table
+from writers import get_report_path, write_reports
+
+
+def parse_date_arg(value: str) -> str:
+    """
+    Приводит дату из командной строки (YYYY-MM-DD или YYYYMMDD)
+    к формату даты в имени лога (YYYYMMDD)
+    """
+    value = value.replace("-", "").replace(".", "")
+    try:
+        datetime.strptime(value, "%Y%m%d")
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(f"Неверная дата: {value}") from err
+    return value
+
+
 argument_parser = argparse.ArgumentParser()
 argument_parser.add_argument("--config", help="Путь до файла ini  с конфигурацией")
+argument_parser.add_argument("--workers", type=int, default=1,
+                             help="Количество процессов для разбора несжатого лога "
+                                  "(0 - по количеству ядер)")
+argument_parser.add_argument("--from", dest="date_from", type=parse_date_arg,
+                             help="Начальная дата периода отчета (YYYY-MM-DD)")
+argument_parser.add_argument("--to", dest="date_to", type=parse_date_arg,
+                             help="Конечная дата периода отчета (YYYY-MM-DD)")
+argument_parser.add_argument("--last", type=int, help="Отчет по N последним логам")
+argument_parser.add_argument("--per-day", action="store_true",
+                             help="Добавить в отчет колонки с разбивкой по дням")
+argument_parser.add_argument("--follow", action="store_true",
+                             help="Следить за живым логом и периодически обновлять отчеты")
+argument_parser.add_argument("--progress", type=float, default=0,
+                             help="Писать прогресс разбора в лог каждые N секунд")
+argument_parser.add_argument("--emit-partial", metavar="PATH",
+                             help="Вместо отчета сохранить частичный агрегат логов для merge "
+                                  "({host} в пути заменяется именем хоста)")
+subparsers = argument_parser.add_subparsers(dest="command")
+merge_parser = subparsers.add_parser("merge", help="Объединить частичные агрегаты с разных хостов")
+merge_parser.add_argument("partials", nargs="+", help="Файлы частичных агрегатов (--emit-partial)")
+merge_parser.add_argument("--output", help="Сохранить объединенный частичный агрегат вместо отчета")
 
 config = {
     "REPORT_SIZE": 1_000,
     "REPORT_DIR": "./reports",
-    "LOG_DIR": "./log"
+    "LOG_DIR": "./log",
+    # Точная медиана (хранит все времена запросов) вместо оценки скетчем
+    "EXACT_MEDIAN": False,
+    # Каталог с сохраненными агрегатами логов (пустое значение - не сохранять)
+    "CACHE_DIR": "./cache",
+    # Приводить URL к шаблонам (правила из секции [NORMALIZE] или правила по умолчанию)
+    "NORMALIZE_URLS": False,
+    # Лимит количества уникальных URL, редкие URL сворачиваются в "__other__" (0 - без лимита),
+    # при разборе в памяти держится не больше URL_SPILL_FACTOR * MAX_URLS URL, остальные - на диске
+    "MAX_URLS": 0,
+    # Форматы отчетов: html, jsonl, parquet, arrow, npz
+    "REPORT_FORMATS": ["html"],
+    # Режим --follow: живой лог (по умолчанию LOG_DIR/nginx-access-ui.log),
+    # период обновления отчетов и окна статистики в секундах
+    "LIVE_LOG": "",
+    "FOLLOW_INTERVAL": 60,
+    "FOLLOW_WINDOWS": [300, 3600],
+    # Перцентили времени запроса в отчете (колонки time_p90 и т.д.)
+    "PERCENTILES": [90, 95, 99],
+    # Границы корзин гистограммы времени запроса в секундах
+    # (колонки hist_le_<граница> и hist_gt_<последняя граница>)
+    "LATENCY_BUCKETS": [0.1, 0.5, 1, 5],
+    # Строк таблицы в одном файле данных HTML отчета
+    "REPORT_CHUNK_SIZE": 1_000,
+    # Файл для итоговой статистики запуска в JSON (пустое значение - только в лог)
+    "STATS_FILE": "",
+    # Бюджет памяти агрегации в МБ (0 - без ограничения): при превышении
+    # статистика URL сбрасывается на диск в SPILL_DIR (пустое значение - временный каталог)
+    "MEMORY_LIMIT_MB": 0,
+    "SPILL_DIR": "",
 }
-# Допустимый процент ошибок
-ERRORS_PERCENT = 30
 # Путь к конфигурационному файлу по умолчанию
 DEFAULT_CONFIG_FILE_PATH = "./config.ini"
 
 # Паттерны
-_http_methods = ["GET", "POST", "HEAD", "OPTIONS", "TRACE",
-                 "DELETE", "PUT", "POST", "PATCH", "CONNECT"]
-_http_method = '|'.join(_http_methods)
-_http_method = rf"(?:{_http_method})"
-_url = rf'"{_http_method} ([\w\W]+) HTTP'
-url_pattern = re.compile(_url)  # URL
-request_time_pattern = re.compile(r"\d*\.\d*$")  # Время запроса
 filename_pattern = re.compile(r"nginx-access-ui\.log-(\d{8})(?:.gz)*$")  # Валидное имя файла лога
-
-LogFile = namedtuple('LogFile', ["date", "path"])
+LOG_NAME_PREFIX = "nginx-access-ui.log-"  # Префикс имени лога перед датой
+# Логгер итоговой статистики запуска: пишет на уровне INFO при любом уровне корневого логгера
+STATS_LOGGER = logging.getLogger("log_analyzer.stats")
+STATS_LOGGER.setLevel(logging.INFO)
 
 
 def configure_logging(cl_args: argparse.Namespace):
@@ -52,6 +118,9 @@ def configure_logging(cl_args: argparse.Namespace):
     config = get_config(cl_args=cl_args)
     kwargs = {"format": "[%(asctime)s] %(levelname).1s %(message)s",
               "datefmt": "%Y.%m.%d %H:%M:%S"}
+    if cl_args.progress:
+        # Прогресс пишется на уровне INFO, итоговая статистика - всегда (STATS_LOGGER)
+        kwargs.update(level=logging.INFO)
     log_file = config.get("LOGING_FILE")
     if log_file:
         kwargs.update(filename=log_file)
@@ -81,10 +150,56 @@ def read_config_from_cli(cl_args: argparse.Namespace) -> dict:
     config_path = cl_args.config
     if config_path is not None:
         new_config = read_config_by_path(path=config_path)
-        if "REPORT_SIZE" in new_config:
-            new_config['REPORT_SIZE'] = int(new_config['REPORT_SIZE'])
-        return new_config
-    return read_default_config()
+        return convert_config_types(new_config)
+    # Конфиг по умолчанию приводится к типам и проверяется так же
+    return convert_config_types(read_default_config())
+
+
+def to_bool(value: str) -> bool:
+    """Приводит строковое значение из конфига к bool"""
+    return str(value).strip().lower() in ("1", "true", "yes", "on")
+
+
+def to_list(value: str) -> list[str]:
+    """Приводит строковое значение из конфига к списку (через запятую)"""
+    return [item.strip() for item in str(value).split(",") if item.strip()]
+
+
+# Приведение типов значений, прочитанных из ini файла
+CONFIG_TYPES = {
+    "REPORT_SIZE": int,
+    "EXACT_MEDIAN": to_bool,
+    "NORMALIZE_URLS": to_bool,
+    "MAX_URLS": int,
+    "REPORT_FORMATS": to_list,
+    "FOLLOW_INTERVAL": int,
+    "FOLLOW_WINDOWS": lambda value: [int(window) for window in to_list(value)],
+    "PERCENTILES": lambda value: [float(percentile) for percentile in to_list(value)],
+    "LATENCY_BUCKETS": lambda value: [float(bound) for bound in to_list(value)],
+    "REPORT_CHUNK_SIZE": int,
+    "MEMORY_LIMIT_MB": int,
+}
+# Проверки значений конфигурации: ключ -> (условие, допустимые значения)
+CONFIG_CHECKS = {
+    "FOLLOW_INTERVAL": (lambda interval: interval > 0, "больше 0"),
+    "FOLLOW_WINDOWS": (lambda windows: all(window > 0 for window in windows), "больше 0"),
+    "PERCENTILES": (lambda percentiles: all(0 <= percentile <= 100 for percentile in percentiles), "от 0 до 100"),
+}
+
+
+def convert_config_types(new_config: dict) -> dict:
+    """
+    Приводит строковые значения конфигурации к нужным типам
+    и проверяет их по CONFIG_CHECKS
+    """
+    for key, converter in CONFIG_TYPES.items():
+        if key in new_config:
+            new_config[key] = converter(new_config[key])
+    for key, check in CONFIG_CHECKS.items():
+        is_valid, allowed = check
+        if key in new_config and not is_valid(new_config[key]):
+            raise ValueError(f"Недопустимое значение {key} = {new_config[key]}, должно быть {allowed}")
+    return new_config
 
 
 def read_config_by_path(path: str) -> dict:
@@ -93,7 +208,11 @@ def read_config_by_path(path: str) -> dict:
     """
     configparser = get_configparser()
     configparser.read(path, encoding='UTF-8')
-    return dict(configparser['CONFIG'])
+    new_config = dict(configparser['CONFIG'])
+    if configparser.has_section("NORMALIZE"):
+        # raw - что бы % в регулярных выражениях не считался подстановкой
+        new_config["NORMALIZE_RULES"] = parse_rules(configparser.items("NORMALIZE", raw=True))
+    return new_config
 
 
 def read_default_config() -> dict:
@@ -119,168 +238,238 @@ def get_config(cl_args: argparse.Namespace) -> dict:
     return default_config
 
 
-def find_last_log(config: dict) -> LogFile:
+def find_logs(config: dict, date_from: str = None, date_to: str = None,
+              last: int = None, log_index: LogIndex = None) -> list[LogFile]:
     """
-    Ищет самый последний файл лога
+    Ищет логи за период [date_from, date_to] (даты в формате YYYYMMDD)
+    и/или last самых последних логов. Возвращает логи по возрастанию даты.
+    Если передан индекс логов, каталог не сканируется.
+    Даты сравниваются как строки, strptime выполняется только
+    для отобранных логов
     """
+    if log_index is not None:
+        return [LogFile(date=datetime.strptime(_date, "%Y%m%d"), path=path)
+                for _date, path in log_index.find(date_from=date_from, date_to=date_to, last=last)]
     catalog = config.get("LOG_DIR", '..')
-    last_log: LogFile = None
-    files = os.listdir(catalog)
-    for file_name in files:
-        dates = filename_pattern.findall(file_name)
-        if dates:
-            _date = dates[0]
-            date = datetime.strptime(_date, "%Y%m%d")
-            path = Path(catalog) / file_name
-            if last_log is not None:
-                if date > last_log.date:
-                    last_log = LogFile(date=date, path=str(path))
-            else:
-                last_log = LogFile(date=date, path=str(path))
-    return last_log
+    # Дата берется срезом имени после префикса, регулярка проверяет
+    # только имена, прошедшие отбор по дате
+    candidates: dict[str, list[str]] = {}
+    with os.scandir(catalog) as entries:
+        for entry in entries:
+            position = entry.name.rfind(LOG_NAME_PREFIX)
+            if position == -1:
+                continue
+            position += len(LOG_NAME_PREFIX)
+            _date = entry.name[position:position + 8]
+            if date_from is not None and _date < date_from:
+                continue
+            if date_to is not None and _date > date_to:
+                continue
+            candidates.setdefault(_date, []).append(entry.name)
+    found: dict[str, str] = {}
+    for _date in sorted(candidates, reverse=True):
+        if last is not None and len(found) >= last:
+            break
+        names = [name for name in candidates[_date] if filename_pattern.findall(name)]
+        if names:
+            # На одну дату берется лог с наименьшим именем, как и в индексе
+            found[_date] = min(names)
+    return [LogFile(date=datetime.strptime(_date, "%Y%m%d"), path=str(Path(catalog) / found[_date]))
+            for _date in sorted(found)]
+
+
+def find_last_log(config: dict, log_index: LogIndex = None) -> LogFile:
+    """
+    Ищет самый последний файл лога
+    """
+    logs = find_logs(config=config, last=1, log_index=log_index)
+    return logs[0] if logs else None
 
 
-def report_exists(last_log: LogFile) -> bool:
+def get_log_index(config: dict) -> LogIndex:
     """
-    Проверяет выполнены ли отчет по этому логу ранее
+    Загружает и обновляет индекс логов LOG_DIR из CACHE_DIR.
+    Без CACHE_DIR индекс не ведется
     """
-    path = get_report_path(last_log=last_log)
-    path = Path(path).resolve()
-    return path.exists()
-
+    cache_dir = config.get("CACHE_DIR")
+    if not cache_dir:
+        return None
+    catalog = config.get("LOG_DIR", '..')
+    digest = hashlib.sha1(os.path.abspath(catalog).encode("UTF-8")).hexdigest()[:12]
+    log_index = LogIndex.load(catalog, path=Path(cache_dir) / f"log-index-{digest}.json",
+                              pattern=filename_pattern)
+    log_index.save()
+    return log_index
 
-def get_report_path(last_log: LogFile) -> str:
-    """Формирует путь до файла с отчетом"""
-    _date = last_log.date
-    date = _date.strftime("%Y.%m.%d")
-    catalog = config.get("REPORT_DIR", ".")
-    return str(Path(catalog) / f"report-{date}.html")
 
+def report_up_to_date(config: dict, log_files: list[LogFile], extension: str = "html",
+                      log_index: LogIndex = None) -> bool:
+    """
+    Проверяет, что отчет по логам построен ранее и логи с тех пор не менялись.
+    Без индекса логов проверяется только существование отчета
+    """
+    path = get_report_path(config, last_log=log_files[-1], first_log=log_files[0], extension=extension)
+    if log_index is None:
+        return os.path.exists(path)
+    return log_index.report_up_to_date(path, [log_file.path for log_file in log_files])
 
-def parse_row(row: str):
-    """Извлекает данные из строки"""
-    address = url_pattern.findall(row)
-    request_time = request_time_pattern.findall(row)
 
-    return address, request_time
+def get_log_fingerprint(log_file: LogFile, aggregate_options: dict) -> str:
+    """
+    Отпечаток лога: имя, размер и время изменения файла,
+    а так же настройки, влияющие на агрегат
+    """
+    file_stat = os.stat(log_file.path)
+    options = sorted(aggregate_options.items())
+    key = f"{Path(log_file.path).name}:{file_stat.st_size}:{file_stat.st_mtime_ns}:{options!r}"
+    return hashlib.sha1(key.encode("UTF-8")).hexdigest()[:16]
 
 
-def read_lines(log_path):
+def get_log_identity(log_file: LogFile, aggregate_options: dict) -> str:
     """
-    Генератор для парсинга данных построчно
+    Идентичность агрегата в кеше: полный путь лога и настройки агрегата.
+    Агрегаты с одной идентичностью и разными отпечатками - версии
+    одного и того же лога, из которых нужна только последняя
     """
-    log = gzip.open(log_path, 'rb') if log_path.endswith(".gz") else open(log_path, encoding="UTF-8")
-    i = 0
-    missing_rows = 0
-    try:
-        for i, row in enumerate(log):
-            if isinstance(row, bytes):
-                row = row.decode("UTF-8")
-            address, request_time = parse_row(row)
-            gather_log_data.total_rows += 1
-            if len(address) > 1 or len(request_time) > 1:
-                msg = f"Неверно написанное регулярное выражение, строка {i + 1}"
-                logging.error(msg)
-                raise ValueError(msg)
-            if address and request_time:
-                addr = address[0]
-                time = float(request_time[0])
-                yield addr, time
-            else:
-                missing_rows += 1
-    except:
-        pass
-    finally:
-        log.close()
-    if missing_rows:
-        errors_percent = missing_rows / gather_log_data.total_rows * 100
-        if errors_percent >= ERRORS_PERCENT:
-            logging.error(f"Большое количество ({errors_percent:.2f} %) "
-                          f"строк пропущено, они имели неверный формат")
-    gather_log_data.total_rows = i + 1
-
-
-def gather_log_data(log_path: str) -> list[dict]:
-    """
-    Собирает данные из лога в нужную структуру
-    """
-    log_data = {}
-    gather_log_data.total_rows = 0
-    for addr, time in read_lines(log_path):
-        if addr not in log_data:
-            log_data[addr] = []
-        log_data[addr].append(time)
-    return log_data
+    options = sorted(aggregate_options.items())
+    key = f"{os.path.abspath(log_file.path)}:{options!r}"
+    return hashlib.sha1(key.encode("UTF-8")).hexdigest()[:12]
 
 
-gather_log_data.total_rows = 0
+def get_cache_path(log_file: LogFile, cache_dir: str, fingerprint: str, identity: str) -> Path:
+    """Формирует путь до файла с агрегатом лога"""
+    date = log_file.date.strftime("%Y%m%d")
+    return Path(cache_dir) / f"{date}-{identity}-{fingerprint}.agg"
 
 
-def prepare_stat_table(log_data: dict) -> list[dict]:
+def load_log_data(log_file: LogFile, config: dict, workers: int = 1,
+                  run_stats: RunStats = None, memory_budget: MemoryBudget = None) -> LogAggregate:
     """
-    Подготавливает таблицу для веба
+    Возвращает агрегат лога из кеша, а если лог изменился
+    (или еще не разбирался) - разбирает лог и сохраняет агрегат в кеш
     """
+    aggregate_options = get_aggregate_options(config)
+    run_stats = RunStats() if run_stats is None else run_stats
+    run_stats.logs += 1
+    cache_dir = config.get("CACHE_DIR")
+    if not cache_dir:
+        return gather_log_data(log_file.path, workers=workers, run_stats=run_stats,
+                               memory_budget=memory_budget, **aggregate_options)
+    fingerprint = get_log_fingerprint(log_file, aggregate_options=aggregate_options)
+    identity = get_log_identity(log_file, aggregate_options=aggregate_options)
+    cache_path = get_cache_path(log_file, cache_dir=cache_dir, fingerprint=fingerprint, identity=identity)
+    cached = read_aggregate(cache_path)
+    if cached is not None:
+        logging.info(f'Агрегат лога "{log_file.path}" взят из кеша "{cache_path}"')
+        run_stats.cached_logs += 1
+        _, log_data = cached
+        return log_data
+    log_data = gather_log_data(log_file.path, workers=workers, run_stats=run_stats,
+                               memory_budget=memory_budget, **aggregate_options)
+    if log_data.runs:
+        # Чтение из кеша собрало бы сброшенный на диск агрегат в памяти целиком
+        logging.info(f'Агрегат лога "{log_file.path}" не помещается в бюджет памяти и не кешируется')
+        return log_data
+    # Агрегаты прежних версий этого лога с теми же настройками больше не нужны,
+    # агрегаты других логов и других настроек остаются
+    for stale_path in cache_path.parent.glob(f"{log_file.date:%Y%m%d}-{identity}-*.agg"):
+        if stale_path != cache_path:
+            stale_path.unlink(missing_ok=True)
+    meta = {"log": log_file.path, "date": log_file.date.strftime("%Y%m%d"),
+            "fingerprint": fingerprint}
+    try:
+        write_aggregate(cache_path, log_data, meta=meta)
+    except OSError:
+        logging.exception(f'Не удалось сохранить агрегат лога в "{cache_path}"')
+    return log_data
 
-    def calculate_row(item: tuple) -> dict:
-        """
-        Подсчитывает статистику в строке
-        """
-        nonlocal all_requests_time
-        total_rows = gather_log_data.total_rows
-        url, times = item
-        row = {"url": url,
-               "count": len(times),
-               "time_avg": mean(times),
-               "time_max": max(times),
-               "time_sum": sum(times),
-               "time_med": median(times),
-               "count_perc": len(times) / total_rows * 100,
-               "time_perc": sum(times) / all_requests_time * 100}
-        return row
 
-    all_requests_times = [sum(v) for v in log_data.values()]  # Суммарное время всех запросов
-    all_requests_time = sum(all_requests_times)
-    stat = [calculate_row(item) for item in log_data.items()]
-    stat = sorted(stat, key=lambda x: x['time_sum'], reverse=True)
-    return stat
+def load_log_data_with_stats(log_file: LogFile, config: dict) -> tuple[LogAggregate, RunStats]:
+    """Агрегат и статистика разбора лога (для запуска в процессе пула)"""
+    run_stats = RunStats()
+    return load_log_data(log_file, config=config, run_stats=run_stats), run_stats
 
 
-def create_report_folders_tree_is_not_exists(report_path: str):
+def load_logs_data(log_files: list[LogFile], config: dict, workers: int = 1,
+                   run_stats: RunStats = None) -> list[LogAggregate]:
     """
-    Создает древо папок, если они не существуют
+    Возвращает агрегаты нескольких логов (из кеша, если он актуален).
+    При workers > 1 логи обрабатываются параллельно, по логу на процесс
     """
-    report_path = Path(report_path).parent
-    report_path.mkdir(parents=True, exist_ok=True)
-
-
-def write_html_report(stat: list[dict], config: dict, last_log: LogFile):
+    run_stats = RunStats() if run_stats is None else run_stats
+    if workers <= 1 or len(log_files) <= 1:
+        return [load_log_data(log_file, config=config, workers=workers, run_stats=run_stats)
+                for log_file in log_files]
+    logs_data = []
+    with ProcessPoolExecutor(max_workers=min(workers, len(log_files))) as executor:
+        for log_data, log_stats in executor.map(load_log_data_with_stats, log_files, repeat(config)):
+            logs_data.append(log_data)
+            run_stats.merge(log_stats)
+            run_stats.progress()
+    return logs_data
+
+
+def load_report_data(log_files: list[LogFile], config: dict, workers: int = 1, run_stats: RunStats = None,
+                     per_day: bool = False) -> tuple[LogAggregate, list[LogAggregate] | None]:
     """
-    Генерирует HTML отчет
+    Загружает логи отчета и объединяет их в один агрегат.
+    Возвращает и агрегаты логов (None, если их не нужно держать).
+    С бюджетом памяти логи загружаются по одному и сразу объединяются,
+    агрегаты логов держатся только для колонок по дням (per_day)
+    и после исчерпания бюджета тоже сбрасываются на диск
     """
-    report_size = config.get("REPORT_SIZE", 1_000)
-    path = get_report_path(last_log=last_log)
-    create_report_folders_tree_is_not_exists(report_path=path)
-    report_template_path = Path(__file__).parent / "report_template.html"
-    try:
-        copy_js_script(config=config)
-        with open(report_template_path, encoding="UTF-8") as template:
-            with open(path, "w", encoding="UTF-8") as new_report:
-                template = template.read()
-                output = Template(template).safe_substitute({"table_json": stat[:report_size]})
-                new_report.write(output)
-    except IOError as err:
-        logging.exception("Произошла ошибка при сохранении HTML отчета", exc_info=True)
-        raise err
+    run_stats = RunStats() if run_stats is None else run_stats
+    memory_budget = get_memory_budget(config)
+    if memory_budget is None:
+        logs_data = load_logs_data(log_files, config=config, workers=workers, run_stats=run_stats)
+        with run_stats.stage("aggregate"):
+            log_data = merge_log_data(logs_data, **get_aggregate_options(config))
+        return log_data, logs_data
+    log_data = LogAggregate(**get_aggregate_options(config))
+    logs_data = [] if per_day else None
+    for log_file in log_files:
+        day_data = load_log_data(log_file, config=config, workers=workers, run_stats=run_stats,
+                                 memory_budget=memory_budget)
+        with run_stats.stage("aggregate"):
+            log_data.merge(day_data, keep_runs=per_day)
+        if per_day:
+            logs_data.append(day_data)
+        del day_data
+        memory_budget.check(log_data, run_stats=run_stats)
+        spill_urls = memory_budget.spill_urls
+        if not per_day or spill_urls is None:
+            continue
+        if sum(len(day_data.urls) for day_data in logs_data) >= spill_urls:
+            # Агрегаты логов нужны только для колонок по дням, которые читают их серии с диска
+            for day_data in logs_data:
+                if day_data.urls:
+                    with run_stats.stage("spill"):
+                        day_data.spill(memory_budget.directory, max_runs=memory_budget.max_runs)
+                    run_stats.spilled_runs += 1
+    return log_data, logs_data
+
+
+def write_run_stats(run_stats: RunStats, config: dict):
+    """
+    Пишет итоговую статистику запуска в JSON: в лог и в STATS_FILE, если он задан
+    """
+    summary = json.dumps(run_stats.summary(), ensure_ascii=False)
+    STATS_LOGGER.info(summary)
+    stats_file = config.get("STATS_FILE")
+    if stats_file:
+        Path(stats_file).parent.mkdir(parents=True, exist_ok=True)
+        Path(stats_file).write_text(summary, encoding="UTF-8")
 
 
-def copy_js_script(config: dict):
+def select_logs(config: dict, cl_args: argparse.Namespace, log_index: LogIndex = None) -> list[LogFile]:
     """
-    Копирует js скрипт в папку с HTML отчетом
-    для корректности отображения
+    Выбирает логи для отчета по аргументам командной строки:
+    период --from/--to и/или --last N, по умолчанию - последний лог
     """
-    copy_from = Path(__file__).parent / "jquery.tablesorter.min.js"
-    copy_to = Path(config.get("REPORT_DIR", "..")) / "jquery.tablesorter.min.js"
-    shutil.copy2(copy_from, copy_to)
+    date_from, date_to, last = cl_args.date_from, cl_args.date_to, cl_args.last
+    if date_from is None and date_to is None and last is None:
+        last = 1
+    return find_logs(config=config, date_from=date_from, date_to=date_to, last=last, log_index=log_index)
 
 
 def main():
@@ -288,13 +477,40 @@ def main():
         cl_args = parse_args()
         configure_logging(cl_args=cl_args)
         config = get_config(cl_args=cl_args)
-        last_log = find_last_log(config=config)
-        if report_exists(last_log=last_log):
-            report_path = get_report_path(last_log)
+        if cl_args.follow:
+            return LogFollower(config=config).run()
+        run_stats = RunStats(progress_interval=cl_args.progress)
+        if cl_args.command == "merge":
+            run_merge(config=config, cl_args=cl_args, run_stats=run_stats)
+            return write_run_stats(run_stats, config=config)
+        log_index = get_log_index(config)
+        log_files = select_logs(config=config, cl_args=cl_args, log_index=log_index)
+        if not log_files:
+            return logging.info("Логи для анализа не найдены")
+        first_log, last_log = log_files[0], log_files[-1]
+        extension = config.get("REPORT_FORMATS", ["html"])[0]
+        report_path = get_report_path(config, last_log, first_log=first_log, extension=extension)
+        if not cl_args.emit_partial and report_up_to_date(config, log_files, extension=extension, log_index=log_index):
             return logging.error(f'Отчет "{report_path}" уже существует')
-        log_data = gather_log_data(log_path=last_log.path)
-        stat = prepare_stat_table(log_data)
-        write_html_report(stat=stat, config=config, last_log=last_log)
+        if not cl_args.emit_partial and os.path.exists(report_path):
+            logging.info(f'Логи изменились после построения отчета "{report_path}", отчет будет перестроен')
+        workers = cl_args.workers or os.cpu_count()
+        per_day = cl_args.per_day and len(log_files) > 1
+        log_data, logs_data = load_report_data(log_files, config=config, workers=workers, run_stats=run_stats,
+                                               per_day=per_day)
+        if cl_args.emit_partial:
+            write_partial_aggregate(cl_args.emit_partial, log_data, meta=get_partial_meta(log_files))
+            return write_run_stats(run_stats, config=config)
+        with run_stats.stage("render"):
+            stat = prepare_stat_table(log_data, report_size=config.get("REPORT_SIZE", 1_000),
+                                      percentiles=config.get("PERCENTILES", ()))
+            if per_day:
+                add_daily_columns(stat, log_files=log_files, logs_data=logs_data, log_data=log_data)
+            write_reports(stat=stat, config=config, last_log=last_log, first_log=first_log)
+        if log_index is not None and os.path.exists(report_path):
+            log_index.record_report(report_path, [log_file.path for log_file in log_files])
+            log_index.save()
+        write_run_stats(run_stats, config=config)
     except Exception as err:
         logging.exception(err, exc_info=True)
 
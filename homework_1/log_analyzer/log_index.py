@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Сохраняемый индекс логов каталога
+
+Для каждого лога хранятся дата, размер и время изменения.
+Каталог пересканируется только если изменилось время изменения
+самого каталога (файл добавлен, удален или переименован),
+и при пересканировании разбираются только новые имена.
+Для построенных отчетов запоминаются размеры и время изменения
+логов, по которым они строились, что бы дешево проверить,
+актуален ли отчет
+"""
+import bisect
+import json
+import os
+import re
+import time
+from collections import namedtuple
+from pathlib import Path
+
+# Версия формата файла индекса
+INDEX_FORMAT_VERSION = 1
+# Время изменения каталога моложе этого интервала не запоминается:
+# файл, добавленный в тот же квант времени файловой системы, что и сканирование,
+# не изменил бы время изменения каталога и не попал бы в индекс
+RACY_INTERVAL_NS = 2 * 10 ** 9
+
+# Лог: дата (datetime) и путь до файла
+LogFile = namedtuple('LogFile', ["date", "path"])
+
+
+class LogIndex:
+    """
+    Индекс логов каталога catalog, сохраняемый в файл path.
+    pattern - регулярное выражение имени лога с датой (YYYYMMDD) в первой группе
+    """
+
+    def __init__(self, catalog: str, path: str | Path, pattern: re.Pattern):
+        self.catalog = catalog
+        self.path = Path(path)
+        self.pattern = pattern
+        self.dir_mtime_ns = None
+        # Имя лога -> [дата YYYYMMDD, размер, время изменения в нс]
+        self.logs: dict[str, list] = {}
+        # Имя отчета -> [[имя лога, размер, время изменения в нс], ...]
+        self.reports: dict[str, list] = {}
+        self.changed = False
+        self._dates: list[str] = []
+        self._by_date: dict[str, str] = {}
+
+    @classmethod
+    def load(cls, catalog: str, path: str | Path, pattern: re.Pattern) -> "LogIndex":
+        """
+        Читает индекс из файла и обновляет его по каталогу.
+        Отсутствующий, битый или чужой файл индекса строится заново
+        """
+        index = cls(catalog, path=path, pattern=pattern)
+        try:
+            with open(index.path, encoding="UTF-8") as file:
+                document = json.load(file)
+        except (OSError, ValueError):
+            document = None
+        if (isinstance(document, dict) and document.get("version") == INDEX_FORMAT_VERSION
+                and document.get("catalog") == os.path.abspath(catalog)):
+            index.dir_mtime_ns = document["dir_mtime_ns"]
+            index.logs = document["logs"]
+            index.reports = document["reports"]
+        index.refresh()
+        return index
+
+    def refresh(self) -> bool:
+        """
+        Обновляет индекс, если каталог изменился.
+        Для уже известных имен дата не разбирается и файл не stat'ится заново
+        """
+        dir_mtime_ns = os.stat(self.catalog).st_mtime_ns
+        if dir_mtime_ns != self.dir_mtime_ns:
+            logs = {}
+            with os.scandir(self.catalog) as entries:
+                for entry in entries:
+                    known = self.logs.get(entry.name)
+                    if known is not None:
+                        logs[entry.name] = known
+                        continue
+                    dates = self.pattern.findall(entry.name)
+                    if not dates:
+                        continue
+                    file_stat = entry.stat()
+                    logs[entry.name] = [dates[0], file_stat.st_size, file_stat.st_mtime_ns]
+            self.logs = logs
+            racy = time.time_ns() - dir_mtime_ns < RACY_INTERVAL_NS
+            self.dir_mtime_ns = None if racy else dir_mtime_ns
+            self.changed = True
+        self._build_lookup()
+        return self.changed
+
+    def _build_lookup(self):
+        """Отсортированные даты и лог на каждую дату (при нескольких - с меньшим именем)"""
+        by_date: dict[str, str] = {}
+        for name, (date, _, _) in self.logs.items():
+            if date not in by_date or name < by_date[date]:
+                by_date[date] = name
+        self._by_date = by_date
+        self._dates = sorted(by_date)
+
+    def find(self, date_from: str = None, date_to: str = None, last: int = None) -> list[tuple[str, str]]:
+        """
+        Пары (дата, путь) логов за период [date_from, date_to]
+        и/или last самых последних, по возрастанию даты
+        """
+        low = 0 if date_from is None else bisect.bisect_left(self._dates, date_from)
+        high = len(self._dates) if date_to is None else bisect.bisect_right(self._dates, date_to)
+        if last is not None:
+            low = max(low, high - last)
+        return [(date, str(Path(self.catalog) / self._by_date[date])) for date in self._dates[low:high]]
+
+    def record_report(self, report_path: str, log_paths: list[str]):
+        """Запоминает логи, по которым построен отчет, и обновляет их размер и время изменения"""
+        states = [get_file_state(path) for path in log_paths]
+        for name, size, mtime_ns in states:
+            if name in self.logs:
+                self.logs[name][1:] = [size, mtime_ns]
+        self.reports[Path(report_path).name] = states
+        self.changed = True
+
+    def report_up_to_date(self, report_path: str, log_paths: list[str]) -> bool:
+        """
+        Отчет существует и логи не менялись с момента его построения.
+        Отчет, построенный до появления индекса, считается актуальным
+        """
+        if not os.path.exists(report_path):
+            return False
+        recorded = self.reports.get(Path(report_path).name)
+        if recorded is None:
+            return True
+        try:
+            return recorded == [get_file_state(path) for path in log_paths]
+        except OSError:
+            return False
+
+    def save(self):
+        """Сохраняет индекс, если он изменился"""
+        if not self.changed:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f"{self.path.name}.tmp{os.getpid()}")
+        document = {"version": INDEX_FORMAT_VERSION,
+                    "catalog": os.path.abspath(self.catalog),
+                    "dir_mtime_ns": self.dir_mtime_ns,
+                    "logs": self.logs,
+                    "reports": self.reports}
+        with open(tmp_path, "w", encoding="UTF-8") as file:
+            json.dump(document, file, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
+        self.changed = False
+
+
+def get_file_state(path: str) -> list:
+    """Имя, размер и время изменения файла"""
+    file_stat = os.stat(path)
+    return [Path(path).name, file_stat.st_size, file_stat.st_mtime_ns]
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Объединение частичных агрегатов (команда merge)
+
+Каждый хост сохраняет агрегат своих логов (--emit-partial),
+merge объединяет их в отчет за весь парк или в частичный
+агрегат следующего уровня иерархии
+"""
+import argparse
+import logging
+import os
+import socket
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import partial
+from pathlib import Path
+from typing import Iterable
+
+from aggregation import LogAggregate, read_aggregate, write_aggregate
+from instrumentation import RunStats
+from log_index import LogFile
+from stat_table import prepare_stat_table
+from writers import get_report_path, report_exists, write_reports
+
+
+def get_partial_meta(log_files: list[LogFile]) -> dict:
+    """
+    Описание частичного агрегата: хост, логи и период
+    """
+    host = socket.gethostname()
+    dates = [log_file.date.strftime("%Y%m%d") for log_file in log_files]
+    return {"hosts": [host],
+            "logs": [{"host": host, "name": Path(log_file.path).name, "date": date}
+                     for log_file, date in zip(log_files, dates)],
+            "date_from": min(dates, default=None),
+            "date_to": max(dates, default=None)}
+
+
+def merge_partial_meta(metas: Iterable[dict]) -> dict:
+    """
+    Объединяет описания частичных агрегатов.
+    Если один и тот же лог хоста встречается дважды, пишет предупреждение:
+    его строки будут учтены дважды
+    """
+    hosts, logs, seen = set(), [], set()
+    for meta in metas:
+        hosts.update(meta["hosts"])
+        for log in meta["logs"]:
+            key = (log["host"], log["name"])
+            if key in seen:
+                logging.warning(f'Лог "{log["name"]}" хоста "{log["host"]}" объединяется повторно')
+            seen.add(key)
+            logs.append(log)
+    dates = [log["date"] for log in logs]
+    return {"hosts": sorted(hosts), "logs": logs,
+            "date_from": min(dates, default=None), "date_to": max(dates, default=None)}
+
+
+def write_partial_aggregate(path: str, log_data: LogAggregate, meta: dict) -> str:
+    """
+    Сохраняет частичный агрегат для объединения командой merge.
+    {host} в пути заменяется именем хоста
+    """
+    path = path.replace("{host}", socket.gethostname())
+    write_aggregate(path, log_data, meta=dict(meta, partial=True))
+    logging.info(f'Частичный агрегат сохранен в "{path}"')
+    return path
+
+
+def read_partial_aggregate(path: str) -> tuple[dict, LogAggregate]:
+    """Читает частичный агрегат, сохраненный write_partial_aggregate"""
+    partial_aggregate = read_aggregate(path)
+    if partial_aggregate is None or not partial_aggregate[0].get("partial"):
+        raise ValueError(f'"{path}" не является частичным агрегатом текущей версии')
+    return partial_aggregate
+
+
+def reduce_partial_aggregates(paths: list[str], max_urls: int = 0) -> tuple[dict, LogAggregate]:
+    """
+    Последовательно объединяет частичные агрегаты (поддерево свертки)
+    """
+    metas, log_data = [], None
+    for path in paths:
+        meta, partial_data = read_partial_aggregate(path)
+        metas.append(meta)
+        if log_data is None:
+            log_data = LogAggregate(exact=partial_data.exact, max_urls=max_urls,
+                                    histogram_bounds=partial_data.histogram_bounds)
+        log_data.merge(partial_data)
+    return merge_partial_meta(metas), log_data
+
+
+def merge_partial_aggregates(paths: list[str], workers: int = 1,
+                             max_urls: int = 0) -> tuple[dict, LogAggregate]:
+    """
+    Объединяет частичные агрегаты сверткой в два уровня: каждый процесс
+    сворачивает свою непрерывную группу файлов, затем результаты процессов
+    сворачиваются по порядку. Объединение ассоциативно, поэтому результат
+    совпадает с последовательным, а объединенный агрегат можно снова
+    передать в merge на следующем уровне иерархии
+    """
+    if not paths:
+        raise ValueError("Не заданы частичные агрегаты для объединения")
+    groups = min(workers, len(paths))
+    if groups <= 1:
+        return reduce_partial_aggregates(paths, max_urls=max_urls)
+    size = -(-len(paths) // groups)
+    path_groups = [paths[i:i + size] for i in range(0, len(paths), size)]
+    with ProcessPoolExecutor(max_workers=len(path_groups)) as executor:
+        results = list(executor.map(partial(reduce_partial_aggregates, max_urls=max_urls), path_groups))
+    metas, log_data = [], None
+    for meta, partial_data in results:
+        metas.append(meta)
+        if log_data is None:
+            log_data = LogAggregate(exact=partial_data.exact, max_urls=max_urls,
+                                    histogram_bounds=partial_data.histogram_bounds)
+        log_data.merge(partial_data)
+    return merge_partial_meta(metas), log_data
+
+
+def run_merge(config: dict, cl_args: argparse.Namespace, run_stats: RunStats):
+    """
+    Команда merge: объединяет частичные агрегаты хостов
+    в отчет за весь парк или в частичный агрегат следующего уровня
+    """
+    workers = cl_args.workers or os.cpu_count()
+    with run_stats.stage("aggregate"):
+        meta, log_data = merge_partial_aggregates(cl_args.partials, workers=workers,
+                                                  max_urls=config.get("MAX_URLS", 0))
+    run_stats.logs += len(meta["logs"])
+    if cl_args.output:
+        return write_partial_aggregate(cl_args.output, log_data, meta=meta)
+    if meta["date_to"] is None:
+        return logging.info("В частичных агрегатах нет логов")
+    first_log = LogFile(date=datetime.strptime(meta["date_from"], "%Y%m%d"), path=None)
+    last_log = LogFile(date=datetime.strptime(meta["date_to"], "%Y%m%d"), path=None)
+    extension = config.get("REPORT_FORMATS", ["html"])[0]
+    if report_exists(config, last_log=last_log, first_log=first_log, extension=extension):
+        report_path = get_report_path(config, last_log, first_log=first_log, extension=extension)
+        return logging.error(f'Отчет "{report_path}" уже существует')
+    with run_stats.stage("render"):
+        stat = prepare_stat_table(log_data, report_size=config.get("REPORT_SIZE", 1_000),
+                                  percentiles=config.get("PERCENTILES", ()))
+        write_reports(stat=stat, config=config, last_log=last_log, first_log=first_log)
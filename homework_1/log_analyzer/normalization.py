@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Нормализация URL перед агрегацией
+
+Идентификаторы, UUID и значения параметров запроса сворачиваются
+в шаблоны, что бы один и тот же обработчик не превращался
+в миллионы уникальных URL
+"""
+import re
+
+# Правила по умолчанию: (регулярное выражение, замена), применяются по порядку
+DEFAULT_RULES = [
+    (r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}", "{uuid}"),
+    (r"([?&][^=&#]+)=[^&#]*", r"\1=*"),
+    (r"/\d+(?=[/?#]|$)", "/{id}"),
+]
+# Разделитель регулярного выражения и замены в секции [NORMALIZE] конфига
+RULE_SEPARATOR = " => "
+# Количество запоминаемых результатов нормализации
+CACHE_SIZE = 100_000
+
+
+class UrlNormalizer:
+    """
+    Приводит URL к шаблону последовательным применением
+    заранее скомпилированных правил
+    """
+
+    def __init__(self, rules: list[tuple[str, str]] = None, cache_size: int = CACHE_SIZE):
+        self.rules = list(rules if rules is not None else DEFAULT_RULES)
+        self.compiled = [(re.compile(pattern), replacement) for pattern, replacement in self.rules]
+        self.cache_size = cache_size
+        self._cache: dict[str, str] = {}
+
+    def __call__(self, url: str) -> str:
+        normalized = self._cache.get(url)
+        if normalized is not None:
+            return normalized
+        normalized = url
+        for pattern, replacement in self.compiled:
+            normalized = pattern.sub(replacement, normalized)
+        if len(self._cache) < self.cache_size:
+            self._cache[url] = normalized
+        return normalized
+
+    def __getstate__(self) -> dict:
+        # Кеш не передается в процессы пула и обратно вместе с частичными агрегатами
+        return {"rules": self.rules, "cache_size": self.cache_size}
+
+    def __setstate__(self, state: dict):
+        self.__init__(rules=state["rules"], cache_size=state["cache_size"])
+
+    def __repr__(self):
+        return f"UrlNormalizer({self.rules!r})"
+
+
+def parse_rules(items: list[tuple[str, str]]) -> list[tuple[str, str]]:
+    """
+    Разбирает правила из секции [NORMALIZE] конфига.
+    Каждое правило задается строкой вида
+    `имя = регулярное_выражение => замена`
+    """
+    rules = []
+    for name, value in items:
+        pattern, separator, replacement = value.partition(RULE_SEPARATOR)
+        if not separator:
+            raise ValueError(f'Правило нормализации "{name}" должно иметь вид '
+                             f'"регулярное_выражение{RULE_SEPARATOR}замена"')
+        re.compile(pattern)
+        rules.append((pattern, replacement))
+    return rules
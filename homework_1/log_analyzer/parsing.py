@@ -0,0 +1,554 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Разбор логов nginx в агрегаты
+
+Строки формата ui_short разбираются пачками: несжатый лог
+отображается в память и может разбираться в нескольких процессах,
+gz лог распаковывается в отдельном потоке (или внешней утилитой),
+а пачки разбираются в пуле процессов
+"""
+import gzip
+import logging
+import mmap
+import os
+import queue
+import re
+import shutil
+import subprocess
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import repeat
+from typing import Iterable
+
+from aggregation import LogAggregate, MemoryBudget, MIN_SPILL_URLS, URL_SPILL_FACTOR
+from instrumentation import RunStats
+from normalization import UrlNormalizer
+
+# Допустимый процент ошибок
+ERRORS_PERCENT = 30
+# Период проверки бюджета памяти в строках
+MEMORY_CHECK_ROWS = 4096
+# Размер блока распаковки gz лога
+GZIP_BLOCK_SIZE = 4 * 2 ** 20
+# Размер окна, которым проходится отображенный в память лог
+MMAP_WINDOW_SIZE = 8 * 2 ** 20
+# Период проверки остановки потоком распаковки, ожидающим места в очереди, в секундах
+QUEUE_POLL_INTERVAL = 0.1
+
+# Паттерны
+_http_methods = ["GET", "POST", "HEAD", "OPTIONS", "TRACE",
+                 "DELETE", "PUT", "POST", "PATCH", "CONNECT"]
+_http_method = '|'.join(_http_methods)
+_http_method = rf"(?:{_http_method})"
+_url = rf'"{_http_method} ([\w\W]+) HTTP'
+url_pattern = re.compile(_url)  # URL
+request_time_pattern = re.compile(r"\d*\.\d*$")  # Время запроса
+# Методы HTTP в виде bytes для быстрого разбора строк ui_short
+_http_methods_bytes = frozenset(method.encode() for method in _http_methods)
+
+
+def parse_row(row: str):
+    """Извлекает данные из строки"""
+    address = url_pattern.findall(row)
+    request_time = request_time_pattern.findall(row)
+
+    return address, request_time
+
+
+def parse_row_fast(row: bytes) -> tuple[str, float] | None:
+    """
+    Быстрый разбор строки формата ui_short без декодирования и регулярок:
+    URL берется из первого поля в кавычках ("$request"),
+    время запроса - из последнего поля строки.
+    Возвращает None, если строка не похожа на ui_short или ее разбор
+    мог бы разойтись с регулярками (не ASCII строка, " HTTP" после
+    протокола запроса, лишние символы в конце строки) - такие строки
+    разбирает parse_row_fallback
+    """
+    if not row.isascii():
+        return None
+    request_start = row.find(b'"') + 1
+    request_end = row.find(b'"', request_start)
+    method_end = row.find(b" ", request_start, request_end)
+    protocol_start = row.rfind(b" HTTP", request_start, request_end)
+    if request_end == -1:
+        return None
+    # URL регулярки жадный и заканчивается перед последним " HTTP" строки
+    if not 0 < method_end < protocol_start - 1 or row.find(b" HTTP", protocol_start + 1) != -1:
+        return None
+    if row[request_start:method_end] not in _http_methods_bytes:
+        return None
+    # Как и $ в регулярке, допускается только перевод строки в конце
+    end = len(row) - 1 if row.endswith(b"\n") else len(row)
+    request_time = row[row.rfind(b" ", 0, end) + 1:end]
+    if not request_time.replace(b".", b"", 1).isdigit() or b"." not in request_time:
+        return None
+    return row[method_end + 1:protocol_start].decode("ascii"), float(request_time)
+
+
+def parse_row_fallback(row: bytes, i: int) -> tuple[str, float] | None:
+    """
+    Разбор строки регулярными выражениями,
+    используется для строк, которые не разобрал parse_row_fast
+    """
+    row = row.decode("UTF-8")
+    address, request_time = parse_row(row)
+    if len(address) > 1 or len(request_time) > 1:
+        msg = f"Неверно написанное регулярное выражение, строка {i + 1}"
+        logging.error(msg)
+        raise ValueError(msg)
+    if address and request_time:
+        return address[0], float(request_time[0])
+    return None
+
+
+def parse_lines(rows: Iterable[bytes], run_stats: RunStats, first_row: int = 0):
+    """
+    Генератор пар (URL, время запроса) из строк лога.
+    Битые строки пропускаются и учитываются в run_stats
+    """
+    for i, row in enumerate(rows, first_row):
+        parsed = parse_row_fast(row)
+        if parsed is None:
+            try:
+                parsed = parse_row_fallback(row, i)
+            except ValueError as err:  # в том числе UnicodeDecodeError
+                run_stats.add_bad_line(row, reason=str(err))
+                continue
+            if parsed is None:
+                run_stats.add_bad_line(row, reason="неверный формат строки")
+                continue
+        yield parsed
+
+
+def parse_batch(rows: list[bytes], run_stats: RunStats) -> list[tuple[str, float]]:
+    """
+    Разбирает пачку строк, время относится к этапу parse
+    """
+    started = time.perf_counter()
+    parsed = list(parse_lines(rows, run_stats, first_row=run_stats.total_rows))
+    run_stats.total_rows += len(rows)
+    run_stats.parsed_rows += len(parsed)
+    run_stats.add_time("parse", time.perf_counter() - started)
+    return parsed
+
+
+def gather_rows(batches: Iterable[list[bytes]], log_data: LogAggregate, run_stats: RunStats,
+                memory_budget: MemoryBudget = None):
+    """
+    Добавляет пачки строк лога в агрегат,
+    время разбора и агрегации замеряется по пачкам, а не по строкам.
+    Бюджет памяти проверяется после каждой пачки
+    """
+    for rows in batches:
+        parsed = parse_batch(rows, run_stats)
+        started = time.perf_counter()
+        spill_time = run_stats.stages.get("spill", 0.0)
+        if memory_budget is None:
+            for addr, request_time in parsed:
+                log_data.add(addr, request_time)
+        else:
+            # Пачка может содержать десятки тысяч новых URL,
+            # поэтому бюджет проверяется и внутри нее
+            for position in range(0, len(parsed), MEMORY_CHECK_ROWS):
+                for addr, request_time in parsed[position:position + MEMORY_CHECK_ROWS]:
+                    log_data.add(addr, request_time)
+                memory_budget.check(log_data, run_stats=run_stats)
+        log_data.total_rows += len(rows)
+        spill_time = run_stats.stages.get("spill", 0.0) - spill_time
+        run_stats.add_time("aggregate", time.perf_counter() - started - spill_time)
+        run_stats.progress()
+
+
+def split_rows(batch: bytes | mmap.mmap, start: int = 0, end: int = None) -> list[bytes]:
+    """
+    Делит участок [start, end) буфера на строки (без символа перевода строки)
+    """
+    if end is None:
+        end = len(batch)
+    rows = batch[start:end].split(b"\n")
+    if not rows[-1]:
+        rows.pop()
+    return rows
+
+
+def iter_mapped_rows(buffer: mmap.mmap, start: int, end: int, window: int = MMAP_WINDOW_SIZE):
+    """
+    Генератор строк участка [start, end) отображенного в память лога
+    """
+    for rows in iter_mapped_batches(buffer, start=start, end=end, window=window):
+        yield from rows
+
+
+def iter_mapped_batches(buffer: mmap.mmap, start: int, end: int, window: int = MMAP_WINDOW_SIZE,
+                        run_stats: RunStats = None):
+    """
+    Генератор пачек строк участка [start, end) отображенного в память лога.
+    Буфер проходится окнами по границам строк, каждое окно делится
+    на строки одним вызовом split без построчного чтения файла.
+    Время чтения окон относится к этапу read.
+    Прочитанные страницы отображения отпускаются (MADV_DONTNEED),
+    что бы RSS процесса не рос вместе с размером лога
+    """
+    position = start
+    released = start - start % mmap.PAGESIZE
+    while position < end:
+        window_end = min(position + window, end)
+        if window_end < end:
+            newline = buffer.rfind(b"\n", position, window_end)
+            if newline == -1:
+                # Строка длиннее окна - окно расширяется до ее конца
+                newline = buffer.find(b"\n", window_end, end)
+            window_end = end if newline == -1 else newline + 1
+        started = time.perf_counter()
+        rows = split_rows(buffer, position, window_end)
+        # Строки уже скопированы, страницы окна больше не нужны
+        release_end = window_end - window_end % mmap.PAGESIZE
+        if hasattr(mmap, "MADV_DONTNEED") and release_end > released:
+            buffer.madvise(mmap.MADV_DONTNEED, released, release_end - released)
+            released = release_end
+        if run_stats is not None:
+            run_stats.bytes_read += window_end - position
+            run_stats.add_time("read", time.perf_counter() - started)
+        yield rows
+        position = window_end
+
+
+def iter_gzip_batches(log_path: str, run_stats: RunStats):
+    """
+    Генератор пачек строк gz лога.
+    Время получения распакованных блоков относится к этапу decompress,
+    деление на строки - к этапу read
+    """
+    for batch in split_batches(run_stats.timed(decompress_blocks(log_path), stage="decompress")):
+        started = time.perf_counter()
+        rows = split_rows(batch)
+        run_stats.bytes_read += len(batch)
+        run_stats.add_time("read", time.perf_counter() - started)
+        yield rows
+
+
+def iter_log_batches(log_path: str, start: int = 0, end: int = None, run_stats: RunStats = None):
+    """
+    Генератор пачек строк лога.
+    Несжатый лог отображается в память (mmap), для него можно задать
+    диапазон байт [start, end), границы диапазона должны совпадать
+    с началами строк
+    """
+    run_stats = RunStats() if run_stats is None else run_stats
+    if log_path.endswith(".gz"):
+        yield from iter_gzip_batches(log_path, run_stats=run_stats)
+        return
+    with open(log_path, 'rb') as log:
+        size = os.fstat(log.fileno()).st_size
+        if not size:
+            return
+        end = size if end is None else min(end, size)
+        with mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            yield from iter_mapped_batches(buffer, start=start, end=end, run_stats=run_stats)
+
+
+def read_lines(log_path: str, start: int = 0, end: int = None, run_stats: RunStats = None):
+    """
+    Генератор для парсинга данных построчно: пары (URL, время запроса).
+    Битые строки учитываются в run_stats
+    """
+    run_stats = RunStats() if run_stats is None else run_stats
+    for rows in iter_log_batches(log_path, start=start, end=end, run_stats=run_stats):
+        yield from parse_batch(rows, run_stats)
+
+
+def decompress_blocks(log_path: str, block_size: int = GZIP_BLOCK_SIZE, external: bool = False):
+    """
+    Генератор распакованных блоков gz лога.
+    По умолчанию распаковывает модулем gzip, при external -
+    внешним pigz/zcat, если он доступен
+    """
+    tool = (shutil.which("pigz") or shutil.which("zcat")) if external else None
+    if tool is None:
+        with gzip.open(log_path, 'rb') as log:
+            while block := log.read(block_size):
+                yield block
+        return
+    with subprocess.Popen([tool, "-dc", log_path], stdout=subprocess.PIPE) as process:
+        try:
+            while block := process.stdout.read(block_size):
+                yield block
+        except GeneratorExit:
+            # Чтение прервано - распаковка больше не нужна
+            process.kill()
+            raise
+    if process.returncode:
+        raise IOError(f'Ошибка распаковки "{log_path}" ({tool}), код {process.returncode}')
+
+
+def split_batches(blocks: Iterable[bytes]):
+    """
+    Генератор пачек целых строк из распакованных блоков
+    """
+    tail = b""
+    for block in blocks:
+        block = tail + block
+        last_newline = block.rfind(b"\n")
+        if last_newline == -1:
+            tail = block
+            continue
+        tail = block[last_newline + 1:]
+        yield block[:last_newline + 1]
+    if tail:
+        yield tail
+
+
+def gather_batch(batch: bytes, **aggregate_options) -> tuple[LogAggregate, RunStats]:
+    """
+    Собирает частичный агрегат и статистику по пачке строк лога.
+    aggregate_options - параметры LogAggregate
+    """
+    log_data = LogAggregate(**aggregate_options)
+    run_stats = RunStats()
+    started = time.perf_counter()
+    rows = split_rows(batch)
+    run_stats.bytes_read += len(batch)
+    run_stats.add_time("read", time.perf_counter() - started)
+    gather_rows([rows], log_data=log_data, run_stats=run_stats)
+    return log_data, run_stats
+
+
+def merge_partial(log_data: LogAggregate, run_stats: RunStats, partial_result: tuple[LogAggregate, RunStats],
+                  memory_budget: MemoryBudget = None):
+    """Добавляет частичный агрегат и статистику процесса разбора"""
+    partial_data, partial_stats = partial_result
+    log_data.merge(partial_data)
+    run_stats.merge(partial_stats)
+    if memory_budget is not None:
+        memory_budget.check(log_data, run_stats=run_stats)
+    run_stats.progress()
+
+
+class GzipDecompressor(threading.Thread):
+    """
+    Поток распаковки gz лога: кладет пачки целых строк в ограниченную
+    очередь batches, в конце - None. Ведет свою статистику run_stats,
+    ошибка распаковки сохраняется в errors. Остановленный поток
+    не остается ждать места в очереди
+    """
+
+    def __init__(self, log_path: str, maxsize: int, block_size: int = GZIP_BLOCK_SIZE):
+        super().__init__(daemon=True)
+        self.log_path = log_path
+        self.block_size = block_size
+        self.batches = queue.Queue(maxsize=maxsize)
+        self.stopped = threading.Event()
+        self.errors = []
+        self.run_stats = RunStats()
+
+    def put(self, item) -> bool:
+        """Кладет элемент в очередь, пока разбор не остановлен"""
+        while not self.stopped.is_set():
+            try:
+                self.batches.put(item, timeout=QUEUE_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run(self):
+        # Распаковка во внешнем процессе не занимает GIL потока распаковки
+        blocks = self.run_stats.timed(decompress_blocks(self.log_path, block_size=self.block_size, external=True),
+                                      stage="decompress")
+        try:
+            for batch in split_batches(blocks):
+                if not self.put(batch):
+                    break
+        except Exception as err:
+            self.errors.append(err)
+        finally:
+            # Прерывает распаковку (и внешний процесс), если она не дошла до конца
+            blocks.close()
+            self.put(None)
+
+
+def gather_gzip_pipeline(log_path: str, workers: int, run_stats: RunStats, memory_budget: MemoryBudget = None,
+                         block_size: int = GZIP_BLOCK_SIZE, **aggregate_options) -> LogAggregate:
+    """
+    Конвейерный разбор gz лога: отдельный поток распаковывает лог
+    и кладет пачки целых строк в ограниченную очередь,
+    пачки разбираются в пуле процессов.
+    Частичные агрегаты объединяются в порядке следования пачек.
+    Если разбор прерван ошибкой, поток распаковки останавливается
+    и не остается ждать места в очереди
+    """
+    decompressor = GzipDecompressor(log_path, maxsize=workers * 2, block_size=block_size)
+    decompressor.start()
+    log_data = LogAggregate(**aggregate_options)
+    in_flight = deque()
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            while (batch := decompressor.batches.get()) is not None:
+                in_flight.append(executor.submit(gather_batch, batch, **aggregate_options))
+                if len(in_flight) >= workers * 2:
+                    merge_partial(log_data, run_stats, in_flight.popleft().result(), memory_budget=memory_budget)
+            while in_flight:
+                merge_partial(log_data, run_stats, in_flight.popleft().result(), memory_budget=memory_budget)
+    finally:
+        decompressor.stopped.set()
+        for future in in_flight:
+            future.cancel()
+        decompressor.join()
+    # Статистика потока распаковки добавляется после его завершения
+    run_stats.merge(decompressor.run_stats)
+    if decompressor.errors:
+        raise decompressor.errors[0]
+    return log_data
+
+
+def check_missing_rows(total_rows: int, parsed_rows: int):
+    """
+    Сообщает об ошибке, если пропущено слишком много строк
+    """
+    missing_rows = total_rows - parsed_rows
+    if missing_rows:
+        errors_percent = missing_rows / total_rows * 100
+        if errors_percent >= ERRORS_PERCENT:
+            logging.error(f"Большое количество ({errors_percent:.2f} %) "
+                          f"строк пропущено, они имели неверный формат")
+
+
+def split_log(log_path: str, parts: int) -> list[tuple[int, int]]:
+    """
+    Делит несжатый лог на диапазоны байт по границам строк
+    """
+    size = os.path.getsize(log_path)
+    bounds = [0]
+    with open(log_path, 'rb') as log:
+        for part in range(1, parts):
+            position = max(size * part // parts, bounds[-1])
+            log.seek(position)
+            if position:
+                # Дочитываем до конца текущей строки
+                log.readline()
+            bounds.append(min(log.tell(), size))
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def gather_range(log_path: str, start: int = 0, end: int = None, run_stats: RunStats = None,
+                 memory_budget: MemoryBudget = None, **aggregate_options) -> tuple[LogAggregate, RunStats]:
+    """
+    Собирает частичный агрегат и статистику по диапазону байт лога.
+    aggregate_options - параметры LogAggregate
+    """
+    log_data = LogAggregate(**aggregate_options)
+    run_stats = RunStats() if run_stats is None else run_stats
+    batches = iter_log_batches(log_path, start=start, end=end, run_stats=run_stats)
+    gather_rows(batches, log_data=log_data, run_stats=run_stats, memory_budget=memory_budget)
+    return log_data, run_stats
+
+
+def gather_range_worker(*args, **kwargs) -> tuple[LogAggregate, RunStats]:
+    """
+    gather_range в процессе пула: файлы серий, сброшенных на диск,
+    переходят вместе с частичным агрегатом к основному процессу
+    """
+    log_data, run_stats = gather_range(*args, **kwargs)
+    log_data.release_runs()
+    return log_data, run_stats
+
+
+def gather_log_data_parallel(log_path: str, workers: int, run_stats: RunStats,
+                             memory_budget: MemoryBudget = None, **aggregate_options) -> LogAggregate:
+    """
+    Параллельно разбирает несжатый лог в пуле процессов.
+    Частичные агрегаты объединяются в порядке следования диапазонов,
+    поэтому результат совпадает с однопроцессным разбором.
+    Бюджет памяти делится поровну между процессами пула и основным процессом
+    """
+    # Диапазонов больше, чем процессов, для равномерной загрузки
+    ranges = split_log(log_path, parts=workers * 4)
+    log_data = LogAggregate(**aggregate_options)
+    worker_budget = None
+    if memory_budget is not None:
+        worker_budget = memory_budget.split(workers + 1)
+        memory_budget = memory_budget.split(workers + 1, baseline=memory_budget.baseline)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        partials = executor.map(partial(gather_range_worker, memory_budget=worker_budget, **aggregate_options),
+                                repeat(log_path),
+                                (start for start, _ in ranges),
+                                (end for _, end in ranges))
+        for partial_result in partials:
+            merge_partial(log_data, run_stats, partial_result, memory_budget=memory_budget)
+    return log_data
+
+
+def gather_log_data(log_path: str, workers: int = 1, run_stats: RunStats = None,
+                    memory_budget: MemoryBudget = None, **aggregate_options) -> LogAggregate:
+    """
+    Собирает данные из лога в нужную структуру.
+    Для каждого URL хранится компактная запись (количество, сумма,
+    максимум и скетч медианы), поэтому память зависит только
+    от количества уникальных URL.
+    aggregate_options - параметры LogAggregate (exact, max_urls, normalizer).
+    При workers > 1 несжатый лог разбирается в нескольких процессах,
+    а gz лог - конвейером распаковки и разбора.
+    Счетчики строк и время этапов добавляются в run_stats.
+    memory_budget ограничивает память агрегата, при разборе несжатого лога
+    в пуле - и в процессах пула (конвейер gz лога держит в процессе пула
+    только одну пачку строк)
+    """
+    started = time.perf_counter()
+    run_stats = RunStats() if run_stats is None else run_stats
+    total_rows, parsed_rows = run_stats.total_rows, run_stats.parsed_rows
+    if workers > 1 and log_path.endswith(".gz"):
+        log_data = gather_gzip_pipeline(log_path, workers=workers, run_stats=run_stats,
+                                        memory_budget=memory_budget, **aggregate_options)
+    elif workers > 1:
+        log_data = gather_log_data_parallel(log_path, workers=workers, run_stats=run_stats,
+                                            memory_budget=memory_budget, **aggregate_options)
+    else:
+        log_data, _ = gather_range(log_path, run_stats=run_stats, memory_budget=memory_budget,
+                                   **aggregate_options)
+    check_missing_rows(total_rows=run_stats.total_rows - total_rows,
+                       parsed_rows=run_stats.parsed_rows - parsed_rows)
+    log_throughput(log_path, log_data, elapsed=time.perf_counter() - started, workers=workers)
+    return log_data
+
+
+def get_aggregate_options(config: dict) -> dict:
+    """
+    Параметры агрегата (LogAggregate) из конфигурации
+    """
+    normalizer = None
+    if config.get("NORMALIZE_URLS") or config.get("NORMALIZE_RULES"):
+        normalizer = UrlNormalizer(rules=config.get("NORMALIZE_RULES"))
+    return {"exact": config.get("EXACT_MEDIAN", False),
+            "max_urls": config.get("MAX_URLS", 0),
+            "normalizer": normalizer,
+            "histogram_bounds": tuple(config.get("LATENCY_BUCKETS", ()))}
+
+
+def get_memory_budget(config: dict) -> MemoryBudget | None:
+    """
+    Бюджет памяти агрегации из конфигурации (None - без ограничения):
+    MEMORY_LIMIT_MB ограничивает память, MAX_URLS - количество URL в памяти
+    """
+    limit = config.get("MEMORY_LIMIT_MB", 0)
+    max_urls = config.get("MAX_URLS", 0)
+    if not limit and not max_urls:
+        return None
+    return MemoryBudget(limit=limit * 2 ** 20 if limit else None, directory=config.get("SPILL_DIR"),
+                        url_limit=max(MIN_SPILL_URLS, max_urls * URL_SPILL_FACTOR) if max_urls else None)
+
+
+def log_throughput(log_path: str, log_data: LogAggregate, elapsed: float, workers: int):
+    """
+    Пишет в лог скорость разбора, что бы сравнивать
+    однопроцессный и параллельный режимы
+    """
+    elapsed = max(elapsed, 1e-9)
+    megabytes = os.path.getsize(log_path) / 2 ** 20
+    logging.info(f'Лог "{log_path}" разобран за {elapsed:.2f} с, процессов: {workers}, '
+                 f'{log_data.total_rows / elapsed:.0f} строк/с, {megabytes / elapsed:.2f} МБ/с')
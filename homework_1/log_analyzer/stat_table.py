@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Таблица отчета по агрегату
+
+Строка таблицы - статистика одного URL: количество запросов,
+время (среднее, максимум, сумма, медиана, перцентили) и гистограмма.
+Для отчета отбираются REPORT_SIZE URL с наибольшим суммарным временем,
+при установленном numpy колонки считаются векторно
+"""
+import heapq
+from array import array
+from typing import Iterable
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from aggregation import LogAggregate, MICROSECONDS, OVERFLOW_URL, to_seconds
+from log_index import LogFile
+
+
+def get_percentile_columns(percentiles: Iterable[float]) -> list[str]:
+    """Имена колонок перцентилей: 90 -> time_p90, 99.9 -> time_p99.9"""
+    return [f"time_p{percentile:g}" for percentile in percentiles]
+
+
+def get_histogram_columns(histogram_bounds: Iterable[float]) -> list[str]:
+    """
+    Имена колонок гистограммы: по колонке на каждую границу (запросы не дольше нее)
+    и колонка для запросов дольше последней границы
+    """
+    bounds = list(histogram_bounds)
+    if not bounds:
+        return []
+    return [f"hist_le_{bound:g}" for bound in bounds] + [f"hist_gt_{bounds[-1]:g}"]
+
+
+def prepare_stat_table(log_data: LogAggregate, report_size: int = None,
+                       vectorized: bool = True, percentiles: Iterable[float] = ()) -> list[dict]:
+    """
+    Подготавливает таблицу для веба.
+    Если задан report_size, полная статистика (медиана и т.д.) считается
+    только для report_size URL с наибольшим суммарным временем,
+    остальные URL учитываются только в общих суммах.
+    percentiles - перцентили времени запроса (в процентах) для колонок time_p<N>,
+    если у агрегата заданы границы гистограммы, добавляются колонки hist_*.
+    Если у агрегата задан лимит URL, редкие URL сначала сворачиваются
+    (fold_rare_urls). Если установлен numpy, таблица считается по колонкам (vectorized)
+    """
+    log_data.fold_rare_urls()
+    percentiles = list(percentiles)
+    if vectorized and np is not None and log_data.urls and not log_data.runs:
+        return prepare_stat_table_numpy(log_data, report_size=report_size, percentiles=percentiles)
+
+    # Медиана и перцентили считаются за один проход по значениям URL
+    quantiles = [0.5] + [percentile / 100 for percentile in percentiles]
+    percentile_columns = get_percentile_columns(percentiles)
+    histogram_columns = get_histogram_columns(log_data.histogram_bounds)
+
+    def calculate_row(item: tuple) -> dict:
+        """
+        Подсчитывает статистику в строке
+        """
+        url, url_stat = item
+        median, *values = url_stat.quantiles.quantiles(quantiles)
+        row = {"url": url,
+               "count": url_stat.count,
+               "time_avg": to_seconds(url_stat.time_sum / url_stat.count),
+               "time_max": to_seconds(url_stat.time_max),
+               "time_sum": to_seconds(url_stat.time_sum),
+               "time_med": to_seconds(median),
+               "count_perc": url_stat.count / total_rows * 100,
+               "time_perc": url_stat.time_sum / all_requests_time * 100}
+        row.update(zip(percentile_columns, map(to_seconds, values)))
+        if histogram_columns:
+            row.update(zip(histogram_columns, url_stat.histogram))
+        return row
+
+    total_rows = log_data.total_rows
+    all_requests_time = log_data.time_sum()  # Суммарное время всех запросов
+
+    def by_time_sum(item: tuple) -> int:
+        """Ключ выбора URL - суммарное время запросов"""
+        return item[1].time_sum
+
+    # Если часть агрегата сброшена на диск, items() сливает серии потоком,
+    # а nlargest держит в памяти только report_size записей
+    items = log_data.items()
+    if report_size is not None and (log_data.runs or report_size < len(log_data.urls)):
+        # nlargest выбирает те же строки и в том же порядке, что и полная сортировка
+        top_items = heapq.nlargest(report_size, items, key=by_time_sum)
+    else:
+        top_items = sorted(items, key=by_time_sum, reverse=True)
+    return [calculate_row(item) for item in top_items]
+
+
+def select_top_indexes(values: "np.ndarray", size: int = None) -> "np.ndarray":
+    """
+    Индексы size наибольших значений по убыванию,
+    при равенстве значений - в порядке индексов (как устойчивая сортировка).
+    Как и heapq.nlargest, при size <= 0 возвращает пустой массив
+    """
+    if size is not None and size <= 0:
+        return np.empty(0, dtype=np.intp)
+    if size is None or size >= len(values):
+        return np.argsort(-values, kind="stable")
+    # Частичный выбор: size-е по величине значение - порог
+    threshold = np.partition(values, len(values) - size)[len(values) - size]
+    above = np.flatnonzero(values > threshold)
+    ties = np.flatnonzero(values == threshold)[:size - len(above)]
+    selected = np.sort(np.concatenate([above, ties]))
+    return selected[np.argsort(-values[selected], kind="stable")]
+
+
+def join_segments(url_stats: list, selected: "np.ndarray") -> tuple["np.ndarray", "np.ndarray"]:
+    """
+    Времена запросов выбранных URL одним массивом (сегмент на URL)
+    и длины сегментов
+    """
+    joined = array("q")
+    lengths = np.empty(len(selected), dtype=np.int64)
+    for segment, i in enumerate(selected):
+        times = url_stats[i].quantiles.values
+        joined.extend(times)
+        lengths[segment] = len(times)
+    return np.frombuffer(joined, dtype=np.int64), lengths
+
+
+def sort_segments(values: "np.ndarray", lengths: "np.ndarray") -> "np.ndarray":
+    """
+    Сортирует значения внутри каждого сегмента, сегменты остаются на своих местах
+    """
+    segments = np.repeat(np.arange(len(lengths), dtype=np.int64), lengths)
+    low_value = int(values.min())
+    span = int(values.max()) - low_value + 1
+    if span * len(lengths) < 2 ** 62:
+        # Ключ (URL, время) помещается в int64 - достаточно одной сортировки чисел
+        return np.sort(segments * span + (values - low_value)) - segments * span + low_value
+    return values[np.lexsort((values, segments))]
+
+
+def segment_quantiles(url_stats: list, selected: "np.ndarray", quantiles: list[float]) -> "np.ndarray":
+    """
+    Точные квантили выбранных URL (строка результата на каждый квантиль):
+    времена запросов собираются в один массив с индексом смещений,
+    массив сортируется по (URL, время) одной сортировкой
+    и квантили интерполируются внутри каждого сегмента
+    """
+    values, lengths = join_segments(url_stats, selected)
+    sorted_values = sort_segments(values, lengths)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    result = np.empty((len(quantiles), len(selected)), dtype=np.float64)
+    for row, q in enumerate(quantiles):
+        # Та же интерполяция, что и в ExactQuantiles.quantiles
+        position = q * (lengths - 1)
+        low_position = np.floor(position).astype(np.int64)
+        low = sorted_values[offsets + low_position]
+        high = sorted_values[offsets + np.ceil(position).astype(np.int64)]
+        result[row] = low + (high - low) * (position - low_position)
+    return result
+
+
+def get_histogram_columns_numpy(url_stats: list, selected: "np.ndarray",
+                                histogram_bounds: Iterable[float]) -> dict[str, list]:
+    """
+    Колонки гистограммы выбранных URL (пустой словарь без гистограммы)
+    """
+    histogram_columns = get_histogram_columns(histogram_bounds)
+    if not histogram_columns:
+        return {}
+    histograms = np.array([url_stats[i].histogram for i in selected], dtype=np.int64)
+    histograms = histograms.reshape(len(selected), len(histogram_columns))
+    return {name: column.tolist() for name, column in zip(histogram_columns, histograms.T)}
+
+
+def prepare_stat_table_numpy(log_data: LogAggregate, report_size: int = None,
+                             percentiles: list[float] = ()) -> list[dict]:
+    """
+    Подготавливает таблицу для веба колоночными операциями numpy.
+    Результат совпадает с prepare_stat_table(vectorized=False)
+    """
+    urls = list(log_data.urls)
+    url_stats = list(log_data.urls.values())
+    counts = np.fromiter((url_stat.count for url_stat in url_stats), dtype=np.int64, count=len(urls))
+    time_sums = np.fromiter((url_stat.time_sum for url_stat in url_stats), dtype=np.int64, count=len(urls))
+    all_requests_time = int(time_sums.sum())  # Суммарное время всех запросов
+    selected = select_top_indexes(time_sums, size=report_size)
+    if not selected.size:
+        return []
+    counts, time_sums = counts[selected], time_sums[selected]
+    time_maxes = np.fromiter((url_stats[i].time_max for i in selected), dtype=np.int64,
+                             count=len(selected))
+    quantiles = [0.5] + [percentile / 100 for percentile in percentiles]
+    if log_data.exact:
+        values = segment_quantiles(url_stats, selected, quantiles)
+    else:
+        values = np.array([url_stats[i].quantiles.quantiles(quantiles) for i in selected],
+                          dtype=np.float64).reshape(len(selected), len(quantiles)).T
+    columns = {"url": [urls[i] for i in selected],
+               "count": counts.tolist(),
+               "time_avg": (time_sums / counts / MICROSECONDS).tolist(),
+               "time_max": (time_maxes / MICROSECONDS).tolist(),
+               "time_sum": (time_sums / MICROSECONDS).tolist(),
+               "time_med": (values[0] / MICROSECONDS).tolist(),
+               "count_perc": (counts / log_data.total_rows * 100).tolist(),
+               "time_perc": (time_sums / all_requests_time * 100).tolist()}
+    for name, column in zip(get_percentile_columns(percentiles), values[1:]):
+        columns[name] = (column / MICROSECONDS).tolist()
+    columns.update(get_histogram_columns_numpy(url_stats, selected, log_data.histogram_bounds))
+    return [dict(zip(columns, row)) for row in zip(*columns.values())]
+
+
+def add_daily_columns(stat: list[dict], log_files: list[LogFile], logs_data: list[LogAggregate],
+                      log_data: LogAggregate = None):
+    """
+    Добавляет в строки таблицы количество и суммарное время запросов по дням.
+    log_data - итоговый агрегат: для строки OVERFLOW_URL по дням суммируются
+    URL, не оставшиеся в нем после сворачивания редких URL.
+    Если агрегат дня сброшен на диск, его серии читаются один раз
+    """
+    overflow_rows = [row for row in stat if row["url"] == OVERFLOW_URL]
+    for log_file, day_data in zip(log_files, logs_data):
+        date = log_file.date.strftime("%Y.%m.%d")
+        day_urls = day_data.urls
+        if day_data.runs:
+            rows_urls = {row["url"] for row in stat}
+            day_urls = {url: url_stat for url, url_stat in day_data.items() if url in rows_urls}
+        for row in stat:
+            url_stat = day_urls.get(row["url"])
+            row[f"count_{date}"] = url_stat.count if url_stat else 0
+            row[f"time_sum_{date}"] = to_seconds(url_stat.time_sum) if url_stat else 0.0
+        if overflow_rows and log_data is not None:
+            count = time_sum = 0
+            for url, url_stat in day_data.items():
+                if url == OVERFLOW_URL or url not in log_data.urls:
+                    count += url_stat.count
+                    time_sum += url_stat.time_sum
+            for row in overflow_rows:
+                row[f"count_{date}"] = count
+                row[f"time_sum_{date}"] = to_seconds(time_sum)
@@ -1,10 +1,46 @@
+import gzip
+import json
+import mmap
+import pickle
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
 import unittest
 from datetime import datetime
+from operator import itemgetter
 from pathlib import Path
+from statistics import median
 
-from log_analyzer import (find_last_log, config, create_report_folders_tree_is_not_exists,
-                          write_html_report, LogFile, get_report_path)
+from aggregation import LogAggregate, MemoryBudget, OVERFLOW_URL, UrlStat, merge_log_data
+from follow import LogFollower
+from instrumentation import RunStats
+from log_index import LogFile
+from merge import get_partial_meta, write_partial_aggregate, merge_partial_aggregates
+from normalization import UrlNormalizer
+from parsing import (gather_log_data, split_batches, parse_row, parse_row_fast, iter_mapped_rows,
+                     gather_gzip_pipeline, parse_row_fallback, parse_lines, get_memory_budget)
+from stat_table import np, prepare_stat_table, add_daily_columns
+from writers import (pa, pq, REPORT_WRITERS, create_report_folders_tree_is_not_exists, write_html_report,
+                     get_report_path, write_reports)
+from log_analyzer import (find_last_log, config, load_log_data, find_logs, get_log_index, report_up_to_date,
+                          convert_config_types, load_report_data)
+
+LOG_ROW = ('1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET {url} HTTP/1.1" 200 927 "-" '
+           '"Lynx/2.8.8dev.9 libwww-FM/2.14" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" {time}\n')
+
+
+def make_log_rows(count: int = 300) -> list[str]:
+    """
+    Формирует строки лога в формате ui_short
+    """
+    rows = []
+    for i in range(count):
+        rows.append(LOG_ROW.format(url=f"/api/v2/banner/{i % 7}", time=f"{(i * 37) % 1000 / 1000:.3f}"))
+        if i % 50 == 0:
+            rows.append("битая строка\n")
+    return rows
 
 
 class Tests(unittest.TestCase):
@@ -32,6 +68,112 @@ class Tests(unittest.TestCase):
                 # Удаляем каталог если не присутствовал ранее
                 catalog.rmdir()
 
+    def test_find_logs_by_period(self):
+        """
+        Выбор логов за период и N последних логов
+        """
+        names = ["nginx-access-ui.log-20200101", "nginx-access-ui.log-20200102.gz",
+                 "nginx-access-ui.log-20200103", "nginx-access-ui.log-20200104.bz2"]
+        with tempfile.TemporaryDirectory() as catalog:
+            for name in names:
+                (Path(catalog) / name).write_bytes(b"")
+            log_config = {"LOG_DIR": catalog}
+            period = find_logs(log_config, date_from="20200102", date_to="20200110")
+            self.assertEqual([log.date.day for log in period], [2, 3])
+            last = find_logs(log_config, last=2)
+            self.assertEqual([Path(log.path).name for log in last], names[1:3])
+            self.assertEqual(find_logs(log_config, date_to="20191231"), [])
+            self.assertEqual(find_logs(log_config, last=0), [])
+            # Без индекса выбираются те же логи, что и по индексу
+            log_index = get_log_index(dict(log_config, CACHE_DIR=str(Path(catalog) / "cache")))
+            for query in ({"last": 1}, {"last": 3}, {"date_from": "20200102"}, {"date_to": "20200103", "last": 1}):
+                self.assertEqual(find_logs(log_config, **query), find_logs(log_config, log_index=log_index, **query))
+
+    def test_log_index(self):
+        """
+        Индекс логов: поиск как без индекса, дозапись новых логов
+        и проверка актуальности отчета
+        """
+        names = ["nginx-access-ui.log-20200101", "nginx-access-ui.log-20200102.gz",
+                 "nginx-access-ui.log-20200103", "nginx-access-ui.log-20200104.bz2"]
+        with tempfile.TemporaryDirectory() as catalog:
+            log_dir = Path(catalog) / "log"
+            log_dir.mkdir()
+            for name in names:
+                (log_dir / name).write_bytes(b"")
+            log_config = {"LOG_DIR": str(log_dir), "CACHE_DIR": str(Path(catalog) / "cache"), "REPORT_DIR": catalog}
+            log_index = get_log_index(log_config)
+            for query in [{"last": 2}, {"date_from": "20200102", "date_to": "20200110"}, {"date_to": "20191231"}]:
+                self.assertEqual(find_logs(log_config, log_index=log_index, **query),
+                                 find_logs(log_config, **query))
+            (log_dir / "nginx-access-ui.log-20200105").write_bytes(b"row\n")
+            log_index = get_log_index(log_config)
+            self.assertEqual(find_last_log(log_config, log_index=log_index).date, datetime(2020, 1, 5))
+            self.assertEqual(len(list(Path(log_config["CACHE_DIR"]).iterdir())), 1)
+
+            log_files = find_logs(log_config, log_index=log_index, date_from="20200103")
+            report_path = get_report_path(log_config, log_files[-1], first_log=log_files[0])
+            self.assertEqual(Path(report_path).parent, Path(catalog))
+            self.assertFalse(report_up_to_date(log_config, log_files, log_index=log_index))
+            Path(report_path).write_text("report")
+            log_index.record_report(report_path, [log_file.path for log_file in log_files])
+            log_index.save()
+            log_index = get_log_index(log_config)
+            self.assertTrue(report_up_to_date(log_config, log_files, log_index=log_index))
+            with open(log_files[-1].path, "ab") as log:
+                log.write(b"row\n")
+            self.assertFalse(report_up_to_date(log_config, log_files, log_index=log_index))
+
+    def test_log_follower(self):
+        """
+        Слежение за логом: дописанные строки, неполная строка, ротация,
+        продолжение с сохраненного смещения и публикация отчетов
+        """
+        rows = make_log_rows(20)
+        with tempfile.TemporaryDirectory() as catalog:
+            live_log = Path(catalog) / "nginx-access-ui.log"
+            live_log.write_text("".join(rows), encoding="UTF-8")
+            follow_config = dict(config, LIVE_LOG=str(live_log), CACHE_DIR=catalog, REPORT_DIR=catalog,
+                                 FOLLOW_INTERVAL=10, FOLLOW_WINDOWS=[10, 60])
+            follower = LogFollower(follow_config)
+            # Без сохраненного состояния лог читается с конца
+            self.assertEqual(follower.poll(now=100), 0)
+            with open(live_log, "a", encoding="UTF-8") as log:
+                log.write("".join(rows[:5]) + rows[5][:10])
+            self.assertEqual(follower.poll(now=100), 5)
+            with open(live_log, "a", encoding="UTF-8") as log:
+                log.write(rows[5][10:])
+            self.assertEqual(follower.poll(now=125), 1)
+
+            live_log.rename(Path(catalog) / "nginx-access-ui.log-20200101")
+            live_log.write_text("".join(rows[:3]), encoding="UTF-8")
+            self.assertEqual(follower.poll(now=125), 3)
+            follower.log.close()
+
+            with open(live_log, "a", encoding="UTF-8") as log:
+                log.write("".join(rows[:2]))
+            resumed = LogFollower(follow_config)
+            self.assertEqual(resumed.poll(now=130), 2)
+            resumed.log.close()
+
+            paths = follower.publish(now=129)
+            self.assertEqual([Path(path).name for path in paths],
+                             ["report-live-10s.html", "report-live-60s.html"])
+            windows = [sum(bucket.total_rows for start, bucket in follower.buckets
+                           if start > 129 - window - 10) for window in (10, 60)]
+            self.assertEqual(windows, [4, 9])
+
+    def test_config_values_are_checked(self):
+        """
+        Недопустимые значения конфигурации отвергаются при чтении
+        """
+        self.assertEqual(convert_config_types({"FOLLOW_INTERVAL": "5"}), {"FOLLOW_INTERVAL": 5})
+        self.assertEqual(convert_config_types({"PERCENTILES": "0, 99.9, 100"}), {"PERCENTILES": [0, 99.9, 100]})
+        for key, value in (("FOLLOW_INTERVAL", "0"), ("FOLLOW_INTERVAL", "-1"), ("FOLLOW_WINDOWS", "60, 0"),
+                           ("PERCENTILES", "90, 101"), ("PERCENTILES", "-5")):
+            with self.assertRaises(ValueError):
+                convert_config_types({key: value})
+
     def test_create_folder_tree(self):
         """
         Создание древа каталогов
@@ -52,17 +194,609 @@ class Tests(unittest.TestCase):
         config['LOG_DIR'] = log_dir
         last_log = LogFile(date=datetime.strptime("2020-01-01", "%Y-%m-%d"),
                            path="nginx-access-ui.log-20200101")
-        stat = [{'one': 1}, {"two": 2}]
-        report_path = get_report_path(last_log=last_log)
+        stat = [{"url": f"/url/{i}", "count": i} for i in range(25)]
+        report_path = get_report_path(config, last_log=last_log)
         report_path = Path(report_path)
         catalog_path = report_path.parent
+        data_path = catalog_path / "report-2020.01.01_data"
         try:
-            write_html_report(stat=stat, config=config, last_log=last_log)
+            write_html_report(stat=stat, config=dict(config, REPORT_CHUNK_SIZE=10), last_log=last_log)
             self.assertTrue(report_path.exists(), "Не создается HTML файл с отчетом")
+            self.assertIn('"chunks": 3', report_path.read_text(encoding="UTF-8"))
+            rows = []
+            for i, chunk_path in enumerate(sorted(data_path.iterdir())):
+                chunk = chunk_path.read_text(encoding="UTF-8")
+                prefix = f"reportChunk({i}, "
+                self.assertTrue(chunk.startswith(prefix))
+                rows += json.loads(chunk[len(prefix):chunk.rindex(")")])
+            self.assertEqual(rows, stat)
         finally:
             report_path.unlink()
+            shutil.rmtree(data_path, ignore_errors=True)
             self._delete_folders_tree(catalog_path)
 
+    def test_gather_log_data_exact_median(self):
+        """
+        Точная медиана совпадает с statistics.median
+        """
+        rows = make_log_rows()
+        with tempfile.TemporaryDirectory() as catalog:
+            path = Path(catalog) / "nginx-access-ui.log-20200101"
+            path.write_text("".join(rows), encoding="UTF-8")
+            log_data = gather_log_data(str(path), exact=True)
+        self.assertEqual(log_data.total_rows, len(rows))
+        stat = {row["url"]: row for row in prepare_stat_table(log_data)}
+        times = [float(row.split()[-1]) for row in rows if row.startswith("1.196")]
+        banner_times = times[3::7]
+        self.assertEqual(stat["/api/v2/banner/3"]["count"], len(banner_times))
+        self.assertAlmostEqual(stat["/api/v2/banner/3"]["time_med"], median(banner_times))
+        self.assertAlmostEqual(stat["/api/v2/banner/3"]["time_sum"], sum(banner_times))
+
+    def test_parallel_gather_matches_single_process(self):
+        """
+        Параллельный разбор дает ту же таблицу, что и однопроцессный
+        """
+        with tempfile.TemporaryDirectory() as catalog:
+            path = Path(catalog) / "nginx-access-ui.log-20200101"
+            path.write_text("".join(make_log_rows(1000)), encoding="UTF-8")
+            for exact, max_urls in ((False, 0), (True, 0), (False, 4)):
+                single = prepare_stat_table(gather_log_data(str(path), exact=exact, max_urls=max_urls))
+                parallel = prepare_stat_table(gather_log_data(str(path), exact=exact, max_urls=max_urls,
+                                                              workers=3))
+                self.assertEqual(single, parallel)
+
+    def test_gzip_pipeline_matches_single_process(self):
+        """
+        Конвейерный разбор gz лога дает ту же таблицу, что и однопроцессный
+        """
+        with tempfile.TemporaryDirectory() as catalog:
+            path = Path(catalog) / "nginx-access-ui.log-20200101.gz"
+            with gzip.open(path, "wt", encoding="UTF-8") as log:
+                log.write("".join(make_log_rows(1000)))
+            single = prepare_stat_table(gather_log_data(str(path)))
+            pipeline = prepare_stat_table(gather_log_data(str(path), workers=2))
+        self.assertEqual(single, pipeline)
+
+    def test_gzip_pipeline_stops_on_error(self):
+        """
+        Ошибка при объединении частичных агрегатов не оставляет
+        поток распаковки ждать места в очереди
+        """
+        class FailingBudget:
+            def check(self, log_data, run_stats=None):
+                raise RuntimeError("объединение прервано")
+
+        errors = []
+
+        def run():
+            try:
+                gather_gzip_pipeline(str(path), workers=2, run_stats=RunStats(),
+                                     memory_budget=FailingBudget(), block_size=1024)
+            except RuntimeError as err:
+                errors.append(err)
+
+        with tempfile.TemporaryDirectory() as catalog:
+            path = Path(catalog) / "nginx-access-ui.log-20200101.gz"
+            with gzip.open(path, "wt", encoding="UTF-8") as log:
+                log.write("".join(make_log_rows(2000)))
+            threads_before = threading.active_count()
+            pipeline = threading.Thread(target=run)
+            pipeline.start()
+            pipeline.join(timeout=60)
+            self.assertFalse(pipeline.is_alive(), "Конвейер завис после ошибки")
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(threading.active_count(), threads_before)
+
+    def test_split_batches(self):
+        """
+        Пачки состоят только из целых строк
+        """
+        blocks = [b"one\ntw", b"o\nthr", b"ee", b"\nfour"]
+        batches = list(split_batches(blocks))
+        self.assertEqual(batches, [b"one\n", b"two\n", b"three\n", b"four"])
+
+    def test_mapped_rows_match_file_rows(self):
+        """
+        Строки отображенного в память лога совпадают со строками файла
+        при любом размере окна
+        """
+        content = "".join(make_log_rows(30)).encode("UTF-8") + b"\n\n" + b"x" * 500 + b"\nlast"
+        with tempfile.TemporaryDirectory() as catalog:
+            path = Path(catalog) / "nginx-access-ui.log-20200101"
+            path.write_bytes(content)
+            with open(path, "rb") as log:
+                expected = [row.rstrip(b"\n") for row in log]
+                with mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                    for window in (7, 100, 10_000):
+                        rows = list(iter_mapped_rows(buffer, start=0, end=len(content), window=window))
+                        self.assertEqual(rows, expected)
+
+    def test_parse_row_fast_matches_regex(self):
+        """
+        Быстрый разбор строк совпадает с разбором регулярками,
+        неподходящие строки отдаются на разбор регуляркам
+        """
+        for row in make_log_rows(100):
+            address, request_time = parse_row(row)
+            parsed = parse_row_fast(row.encode("UTF-8"))
+            if address and request_time:
+                self.assertEqual(parsed, (address[0], float(request_time[0])))
+            else:
+                self.assertIsNone(parsed)
+        self.assertIsNone(parse_row_fast(b'1.1.1.1 - - [x] "0" 400 0 "-" "-" "-" "-" "-" 0.001\n'))
+
+    def test_parse_row_fast_edge_cases(self):
+        """
+        На строках с кавычками, пробелами и " HTTP" внутри полей
+        быстрый разбор либо совпадает с регулярками, либо отдает строку им
+        """
+        prefix = '1.1.1.1 -  - [29/Jun/2017:03:50:22 +0300] '
+        rows = [
+            prefix + '"GET /a"b HTTP/1.1" 200 1 "-" "-" "-" "-" "-" 0.100',
+            prefix + '"GET /a b HTTP/1.1" 200 1 "-" "-" "-" "-" "-" 0.100',
+            prefix + '"GET /a HTTP/1.1 /b HTTP/1.0" 200 1 "-" "-" "-" "-" "-" 0.100',
+            prefix + '"GET /a HTTP/1.1" 200 1 "-" "Bot HTTP client" "-" "-" "-" 0.100',
+            prefix + '"GET  HTTP/1.1" 200 1 "-" "-" "-" "-" "-" 0.100',
+            prefix + '"GET /a HTTP/1.1" 200 1 "-" "-" "-" "-" "-" 0.100 ',
+            prefix + '"GET /a HTTP/1.1" 200 1 "-" "-" "-" "-" "-" 0.100\r',
+            prefix + '"GET /a HTTP/1.1" 200 1 "-" "-" "-" "-" "-" x0.100',
+            prefix + '"GET /a HTTP/1.1" 200 1 "-" "-" "-" "-" "-" .',
+            prefix + '"GET /a HTTP/1.1" 200 1 "-" "-" "-" "-" "-" 1.',
+            prefix + '"GET /ы HTTP/1.1" 200 1 "-" "-" "-" "-" "-" 0.100',
+            prefix + '"GET /a HTTP/1.1" 200 1 "-" "Мозилла" "-" "-" "-" 0.100',
+            '1.1.1.1 "-" "GET /a HTTP/1.1" 200 1 "-" "-" "-" "-" "-" 0.100',
+            'GET /a HTTP/1.1 0.100',
+            '"GET /a HTTP/1.1 0.100',
+        ]
+        for row in rows:
+            data = row.encode("UTF-8")
+            try:
+                expected = parse_row_fallback(data, 0)
+            except ValueError:
+                expected = None
+            fast = parse_row_fast(data)
+            if fast is not None:
+                self.assertEqual(fast, expected, row)
+            parsed = list(parse_lines([data], RunStats()))
+            self.assertEqual(parsed, [] if expected is None else [expected], row)
+
+    def test_log_data_cache(self):
+        """
+        Агрегат лога сохраняется в кеш и пересчитывается при изменении лога
+        """
+        rows = make_log_rows(100)
+        with tempfile.TemporaryDirectory() as catalog:
+            path = Path(catalog) / "nginx-access-ui.log-20200101"
+            path.write_text("".join(rows), encoding="UTF-8")
+            log_file = LogFile(date=datetime(2020, 1, 1), path=str(path))
+            cache_config = {"CACHE_DIR": str(Path(catalog) / "cache")}
+            log_data = load_log_data(log_file, config=cache_config)
+            cache_files = list(Path(cache_config["CACHE_DIR"]).iterdir())
+            self.assertEqual(len(cache_files), 1)
+            cached = load_log_data(log_file, config=cache_config)
+            self.assertEqual(prepare_stat_table(log_data), prepare_stat_table(cached))
+
+            with open(path, "a", encoding="UTF-8") as log:
+                log.write(rows[0])
+            changed = load_log_data(log_file, config=cache_config)
+            self.assertEqual(changed.total_rows, len(rows) + 1)
+            new_cache_files = list(Path(cache_config["CACHE_DIR"]).iterdir())
+            self.assertEqual(len(new_cache_files), 1)
+            self.assertNotEqual(cache_files, new_cache_files)
+
+    def test_log_data_cache_keeps_other_logs(self):
+        """
+        Обновление агрегата лога не удаляет агрегаты других логов
+        за ту же дату и агрегаты с другими настройками
+        """
+        rows = make_log_rows(50)
+        with tempfile.TemporaryDirectory() as catalog:
+            cache_dir = Path(catalog) / "cache"
+            log_files = []
+            for log_dir, name in (("one", "nginx-access-ui.log-20200101"),
+                                  ("one", "nginx-access-ui.log-20200101.gz"),
+                                  ("two", "nginx-access-ui.log-20200101")):
+                path = Path(catalog) / log_dir / name
+                path.parent.mkdir(exist_ok=True)
+                opener = gzip.open if name.endswith(".gz") else open
+                with opener(path, "wt", encoding="UTF-8") as log:
+                    log.write("".join(rows))
+                log_files.append(LogFile(date=datetime(2020, 1, 1), path=str(path)))
+            configs = [{"CACHE_DIR": str(cache_dir)}, {"CACHE_DIR": str(cache_dir), "EXACT_MEDIAN": True}]
+            for log_file in log_files:
+                for cache_config in configs:
+                    load_log_data(log_file, config=cache_config)
+            cache_files = set(cache_dir.iterdir())
+            self.assertEqual(len(cache_files), len(log_files) * len(configs))
+
+            with open(log_files[0].path, "a", encoding="UTF-8") as log:
+                log.write(rows[0])
+            load_log_data(log_files[0], config=configs[0])
+            new_cache_files = set(cache_dir.iterdir())
+            self.assertEqual(len(new_cache_files), len(cache_files))
+            self.assertEqual(len(cache_files - new_cache_files), 1)
+
+    def test_prepare_stat_table_top(self):
+        """
+        Таблица по report_size URL совпадает с началом полной таблицы,
+        проценты считаются от всех URL
+        """
+        log_data = LogAggregate()
+        for i in range(200):
+            for _ in range(i % 13 + 1):
+                log_data.add(f"/url/{i}", (i * 7 % 31) / 10)
+        log_data.total_rows = sum(url_stat.count for url_stat in log_data.urls.values())
+        full = prepare_stat_table(log_data)
+        top = prepare_stat_table(log_data, report_size=10)
+        self.assertEqual(top, full[:10])
+        self.assertAlmostEqual(sum(row["time_perc"] for row in full), 100)
+
+    def test_url_normalization(self):
+        """
+        Идентификаторы, UUID и значения параметров сворачиваются в шаблоны
+        """
+        normalizer = UrlNormalizer()
+        self.assertEqual(normalizer("/api/v2/banner/25019354"), "/api/v2/banner/{id}")
+        self.assertEqual(normalizer("/api/1/list/?server_name=WIN7RB4&page=2"),
+                         "/api/{id}/list/?server_name=*&page=*")
+        self.assertEqual(normalizer("/x/0b1e1a2c-1111-2222-3333-444455556666/y"), "/x/{uuid}/y")
+        custom = UrlNormalizer(rules=[(r"/banner/\d+", "/banner/N")])
+        self.assertEqual(custom("/api/v2/banner/1?a=1"), "/api/v2/banner/N?a=1")
+        # Кеш нормализации не сериализуется
+        restored = pickle.loads(pickle.dumps(custom))
+        self.assertEqual(restored._cache, {})
+        self.assertEqual(restored("/api/v2/banner/1?a=1"), "/api/v2/banner/N?a=1")
+
+    def test_max_urls_overflow(self):
+        """
+        При превышении лимита редкие URL сворачиваются в отдельный URL
+        """
+        log_data = LogAggregate(max_urls=10)
+        for _ in range(100):
+            log_data.add("/popular", 0.1)
+        for i in range(1000):
+            log_data.add(f"/rare/{i}", 0.2)
+        log_data.fold_rare_urls()
+        self.assertEqual(len(log_data), 10)
+        self.assertEqual(log_data.urls["/popular"].count, 100)
+        self.assertEqual(sum(url_stat.count for url_stat in log_data.urls.values()), 1100)
+        self.assertIn(OVERFLOW_URL, log_data.urls)
+
+    def test_max_urls_spill(self):
+        """
+        MAX_URLS ограничивает количество URL в памяти на разборе:
+        остальные сбрасываются на диск, отчет не меняется
+        """
+        rows = [LOG_ROW.format(url=f"/url/{i * 7919 % 5000}", time=f"{i % 1000 / 1000:.3f}") for i in range(20000)]
+        with tempfile.TemporaryDirectory() as catalog:
+            path = Path(catalog) / "nginx-access-ui.log-20200101"
+            path.write_text("".join(rows), encoding="UTF-8")
+            self.assertIsNone(get_memory_budget({"MAX_URLS": 0}))
+            budget = get_memory_budget({"MAX_URLS": 10, "SPILL_DIR": catalog})
+            self.assertIsNone(budget.limit)
+            expected = gather_log_data(str(path), max_urls=10)
+            run_stats = RunStats()
+            spilled = gather_log_data(str(path), run_stats=run_stats, memory_budget=budget, max_urls=10)
+            self.assertTrue(spilled.runs)
+            self.assertGreater(run_stats.spilled_runs, 0)
+            self.assertLess(len(spilled.urls), budget.spill_urls)
+            expected.fold_rare_urls()
+            spilled.fold_rare_urls()
+            # При равном суммарном времени порядок строк может отличаться
+            self.assertEqual(sorted(prepare_stat_table(spilled), key=itemgetter("url")),
+                             sorted(prepare_stat_table(expected), key=itemgetter("url")))
+
+    def test_daily_columns_with_overflow(self):
+        """
+        Колонки по дням строки OVERFLOW_URL складываются в ее итог
+        """
+        days = [LogAggregate(max_urls=3), LogAggregate(max_urls=3)]
+        for i in range(40):
+            days[i % 2].add(f"/url/{i % 9}", 0.1 * (i % 5))
+            days[i % 2].total_rows += 1
+        log_files = [LogFile(date=datetime(2020, 1, day), path=None) for day in (1, 2)]
+        log_data = merge_log_data(days, max_urls=3)
+        stat = prepare_stat_table(log_data, vectorized=False)
+        add_daily_columns(stat, log_files=log_files, logs_data=days, log_data=log_data)
+        for row in stat:
+            self.assertEqual(row["count_2020.01.01"] + row["count_2020.01.02"], row["count"], row["url"])
+        self.assertIn(OVERFLOW_URL, [row["url"] for row in stat])
+
+    @unittest.skipIf(np is None, "numpy не установлен")
+    def test_prepare_stat_table_numpy(self):
+        """
+        Колоночный расчет таблицы совпадает с построчным
+        """
+        for exact in (False, True):
+            log_data = LogAggregate(exact=exact, histogram_bounds=(0.1, 1))
+            for i in range(500):
+                for j in range(i % 5 + 1):
+                    log_data.add(f"/url/{i % 97}", (i * j % 17) / 10)
+            log_data.total_rows = 2000
+            for report_size in (None, 0, -1, 10, 96, 97, 500):
+                self.assertEqual(prepare_stat_table(log_data, report_size=report_size, percentiles=[90, 99]),
+                                 prepare_stat_table(log_data, report_size=report_size, percentiles=[90, 99],
+                                                    vectorized=False))
+
+    def test_sketch_median_is_mergeable(self):
+        """
+        Медиана по скетчу близка к точной и не зависит от объединения агрегатов
+        """
+        times = [i / 1000 for i in range(1, 2001)]
+        whole = LogAggregate()
+        left, right = LogAggregate(), LogAggregate()
+        for i, time in enumerate(times):
+            whole.add("/url", time)
+            (left if i % 2 else right).add("/url", time)
+        left.merge(right)
+        whole_median = whole.urls["/url"].median()
+        self.assertEqual(whole_median, left.urls["/url"].median())
+        self.assertAlmostEqual(whole_median / 1_000_000, median(times), delta=median(times) * 0.02)
+
+    def test_percentiles_and_histogram(self):
+        """
+        Перцентили близки к точным, гистограмма объединяется без потерь
+        """
+        times = [i / 1000 for i in range(1, 2001)]
+        for exact in (False, True):
+            options = {"exact": exact, "histogram_bounds": (0.5, 1, 1.5)}
+            whole, left, right = LogAggregate(**options), LogAggregate(**options), LogAggregate(**options)
+            for i, time in enumerate(times):
+                whole.add("/url", time)
+                (left if i % 3 else right).add("/url", time)
+            left.merge(right)
+            whole.total_rows = left.total_rows = len(times)
+            row, = prepare_stat_table(left, percentiles=[90, 99], vectorized=False)
+            self.assertEqual(row, prepare_stat_table(whole, percentiles=[90, 99], vectorized=False)[0])
+            self.assertAlmostEqual(row["time_p90"], 1.8, delta=1.8 * 0.02)
+            self.assertAlmostEqual(row["time_p99"], 1.98, delta=1.98 * 0.02)
+            self.assertEqual([row["hist_le_0.5"], row["hist_le_1"], row["hist_le_1.5"], row["hist_gt_1.5"]],
+                             [500, 500, 500, 500])
+        # Отсутствующая гистограмма объединяется как пустая, разные корзины - ошибка
+        bounds = (500_000, 1_000_000)
+        with_histogram, without_histogram = UrlStat(bounds=bounds), UrlStat(bounds=bounds)
+        with_histogram.add(700_000)
+        without_histogram.histogram = None
+        without_histogram.merge(with_histogram)
+        self.assertEqual(without_histogram.histogram, [0, 1, 0])
+        with self.assertRaises(ValueError):
+            with_histogram.merge(UrlStat(bounds=(500_000,)))
+
+    def test_run_stats(self):
+        """
+        Счетчики строк, выборка битых строк и время этапов;
+        строка не в UTF-8 не прерывает разбор лога
+        """
+        rows = make_log_rows(300)
+        with tempfile.TemporaryDirectory() as catalog:
+            path = Path(catalog) / "nginx-access-ui.log-20200101"
+            content = ("".join(rows[:3]).encode("UTF-8") + b"\xff\xfe \"GET /\n" +
+                       "".join(rows[3:]).encode("UTF-8"))
+            path.write_bytes(content)
+            run_stats = RunStats(sample_size=3)
+            log_data = gather_log_data(str(path), run_stats=run_stats)
+            parallel_stats = RunStats(sample_size=3)
+            gather_log_data(str(path), workers=2, run_stats=parallel_stats)
+        summary = run_stats.summary()
+        self.assertEqual(summary["total_rows"], len(rows) + 1)
+        self.assertEqual(summary["parsed_rows"], 300)
+        self.assertEqual(summary["malformed_rows"], len(rows) - 300 + 1)
+        self.assertEqual(summary["bytes_read"], len(content))
+        self.assertEqual(len(summary["bad_lines_sample"]), 3)
+        self.assertLessEqual({"read", "parse", "aggregate"}, set(summary["stages"]))
+        self.assertEqual(log_data.total_rows, summary["total_rows"])
+        parallel_summary = parallel_stats.summary()
+        self.assertEqual([parallel_summary[key] for key in ("total_rows", "malformed_rows", "bytes_read")],
+                         [summary["total_rows"], summary["malformed_rows"], len(content)])
+        self.assertEqual(len(parallel_summary["bad_lines_sample"]), 3)
+
+    def test_run_summary_by_default(self):
+        """
+        Итоговая статистика пишется в лог и без --progress и STATS_FILE
+        """
+        with tempfile.TemporaryDirectory() as catalog:
+            (Path(catalog) / "log").mkdir()
+            (Path(catalog) / "log" / "nginx-access-ui.log-20200101").write_text("".join(make_log_rows(100)),
+                                                                                encoding="UTF-8")
+            (Path(catalog) / "config.ini").write_text(f"[CONFIG]\nLOG_DIR = {catalog}/log\n"
+                                                      f"REPORT_DIR = {catalog}/out\nCACHE_DIR =\n",
+                                                      encoding="UTF-8")
+            process = subprocess.run([sys.executable, str(Path(__file__).with_name("log_analyzer.py")),
+                                      "--config", f"{catalog}/config.ini"],
+                                     cwd=catalog, capture_output=True, text=True, encoding="UTF-8", check=True)
+            # Отчет пишется в REPORT_DIR из --config, а не в каталог по умолчанию
+            self.assertTrue((Path(catalog) / "out" / "report-2020.01.01.html").exists())
+            self.assertTrue((Path(catalog) / "out" / "report-2020.01.01_data").is_dir())
+            self.assertFalse((Path(catalog) / "reports").exists())
+        summary = json.loads(process.stderr.strip().splitlines()[-1].split(" I ", 1)[1])
+        self.assertEqual((summary["parsed_rows"], summary["malformed_rows"]), (100, 2))
+
+    def test_merge_partial_aggregates(self):
+        """
+        Объединение частичных агрегатов хостов ассоциативно
+        и совпадает с агрегатом всех строк
+        """
+        rows = make_log_rows(600)
+        parts = [rows[:200], rows[200:450], rows[450:]]
+        log_files = [LogFile(date=datetime(2020, 1, day), path=f"nginx-access-ui.log-2020010{day}")
+                     for day in (1, 2, 3)]
+        with tempfile.TemporaryDirectory() as catalog:
+            whole_path = Path(catalog) / "whole.log"
+            whole_path.write_text("".join(rows), encoding="UTF-8")
+            whole = gather_log_data(str(whole_path), histogram_bounds=(0.5,))
+            paths = []
+            for i, part in enumerate(parts):
+                log_path = Path(catalog) / f"{i}.log"
+                log_path.write_text("".join(part), encoding="UTF-8")
+                paths.append(write_partial_aggregate(str(Path(catalog) / f"{i}.agg"),
+                                                     gather_log_data(str(log_path), histogram_bounds=(0.5,)),
+                                                     meta=get_partial_meta([log_files[i]])))
+            _, left = merge_partial_aggregates(paths)
+            _, parallel = merge_partial_aggregates(paths, workers=2)
+            meta, tail = merge_partial_aggregates(paths[1:])
+            tail_path = write_partial_aggregate(str(Path(catalog) / "tail.agg"), tail, meta=meta)
+            meta, right = merge_partial_aggregates([paths[0], tail_path])
+            # Лимит URL применяется к итоговому агрегату и не зависит от группировки
+            capped = gather_log_data(str(whole_path), histogram_bounds=(0.5,), max_urls=4)
+            _, merged_capped = merge_partial_aggregates(paths, workers=2, max_urls=4)
+            with self.assertRaises(ValueError):
+                merge_partial_aggregates([str(whole_path)])
+        expected = prepare_stat_table(whole, percentiles=[90])
+        for merged in (left, parallel, right):
+            self.assertEqual(prepare_stat_table(merged, percentiles=[90]), expected)
+        self.assertEqual(prepare_stat_table(merged_capped, percentiles=[90]), prepare_stat_table(capped, percentiles=[90]))
+        self.assertEqual([log["name"] for log in meta["logs"]], [log_file.path for log_file in log_files])
+        self.assertEqual((meta["date_from"], meta["date_to"]), ("20200101", "20200103"))
+
+    def test_spill_to_disk(self):
+        """
+        Агрегат, сброшенный на диск сериями, дает ту же таблицу,
+        что и агрегат в памяти; файлы серий удаляются вместе с агрегатом
+        """
+        for exact in (False, True):
+            in_memory = LogAggregate(exact=exact, histogram_bounds=(0.5,))
+            spilled = LogAggregate(exact=exact, histogram_bounds=(0.5,))
+            # Любой прирост памяти превышает отрицательный бюджет
+            budget = MemoryBudget(limit=-1, min_urls=40, max_runs=3)
+            for i in range(3000):
+                url, time = f"/url/{i * 7919 % 450}", (i * 37 % 1000 + i % 450) / 1000
+                in_memory.add(url, time)
+                spilled.add(url, time)
+                if i % 10 == 0:
+                    budget.check(spilled)
+            in_memory.total_rows = spilled.total_rows = 3000
+            runs = list(spilled.runs)
+            self.assertTrue(runs)
+            self.assertLessEqual(len(runs), 3)
+            # При равном суммарном времени порядок строк может отличаться
+            expected = prepare_stat_table(in_memory, percentiles=[90], vectorized=False)
+            actual = prepare_stat_table(spilled, percentiles=[90])
+            self.assertEqual(sorted(actual, key=itemgetter("url")), sorted(expected, key=itemgetter("url")))
+            self.assertEqual([row["time_sum"] for row in prepare_stat_table(spilled, report_size=25)],
+                             [row["time_sum"] for row in expected[:25]])
+            # Частичный агрегат сохраняется вместе с сериями на диске
+            with tempfile.TemporaryDirectory() as catalog:
+                meta = get_partial_meta([LogFile(date=datetime(2020, 1, 1), path="nginx-access-ui.log-20200101")])
+                path = write_partial_aggregate(str(Path(catalog) / "spilled.agg"), spilled, meta=meta)
+                _, restored = merge_partial_aggregates([path])
+            self.assertEqual(restored.time_sum(), in_memory.time_sum())
+            restored_stat = prepare_stat_table(restored, percentiles=[90], vectorized=False)
+            self.assertEqual(sorted(restored_stat, key=itemgetter("url")), sorted(expected, key=itemgetter("url")))
+            merged = LogAggregate(exact=exact, histogram_bounds=(0.5,))
+            merged.merge(spilled)
+            self.assertEqual(merged.runs, runs)
+            del spilled
+            self.assertTrue(all(Path(path).exists() for path in runs))
+            del merged
+            self.assertFalse(any(Path(path).exists() for path in runs))
+
+    def test_spill_in_workers(self):
+        """
+        Бюджет памяти соблюдается в процессах пула, их серии
+        переходят к основному процессу и удаляются вместе с агрегатом
+        """
+        rows = [LOG_ROW.format(url=f"/url/{i * 7919 % 500}", time=f"{i % 1000 / 1000:.3f}") for i in range(3000)]
+        with tempfile.TemporaryDirectory() as catalog:
+            path = Path(catalog) / "nginx-access-ui.log-20200101"
+            path.write_text("".join(rows), encoding="UTF-8")
+            expected = gather_log_data(str(path))
+            budget = MemoryBudget(limit=-1, directory=catalog, min_urls=20)
+            run_stats = RunStats()
+            spilled = gather_log_data(str(path), workers=2, run_stats=run_stats, memory_budget=budget)
+            runs = list(spilled.runs)
+            self.assertTrue(runs)
+            self.assertTrue(all(Path(run).exists() for run in runs))
+            self.assertGreater(run_stats.spilled_runs, 0)
+            self.assertEqual(len(spilled), len(expected))
+            self.assertEqual(sorted(prepare_stat_table(spilled), key=itemgetter("url")),
+                             sorted(prepare_stat_table(expected), key=itemgetter("url")))
+            del spilled
+            self.assertFalse(any(Path(run).exists() for run in runs))
+
+    def test_spill_per_day(self):
+        """
+        С --per-day бюджет памяти соблюдается: агрегаты дней сбрасываются
+        на диск, колонки по дням совпадают с расчетом в памяти
+        """
+        with tempfile.TemporaryDirectory() as catalog:
+            log_files = []
+            for day in (1, 2, 3):
+                rows = [LOG_ROW.format(url=f"/url/{i * 7919 % (1000 * day)}", time=f"{i % 1000 / 1000:.3f}")
+                        for i in range(5000)]
+                path = Path(catalog) / f"nginx-access-ui.log-2020010{day}"
+                path.write_text("".join(rows), encoding="UTF-8")
+                log_files.append(LogFile(date=datetime(2020, 1, day), path=str(path)))
+            log_data, logs_data = load_report_data(log_files, config={}, per_day=True)
+            expected = prepare_stat_table(log_data)
+            add_daily_columns(expected, log_files=log_files, logs_data=logs_data, log_data=log_data)
+            # Любой прирост памяти превышает отрицательный бюджет
+            budget_config = {"MEMORY_LIMIT_MB": -1, "SPILL_DIR": catalog}
+            run_stats = RunStats()
+            log_data, logs_data = load_report_data(log_files, config=budget_config, run_stats=run_stats,
+                                                   per_day=True)
+            self.assertTrue(all(day_data.runs for day_data in logs_data))
+            # У общего агрегата свои файлы серий, дни их не делят
+            day_runs = {path for day_data in logs_data for path in day_data.runs}
+            self.assertFalse(day_runs & set(log_data.runs))
+            self.assertGreater(run_stats.spilled_runs, 0)
+            actual = prepare_stat_table(log_data)
+            add_daily_columns(actual, log_files=log_files, logs_data=logs_data, log_data=log_data)
+            self.assertEqual(sorted(actual, key=itemgetter("url")), sorted(expected, key=itemgetter("url")))
+            del logs_data
+            self.assertFalse(any(Path(path).exists() for path in day_runs))
+
+    def test_write_jsonl_report(self):
+        """
+        Запись отчета в JSON Lines
+        """
+        last_log = LogFile(date=datetime(2020, 1, 1), path="nginx-access-ui.log-20200101")
+        stat = [{"url": "/one", "count": 1}, {"url": "/two", "count": 2}, {"url": "/three", "count": 3}]
+        with tempfile.TemporaryDirectory() as catalog:
+            write_reports(stat=stat, config={"REPORT_SIZE": 2, "REPORT_FORMATS": ["jsonl"], "REPORT_DIR": catalog},
+                          last_log=last_log)
+            report_path = Path(catalog) / "report-2020.01.01.jsonl"
+            rows = [json.loads(row) for row in report_path.read_text(encoding="UTF-8").splitlines()]
+        self.assertEqual(rows, stat[:2])
+
+    @unittest.skipIf(np is None and pa is None, "не установлены ни numpy, ни pyarrow")
+    def test_write_columnar_reports(self):
+        """
+        Запись колоночных отчетов, ошибка одного формата не мешает остальным
+        """
+        last_log = LogFile(date=datetime(2020, 1, 1), path="nginx-access-ui.log-20200101")
+        stat = [{"url": "/one", "count": 1, "time_sum": 0.5}, {"url": "/two", "count": 2, "time_sum": 1.5}]
+
+        def broken_writer(**kwargs):
+            raise ValueError("формат сломан")
+
+        formats = ["broken", "jsonl"]
+        extensions = ["jsonl"]
+        if np is not None:
+            formats.append("npz")
+            extensions.append("npz")
+        if pa is not None:
+            formats += ["parquet", "arrow"]
+            extensions += ["parquet", "arrow"]
+        with tempfile.TemporaryDirectory() as catalog:
+            REPORT_WRITERS["broken"] = broken_writer
+            try:
+                with self.assertLogs(level="ERROR"):
+                    write_reports(stat=stat, config={"REPORT_FORMATS": formats, "REPORT_DIR": catalog},
+                                  last_log=last_log)
+            finally:
+                del REPORT_WRITERS["broken"]
+            for extension in extensions:
+                self.assertTrue((Path(catalog) / f"report-2020.01.01.{extension}").exists(), extension)
+            if np is not None:
+                with np.load(Path(catalog) / "report-2020.01.01.npz") as columns:
+                    self.assertEqual(columns["url"].tolist(), ["/one", "/two"])
+                    self.assertEqual(columns["time_sum"].tolist(), [0.5, 1.5])
+            if pa is not None:
+                table = pq.read_table(Path(catalog) / "report-2020.01.01.parquet")
+                self.assertEqual(table.to_pylist(), stat)
+                with pa.OSFile(str(Path(catalog) / "report-2020.01.01.arrow"), "rb") as source:
+                    self.assertEqual(pa.ipc.open_file(source).read_all().to_pylist(), stat)
+
     def _delete_folders_tree(self, catalog_path):
         """
         Удаляет древо каталогов
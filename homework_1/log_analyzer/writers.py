@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Запись отчетов
+
+Отчет за лог (период) пишется в каталог REPORT_DIR во всех форматах
+из REPORT_FORMATS: HTML, JSON Lines и колоночных (Parquet, Arrow IPC, .npz)
+"""
+import json
+import logging
+import os
+import shutil
+from functools import partial
+from itertools import islice
+from pathlib import Path
+from string import Template
+from typing import Iterable
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from log_index import LogFile
+
+
+def get_report_path(config: dict, last_log: LogFile, first_log: LogFile = None, extension: str = "html") -> str:
+    """
+    Формирует путь до файла с отчетом в каталоге REPORT_DIR конфигурации config.
+    Если задан first_log, отчет строится за период от first_log до last_log
+    """
+    _date = last_log.date
+    date = _date.strftime("%Y.%m.%d")
+    if first_log is not None and first_log.date != last_log.date:
+        date = f'{first_log.date.strftime("%Y.%m.%d")}-{date}'
+    catalog = config.get("REPORT_DIR", ".")
+    return str(Path(catalog) / f"report-{date}.{extension}")
+
+
+def report_exists(config: dict, last_log: LogFile, first_log: LogFile = None, extension: str = "html") -> bool:
+    """
+    Проверяет выполнены ли отчет по этому логу (периоду) ранее
+    """
+    path = get_report_path(config, last_log=last_log, first_log=first_log, extension=extension)
+    return os.path.exists(path)
+
+
+def create_report_folders_tree_is_not_exists(report_path: str):
+    """
+    Создает древо папок, если они не существуют
+    """
+    report_path = Path(report_path).parent
+    report_path.mkdir(parents=True, exist_ok=True)
+
+
+def get_report_data_path(report_path: str) -> Path:
+    """Каталог с файлами данных HTML отчета: report-2017.06.30.html -> report-2017.06.30_data"""
+    report_path = Path(report_path)
+    return report_path.with_name(f"{report_path.stem}_data")
+
+
+def write_report_chunks(rows: Iterable[dict], data_path: Path, chunk_size: int) -> int:
+    """
+    Записывает строки таблицы в файлы chunk-NNNNN.js по chunk_size строк.
+    Файл вызывает reportChunk(номер, [строки в JSON]), поэтому отчет
+    открывается и с диска (file://), где загрузка JSON через fetch запрещена.
+    Строки пишутся по одной, без сборки документа в памяти.
+    Возвращает количество файлов
+    """
+    rows = iter(rows)
+    chunks = 0
+    while True:
+        chunk_rows = list(islice(rows, chunk_size))
+        if not chunk_rows:
+            break
+        with open(data_path / f"chunk-{chunks:05d}.js", "w", encoding="UTF-8") as chunk:
+            chunk.write(f"reportChunk({chunks}, [\n")
+            for i, row in enumerate(chunk_rows):
+                if i:
+                    chunk.write(",\n")
+                chunk.write(json.dumps(row, ensure_ascii=False))
+            chunk.write("]);\n")
+        chunks += 1
+    return chunks
+
+
+def write_report_page(path: str, report: dict):
+    """
+    Записывает страницу HTML отчета: шаблон с описанием отчета в JSON
+    """
+    report_template_path = Path(__file__).parent / "report_template.html"
+    with open(report_template_path, encoding="UTF-8") as template:
+        output = Template(template.read()).safe_substitute({"report_json": json.dumps(report, ensure_ascii=False)})
+    with open(path, "w", encoding="UTF-8") as new_report:
+        new_report.write(output)
+
+
+def write_html_report(stat: list[dict], config: dict, last_log: LogFile, first_log: LogFile = None,
+                      path: str = None):
+    """
+    Генерирует HTML отчет: страницу-оболочку и каталог с файлами данных
+    по REPORT_CHUNK_SIZE строк, которые страница загружает по мере листания.
+    Отчет подменяется целиком, что бы не отдать браузеру недописанные файлы.
+    path - путь до отчета, если он не должен зависеть от даты лога
+    """
+    report_size = config.get("REPORT_SIZE", 1_000)
+    chunk_size = max(1, config.get("REPORT_CHUNK_SIZE", 1_000))
+    if path is None:
+        path = get_report_path(config, last_log=last_log, first_log=first_log)
+    create_report_folders_tree_is_not_exists(report_path=path)
+    data_path = get_report_data_path(path)
+    tmp_data_path = data_path.with_name(f"{data_path.name}.tmp")
+    old_data_path = data_path.with_name(f"{data_path.name}.old")
+    tmp_path = f"{path}.tmp"
+    try:
+        shutil.rmtree(tmp_data_path, ignore_errors=True)
+        tmp_data_path.mkdir()
+        rows = stat[:report_size]
+        chunks = write_report_chunks(rows, data_path=tmp_data_path, chunk_size=chunk_size)
+        report = {"rows": len(rows),
+                  "chunks": chunks,
+                  "chunk_size": chunk_size,
+                  "columns": list(rows[0]) if rows else ["url"],
+                  "data_dir": data_path.name}
+        write_report_page(tmp_path, report)
+        if data_path.exists():
+            shutil.rmtree(old_data_path, ignore_errors=True)
+            os.replace(data_path, old_data_path)
+        os.replace(tmp_data_path, data_path)
+        os.replace(tmp_path, path)
+        shutil.rmtree(old_data_path, ignore_errors=True)
+    except IOError as err:
+        logging.exception("Произошла ошибка при сохранении HTML отчета", exc_info=True)
+        raise err
+
+
+def write_jsonl_report(stat: list[dict], config: dict, last_log: LogFile, first_log: LogFile = None):
+    """
+    Записывает таблицу в JSON Lines: строка файла - строка таблицы.
+    Строки пишутся по одной, без сборки всего документа в памяти
+    """
+    report_size = config.get("REPORT_SIZE", 1_000)
+    path = get_report_path(config, last_log=last_log, first_log=first_log, extension="jsonl")
+    create_report_folders_tree_is_not_exists(report_path=path)
+    with open(path, "w", encoding="UTF-8") as report:
+        for row in stat[:report_size]:
+            report.write(json.dumps(row, ensure_ascii=False))
+            report.write("\n")
+
+
+def get_stat_columns(stat: list[dict]) -> dict[str, list]:
+    """
+    Переводит таблицу из списка строк в колонки
+    """
+    names = list(stat[0]) if stat else ["url"]
+    return {name: [row.get(name) for row in stat] for name in names}
+
+
+def write_columnar_report(stat: list[dict], config: dict, last_log: LogFile,
+                          first_log: LogFile = None, file_format: str = "parquet"):
+    """
+    Записывает таблицу в колоночном формате:
+    Parquet или Arrow IPC, если установлен pyarrow, иначе NumPy .npz
+    """
+    report_size = config.get("REPORT_SIZE", 1_000)
+    columns = get_stat_columns(stat[:report_size])
+    if pa is None or file_format == "npz":
+        if np is None:
+            raise ImportError("Для колоночного отчета нужен pyarrow или numpy")
+        path = get_report_path(config, last_log=last_log, first_log=first_log, extension="npz")
+        create_report_folders_tree_is_not_exists(report_path=path)
+        np.savez_compressed(path, **{name: np.array(values) for name, values in columns.items()})
+        return
+    table = pa.table(columns)
+    extension = "parquet" if file_format == "parquet" else "arrow"
+    path = get_report_path(config, last_log=last_log, first_log=first_log, extension=extension)
+    create_report_folders_tree_is_not_exists(report_path=path)
+    if file_format == "parquet":
+        pq.write_table(table, path)
+    else:
+        with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+# Форматы отчетов: имя формата из REPORT_FORMATS -> функция записи
+REPORT_WRITERS = {
+    "html": write_html_report,
+    "jsonl": write_jsonl_report,
+    "parquet": partial(write_columnar_report, file_format="parquet"),
+    "arrow": partial(write_columnar_report, file_format="arrow"),
+    "npz": partial(write_columnar_report, file_format="npz"),
+}
+
+
+def write_reports(stat: list[dict], config: dict, last_log: LogFile, first_log: LogFile = None):
+    """
+    Записывает отчеты во всех форматах из REPORT_FORMATS.
+    Ошибка записи одного формата пишется в лог и не мешает остальным
+    """
+    for report_format in config.get("REPORT_FORMATS", ["html"]):
+        writer = REPORT_WRITERS.get(report_format)
+        if writer is None:
+            logging.error(f'Неизвестный формат отчета "{report_format}"')
+            continue
+        try:
+            writer(stat=stat, config=config, last_log=last_log, first_log=first_log)
+        except Exception:
+            logging.exception(f'Не удалось сохранить отчет в формате "{report_format}"')